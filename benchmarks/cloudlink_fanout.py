@@ -0,0 +1,498 @@
+"""
+Cloudlink fan-out benchmark.
+
+Starts the server (main.py) in a subprocess against local MongoDB and Redis instances, connects simulated
+v0 and v1 clients, and drives a few realistic workloads through Cloudlink commands:
+    posting    bursts of home posts (create_post), delivered to every client
+    typing     home typing storms (typing), delivered to every client as low priority frames
+    reactions  reactions on home posts (add_reaction), delivered to every client
+    churn      clients logging in and out (authpswd + disconnect), which makes the server send the ulist to everyone
+
+For each workload it reports events/sec, deliveries/sec, p50/p99 delivery latency (from the command being sent to
+each client receiving the event), the share of expected deliveries that arrived, and the server-side fan-out time
+from the metrics endpoint. Server memory per connection is measured from the server's RSS before and after
+connecting the clients.
+
+Usage:
+    python benchmarks/cloudlink_fanout.py --clients 2000 --v0-ratio 0.5
+
+MONGO_URI and REDIS_URI should point at throwaway local instances. The benchmark database (--mongo-db) gets dropped
+and the Redis database (--redis-uri) gets flushed on every run, so don't point them at anything you care about.
+Clients run in this process, so on small machines the client side can become the bottleneck before the server does.
+"""
+
+from typing import Optional, Callable
+import argparse, asyncio, json, os, re, secrets, socket, subprocess, sys, time, urllib.request
+
+import pymongo, redis, websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_IP_HEADER = "X-Bench-Ip"
+REACTION_EMOJIS = ["👍", "😂", "❤️", "🎉", "😮", "😢", "🔥", "👀"]
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def fake_ip(i: int) -> str:
+    # Unique IP per client, so per-IP rate limits don't kick in
+    return f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get_rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def scrape_fanout(metrics_url: str) -> dict[str, tuple[float, int]]:
+    # {"cmd": (total seconds, events)}
+    try:
+        body = urllib.request.urlopen(metrics_url, timeout=5).read().decode()
+    except OSError:
+        return {}
+    totals: dict[str, list] = {}
+    for name, cmd, value in re.findall(r'^cl_fanout_duration_seconds_(sum|count)\{cmd="([^"]+)"\} (\S+)$', body, re.M):
+        totals.setdefault(cmd, [0.0, 0])[0 if name == "sum" else 1] = float(value)
+    return {cmd: (total, int(count)) for cmd, (total, count) in totals.items()}
+
+
+class SimClient:
+    def __init__(self, bench: "Bench", i: int, username: str, token: str, proto: int, counted: bool = True):
+        self.bench = bench
+        self.counted = counted  # whether deliveries to this client count towards a round
+        self.ip = fake_ip(i)
+        self.username = username
+        self.token = token
+        self.proto = proto
+        self.ws: Optional[websockets.WebSocketClientProtocol] = None
+        self.reader: Optional[asyncio.Task] = None
+        self.listeners: dict[str, asyncio.Future] = {}
+        self.authed = False
+
+    async def connect(self):
+        self.ws = await websockets.connect(
+            f"{self.bench.cl_url}/?v={self.proto}",
+            extra_headers={BENCH_IP_HEADER: self.ip},
+            compression=(None if self.bench.args.no_deflate else "deflate"),
+            max_size=None,
+            open_timeout=60
+        )
+        self.reader = asyncio.create_task(self.read_loop())
+
+    async def close(self):
+        if self.ws:
+            await self.ws.close()
+        if self.reader:
+            await asyncio.gather(self.reader, return_exceptions=True)
+        self.authed = False
+
+    async def send(self, cmd: str, val, listener: Optional[str] = None):
+        packet = {"cmd": cmd, "val": val}
+        if self.proto == 0:  # v0 clients wrap commands in "direct"
+            packet = {"cmd": "direct", "val": packet}
+        if listener:
+            packet["listener"] = listener
+        await self.ws.send(json.dumps(packet))
+
+    async def request(self, cmd: str, val, timeout: float = 60) -> str:
+        listener = secrets.token_hex(4)
+        future = self.listeners[listener] = asyncio.get_running_loop().create_future()
+        await self.send(cmd, val, listener=listener)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.listeners.pop(listener, None)
+
+    async def login(self) -> bool:
+        statuscode = await self.request("authpswd", {"username": self.username, "pswd": self.token})
+        self.authed = statuscode.startswith("I:100")
+        return self.authed
+
+    async def read_loop(self):
+        try:
+            async for frame in self.ws:
+                received_at = time.perf_counter()
+                packet = json.loads(frame)
+                cmd, val = packet.get("cmd"), packet.get("val")
+
+                # Resolve command responses
+                if cmd == "statuscode" and packet.get("listener") in self.listeners:
+                    future = self.listeners[packet["listener"]]
+                    if not future.done():
+                        future.set_result(val)
+                    continue
+
+                # Unwrap v0 events
+                if self.proto == 0 and cmd == "direct" and isinstance(val, dict):
+                    if val.get("mode") == 1:
+                        cmd = "post"
+                    elif val.get("state") == 101:
+                        cmd, val = "typing", {"chat_id": "home", "username": val.get("u")}
+                    elif "payload" in val:
+                        cmd, val = val["mode"], val["payload"]
+
+                # Keep refreshed session token for the next login
+                if cmd == "auth" and isinstance(val, dict) and val.get("token"):
+                    self.token = val["token"]
+
+                self.bench.on_event(self, cmd, val, received_at)
+        except websockets.ConnectionClosed:
+            pass
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.cl_port = get_free_port()
+        self.api_port = get_free_port()
+        self.metrics_port = get_free_port()
+        self.cl_url = f"ws://127.0.0.1:{self.cl_port}"
+        self.metrics_url = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        self.server: Optional[subprocess.Popen] = None
+        self.env = {
+            "MONGO_URI": args.mongo_uri,
+            "MONGO_DB": args.mongo_db,
+            "REDIS_URI": args.redis_uri,
+            "REAL_IP_HEADER": BENCH_IP_HEADER,
+            "CL3_HOST": "127.0.0.1",
+            "CL3_PORT": str(self.cl_port),
+            "CL3_CONN_RATE_BURST": "1000000",
+            "CL3_CONN_RATE_REFILL": "1000000",
+            "API_HOST": "127.0.0.1",
+            "API_PORT": str(self.api_port),
+            "INTERNAL_API_ENDPOINT": f"http://127.0.0.1:{self.api_port}",
+            "INTERNAL_API_TOKEN": secrets.token_hex(16),
+            "METRICS_HOST": "127.0.0.1",
+            "METRICS_PORT": str(self.metrics_port),
+            "CAPTCHA_SECRET": "",
+            "EMAIL_SMTP_HOST": "",
+            "SENTRY_DSN": "",
+            "GRPC_AUTH_ADDRESS": f"127.0.0.1:{get_free_port()}"
+        }
+
+        self.clients: list[SimClient] = []
+        self.churners: list[SimClient] = []
+        self.post_ids: list[str] = []
+
+        # Current round
+        self.sent_at: dict[str, float] = {}
+        self.key_fn: Optional[Callable] = None
+        self.pending_ulist: set[str] = set()
+        self.latencies: list[float] = []
+        self.delivered = 0
+        self.expected = 0
+        self.round_done = asyncio.Event()
+
+    def seed(self) -> list[tuple[str, str]]:
+        # Reset benchmark databases
+        pymongo.MongoClient(self.args.mongo_uri).drop_database(self.args.mongo_db)
+        redis.from_url(self.args.redis_uri).flushdb()
+
+        # Importing the database module connects and creates the default config (signing keys),
+        # indexes (database.build_indexes) and migrations (migrations.py) aren't needed for fan-out
+        os.environ.update(self.env)
+        sys.path.insert(0, ROOT)
+        from database import db
+        import security
+        from sessions import AccSession
+
+        # Every user shares one password hash, bcrypt is way too slow to run per user
+        password_hash = security.hash_password(secrets.token_hex(16))
+        now = int(time.time())
+        users, settings, sessions = [], [], []
+        for i in range(self.args.clients + self.args.churn_clients):
+            username = f"bench{i}"
+            users.append({
+                "_id": username,
+                "lower_username": username,
+                "uuid": secrets.token_hex(16),
+                "created": now,
+                "pfp_data": 1,
+                "avatar": "",
+                "avatar_color": "000000",
+                "quote": "",
+                "email": "",
+                "normalized_email_hash": "",
+                "pswd": password_hash,
+                "mfa_recovery_code": secrets.token_hex(5),
+                "flags": 0,
+                "permissions": 0,
+                "ban": {"state": "none", "restrictions": 0, "expires": 0, "reason": ""},
+                "last_seen": now,
+                "delete_after": None
+            })
+            settings.append({"_id": username})
+            sessions.append({
+                "_id": secrets.token_hex(16),
+                "user": username,
+                "ip": fake_ip(i),
+                "user_agent": None,
+                "created_at": now,
+                "refreshed_at": now
+            })
+        db.usersv0.insert_many(users)
+        db.user_settings.insert_many(settings)
+        db.acc_sessions.insert_many(sessions)
+        return [(session["user"], AccSession(session).token) for session in sessions]
+
+    async def start_server(self):
+        self.server = subprocess.Popen(
+            [sys.executable, "main.py"],
+            cwd=ROOT,
+            env={**os.environ, **self.env},
+            stdout=open(self.args.server_log, "w"),
+            stderr=subprocess.STDOUT
+        )
+
+        # Wait for the REST API and Cloudlink to accept connections
+        deadline = time.time() + 120
+        for port in (self.api_port, self.cl_port):
+            while True:
+                if self.server.poll() is not None:
+                    raise RuntimeError(f"Server exited early, see {self.args.server_log}")
+                try:
+                    _, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.close()
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise RuntimeError("Timed out waiting for the server to start")
+                    await asyncio.sleep(0.25)
+
+    def stop_server(self):
+        if self.server and self.server.poll() is None:
+            self.server.terminate()
+            try:
+                self.server.wait(10)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+
+    async def connect_clients(self, clients: list[SimClient], login: bool):
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def connect(client: SimClient):
+            async with semaphore:
+                await client.connect()
+                if login:
+                    await client.login()
+
+        await asyncio.gather(*(connect(client) for client in clients))
+
+    def on_event(self, client: SimClient, cmd: str, val, received_at: float):
+        if self.key_fn is None or not client.counted:
+            return
+
+        if cmd == "post" and isinstance(val, dict) and str(val.get("p", "")).startswith("bench "):
+            if val.get("_id") not in self.post_ids:
+                self.post_ids.append(val.get("_id"))
+
+        # Logins show up as new usernames in the ulist
+        if cmd == "ulist" and self.pending_ulist:
+            keys = [f"ulist:{username}" for username in self.pending_ulist if f";{username};" in f";{val}"]
+        else:
+            key = self.key_fn(cmd, val)
+            keys = [key] if key else []
+
+        for key in keys:
+            sent_at = self.sent_at.get(key)
+            if sent_at is None:
+                continue
+            self.latencies.append(received_at - sent_at)
+            self.delivered += 1
+        if self.delivered >= self.expected:
+            self.round_done.set()
+
+    async def run_round(self, key_fn: Callable, triggers: list[tuple[str, SimClient, Callable]], expected: int):
+        # triggers: [(key, client, coroutine function that sends the command)]
+        self.key_fn = key_fn
+        self.sent_at = {}
+        self.delivered = 0
+        self.expected = expected
+        self.round_done.clear()
+        for key, _, _ in triggers:
+            self.sent_at[key] = time.perf_counter()
+        await asyncio.gather(*(trigger() for _, _, trigger in triggers), return_exceptions=True)
+        try:
+            await asyncio.wait_for(self.round_done.wait(), self.args.round_timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.delivered
+
+    async def run_workload(self, name: str) -> dict:
+        actors = [client for client in self.clients if client.authed]
+        if not actors:
+            raise RuntimeError("No authenticated clients to drive workloads with")
+        connected = sum(1 for client in self.clients if client.ws and not client.ws.closed)
+        burst = self.args.burst
+
+        self.latencies = []
+        events = delivered = expected = 0
+        fanout_before = scrape_fanout(self.metrics_url)
+        started_at = time.perf_counter()
+        for round_num in range(self.args.rounds):
+            # Rotate actors, every command type is rate limited per user
+            round_actors = [actors[((round_num * burst) + i) % len(actors)] for i in range(burst)]
+
+            if name == "posting":
+                triggers = []
+                for actor in round_actors:
+                    content = f"bench {secrets.token_hex(8)}"
+                    triggers.append((content, actor, lambda actor=actor, content=content: actor.send("create_post", {"chat_id": "home", "content": content})))
+                key_fn = lambda cmd, val: val.get("p") if cmd == "post" and isinstance(val, dict) else None
+                round_expected = burst * connected
+            elif name == "typing":
+                round_actors = list({actor.username: actor for actor in round_actors}.values())
+                triggers = [
+                    (f"typing:{actor.username}", actor, lambda actor=actor: actor.send("typing", {"chat_id": "home"}))
+                    for actor in round_actors
+                ]
+                key_fn = lambda cmd, val: f"typing:{val.get('username')}" if cmd == "typing" and isinstance(val, dict) else None
+                round_expected = len(triggers) * connected
+            elif name == "reactions":
+                if not self.post_ids:
+                    raise RuntimeError("The reactions workload needs the posting workload to run first")
+                post_id = self.post_ids[round_num % len(self.post_ids)]
+                triggers = []
+                for i, actor in enumerate(round_actors):
+                    emoji = REACTION_EMOJIS[i % len(REACTION_EMOJIS)]
+                    triggers.append((
+                        f"react:{post_id}:{emoji}:{actor.username}",
+                        actor,
+                        lambda actor=actor, emoji=emoji: actor.send("add_reaction", {"post_id": post_id, "emoji": emoji})
+                    ))
+                key_fn = lambda cmd, val: f"react:{val.get('post_id')}:{val.get('emoji')}:{val.get('username')}" if cmd == "post_reaction_add" and isinstance(val, dict) else None
+                round_expected = burst * connected
+            elif name == "churn":
+                churners = self.churners[(round_num * burst) % len(self.churners):][:burst]
+                await self.connect_clients(churners, login=False)
+                self.pending_ulist = {churner.username for churner in churners}
+                triggers = [(f"ulist:{churner.username}", churner, churner.login) for churner in churners]
+                key_fn = lambda cmd, val: None
+                round_expected = len(churners) * connected
+            else:
+                raise ValueError(f"Unknown workload {name}")
+
+            delivered += await self.run_round(key_fn, triggers, round_expected)
+            events += len(triggers)
+            expected += round_expected
+
+            if name == "churn":
+                self.pending_ulist = set()
+                await asyncio.gather(*(churner.close() for churner in churners))
+
+        elapsed = time.perf_counter() - started_at
+        self.key_fn = None
+
+        # Server-side fan-out time
+        fanout_cmd = {"posting": "post", "typing": "typing", "reactions": "post_reaction_add", "churn": "ulist"}[name]
+        fanout_after = scrape_fanout(self.metrics_url)
+        fanout_time = fanout_after.get(fanout_cmd, (0, 0))[0] - fanout_before.get(fanout_cmd, (0, 0))[0]
+        fanout_events = fanout_after.get(fanout_cmd, (0, 0))[1] - fanout_before.get(fanout_cmd, (0, 0))[1]
+
+        p50, p99 = percentile(self.latencies, 0.5), percentile(self.latencies, 0.99)
+        return {
+            "workload": name,
+            "clients": connected,
+            "events": events,
+            "events_per_sec": round(events / elapsed, 1),
+            "deliveries_per_sec": round(delivered / elapsed, 1),
+            "delivered_ratio": round(delivered / expected, 4) if expected else None,
+            "p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+            "p99_ms": round(p99 * 1000, 2) if p99 is not None else None,
+            "server_fanout_avg_ms": round((fanout_time / fanout_events) * 1000, 3) if fanout_events else None
+        }
+
+    async def run(self) -> dict:
+        credentials = self.seed()
+        await self.start_server()
+        try:
+            rss_idle = get_rss(self.server.pid)
+
+            # Connect clients, the first auth_ratio of them get logged in to drive workloads
+            v0_count = int(self.args.clients * self.args.v0_ratio)
+            auth_count = max(int(self.args.clients * self.args.auth_ratio), 1)
+            self.clients = [
+                SimClient(self, i, username, token, (0 if i < v0_count else 1))
+                for i, (username, token) in enumerate(credentials[:self.args.clients])
+            ]
+            self.churners = [
+                SimClient(self, self.args.clients + i, username, token, (i % 2), counted=False)
+                for i, (username, token) in enumerate(credentials[self.args.clients:])
+            ]
+            started_at = time.perf_counter()
+            await self.connect_clients(self.clients[auth_count:], login=False)
+            await self.connect_clients(self.clients[:auth_count], login=True)
+            connect_time = time.perf_counter() - started_at
+            await asyncio.sleep(1)
+            rss_connected = get_rss(self.server.pid)
+
+            results = {
+                "clients": self.args.clients,
+                "v0_clients": v0_count,
+                "authenticated": sum(1 for client in self.clients if client.authed),
+                "connect_seconds": round(connect_time, 2),
+                "server_rss_idle_mb": round(rss_idle / 1048576, 1),
+                "server_bytes_per_connection": round((rss_connected - rss_idle) / self.args.clients),
+                "workloads": []
+            }
+            for name in self.args.workloads:
+                results["workloads"].append(await self.run_workload(name))
+                await asyncio.sleep(self.args.cooldown)
+            return results
+        finally:
+            await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
+            self.stop_server()
+
+
+def print_results(results: dict):
+    print(f"{results['clients']} clients ({results['v0_clients']} v0, {results['authenticated']} authenticated), connected in {results['connect_seconds']}s")
+    print(f"Server RSS: {results['server_rss_idle_mb']} MB idle, {results['server_bytes_per_connection']} bytes per connection")
+    print()
+    columns = ["workload", "events", "events_per_sec", "deliveries_per_sec", "delivered_ratio", "p50_ms", "p99_ms", "server_fanout_avg_ms"]
+    print("  ".join(f"{column:>20}" for column in columns))
+    for workload in results["workloads"]:
+        print("  ".join(f"{str(workload[column]):>20}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Cloudlink fan-out with simulated clients.")
+    parser.add_argument("--clients", type=int, default=1000, help="simulated clients to keep connected")
+    parser.add_argument("--v0-ratio", type=float, default=0.5, help="share of clients using protocol v0 (the rest use v1)")
+    parser.add_argument("--auth-ratio", type=float, default=0.25, help="share of clients that log in and drive workloads")
+    parser.add_argument("--churn-clients", type=int, default=100, help="extra clients that log in and out for the churn workload")
+    parser.add_argument("--workloads", nargs="+", default=["posting", "typing", "reactions", "churn"], choices=["posting", "typing", "reactions", "churn"])
+    parser.add_argument("--rounds", type=int, default=10, help="rounds per workload")
+    parser.add_argument("--burst", type=int, default=20, help="events triggered at once per round")
+    parser.add_argument("--round-timeout", type=float, default=10, help="seconds to wait for a round to be delivered")
+    parser.add_argument("--cooldown", type=float, default=5, help="seconds between workloads (lets rate limits reset)")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--no-deflate", action="store_true", help="don't negotiate permessage-deflate")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017"))
+    parser.add_argument("--mongo-db", default="meowerbench")
+    parser.add_argument("--redis-uri", default="redis://127.0.0.1:6379/15")
+    parser.add_argument("--server-log", default="cloudlink_fanout_server.log")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(Bench(args).run())
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+Query-plan regression suite.
+
+Seeds a synthetic dataset (see seed.py) into a throwaway local MongoDB, calls the REST routes and a few background
+queries while capturing every MongoDB command they issue (with a pymongo command listener), then groups the commands
+by query shape (collection, command, filter fields and operators, sort) and runs explain() on one example of each.
+
+A shape fails when its winning plan has a COLLSCAN, or a blocking in-memory SORT (the index doesn't provide the
+order). Failing shapes, and shapes that aren't in the known shapes file yet, get an index recommendation built with
+the equality, sort, range rule. A missing known shapes file fails the run (unless --update-known is given).
+
+Usage:
+    python benchmarks/query_plans.py                  # check plans
+    python benchmarks/query_plans.py --update-known   # accept the current shapes as known
+"""
+
+from typing import Any, Iterator
+from copy import deepcopy
+import argparse, asyncio, json, os, sys, time
+
+from pymongo import monitoring
+
+from seed import setup_environment, seed
+from rest_hot_paths import get_routes
+
+KNOWN_SHAPES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.known.json")
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+SESSION_FIELDS = {"lsid", "txnNumber", "$db", "$clusterTime", "$readPreference", "readConcern", "writeConcern", "cursor"}
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$exists", "$type", "$regex", "$not", "$size", "$all", "$elemMatch"}
+EQUALITY_OPERATORS = {"$eq", "$in"}
+
+# Collections small enough that a collection scan is fine
+SMALL_COLLECTIONS = {"config"}
+
+
+class CommandCapture(monitoring.CommandListener):
+    def __init__(self):
+        self.enabled = False
+        self.source = ""
+        self.commands: list[tuple[str, str, dict]] = []  # [(source, command name, command)]
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if self.enabled and event.command_name in EXPLAINABLE_COMMANDS:
+            self.commands.append((self.source, event.command_name, deepcopy(dict(event.command))))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        pass
+
+
+def get_filter_and_sort(command_name: str, command: dict) -> tuple[dict, dict]:
+    match command_name:
+        case "find":
+            return command.get("filter", {}), command.get("sort", {})
+        case "count" | "distinct":
+            return command.get("query", {}), {}
+        case "update":
+            return command["updates"][0].get("q", {}), {}
+        case "delete":
+            return command["deletes"][0].get("q", {}), {}
+        case "findAndModify":
+            return command.get("query", {}), command.get("sort", {})
+        case "aggregate":
+            match_filter, sort = {}, {}
+            for stage in command.get("pipeline", []):
+                if "$match" in stage and not match_filter:
+                    match_filter = stage["$match"]
+                elif "$sort" in stage and not sort:
+                    sort = stage["$sort"]
+            return match_filter, sort
+    return {}, {}
+
+
+def shape(value: Any) -> Any:
+    # Replace values with their type, keeping field names and operators
+    if isinstance(value, dict):
+        if any(key.startswith("$") for key in value) and not {"$or", "$and", "$nor"} & value.keys():
+            return {key: ("<list>" if isinstance(item, list) else shape(item)) for key, item in value.items()}
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shape(item) for item in value]
+    return f"<{type(value).__name__}>"
+
+
+def get_shape_key(collection: str, command_name: str, command: dict) -> str:
+    query_filter, sort = get_filter_and_sort(command_name, command)
+    return json.dumps({
+        "collection": collection,
+        "command": command_name,
+        "filter": shape(query_filter),
+        "sort": dict(sort)
+    }, sort_keys=True)
+
+
+def to_explainable(command_name: str, command: dict) -> dict:
+    command = {key: value for key, value in command.items() if key not in SESSION_FIELDS}
+    if command_name == "update":
+        command["updates"] = command["updates"][:1]
+    elif command_name == "delete":
+        command["deletes"] = command["deletes"][:1]
+    elif command_name == "aggregate":
+        command["cursor"] = {}
+    return command
+
+
+def iter_plan_stages(plan: dict) -> Iterator[dict]:
+    yield plan
+    if "inputStage" in plan:
+        yield from iter_plan_stages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        yield from iter_plan_stages(stage)
+    if "queryPlan" in plan:  # slot-based execution engine
+        yield from iter_plan_stages(plan["queryPlan"])
+
+
+def iter_winning_plans(explain: Any) -> Iterator[dict]:
+    # The winning plan can be nested in aggregation stages or shards, so look everywhere
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan" and isinstance(value, dict):
+                yield value
+            else:
+                yield from iter_winning_plans(value)
+    elif isinstance(explain, list):
+        for item in explain:
+            yield from iter_winning_plans(item)
+
+
+def analyze_plan(collection: str, explain: dict) -> tuple[list[str], list[str]]:
+    # Returns (plan summary, problems)
+    summary, problems = [], []
+    for plan in iter_winning_plans(explain):
+        for stage in iter_plan_stages(plan):
+            name = stage.get("stage")
+            if not name:
+                continue
+            summary.append(f"{name}({stage['indexName']})" if stage.get("indexName") else name)
+            if name == "COLLSCAN" and collection not in SMALL_COLLECTIONS:
+                problems.append("COLLSCAN")
+            elif name == "SORT":
+                problems.append("in-memory SORT")
+
+    # Sorts that didn't get pushed down into the query show up as their own aggregation stage
+    for stage in explain.get("stages", []):
+        if "$sort" in stage:
+            summary.append("$sort")
+            problems.append("in-memory $sort stage")
+    return summary, problems
+
+
+def recommend_indexes(query_filter: dict, sort: dict) -> list[list[tuple[str, int]]]:
+    # Equality fields first, then sort fields, then range fields (one index per $or branch)
+    base = {key: value for key, value in query_filter.items() if key != "$or"}
+    branches = [{**base, **branch} for branch in query_filter["$or"]] if "$or" in query_filter else [base]
+    recommendations = []
+    for branch in branches:
+        equality, ranges = [], []
+        for field, value in branch.items():
+            if field.startswith("$"):
+                continue
+            if isinstance(value, dict) and any(key.startswith("$") for key in value):
+                (equality if set(value) <= EQUALITY_OPERATORS else ranges).append(field)
+            else:
+                equality.append(field)
+        keys = [(field, 1) for field in equality]
+        keys += [(field, direction) for field, direction in sort.items() if field not in equality]
+        keys += [(field, 1) for field in ranges if field not in sort and field not in equality]
+        if keys and keys not in recommendations:
+            recommendations.append(keys)
+    return recommendations
+
+
+async def capture_commands(args: argparse.Namespace) -> tuple[Any, CommandCapture]:
+    # Point the server modules at the benchmark databases before importing them
+    setup_environment(args.mongo_uri, args.mongo_db, args.redis_uri)
+    capture = CommandCapture()
+    monitoring.register(capture)
+
+    fixtures = seed(users=args.users, home_posts=args.home_posts, chats=args.chats, chat_posts=args.chat_posts)
+    from database import db
+    from cloudlink import CloudlinkServer
+    from supporter import Supporter
+    from search_index import home_index
+    from sessions import AccSession
+    from rest_api import app
+    import security
+
+    cl = CloudlinkServer()
+    supporter = Supporter(cl)
+    cl.supporter = supporter
+    app.cl = cl
+    app.supporter = supporter
+    home_index.build()
+
+    reacted_post = db.posts.find_one({"post_origin": "home", "reactions.0": {"$exists": True}})
+    report = db.reports.find_one({})
+    viewer, admin = fixtures["viewer_token"], fixtures["admin_token"]
+    routes = get_routes(fixtures) + [
+        ("GET /me", "/me", viewer),
+        ("GET /me/relationships", "/me/relationships", viewer),
+        ("GET /users/<username>", f"/users/{fixtures['profile_user']}", viewer),
+        ("GET /posts", f"/posts?id={reacted_post['_id']}", viewer),
+        ("GET /posts/<post_id>/reactions/<emoji>", f"/posts/{reacted_post['_id']}/reactions/{reacted_post['reactions'][0]['emoji']}", viewer),
+        ("GET /chats/<chat_id>", f"/chats/{fixtures['chat_id']}", viewer),
+        ("GET /search/users", "/search/users?q=bench1", viewer),
+        ("GET /search/users prefix", "/search/users?q=bench1&mode=prefix", viewer),
+        ("GET /admin/reports/<report_id>", f"/admin/reports/{report['_id']}", admin),
+        ("GET /admin/users/<username>", f"/admin/users/{fixtures['profile_user']}", admin),
+        ("GET /admin/users/<username>/posts", f"/admin/users/{fixtures['profile_user']}/posts", admin),
+        ("GET /admin/chats/<chat_id>", f"/admin/chats/{fixtures['chat_id']}", admin),
+        ("GET /admin/chats/<chat_id>/posts", f"/admin/chats/{fixtures['chat_id']}/posts", admin),
+        ("GET /admin/netinfo/<ip>", "/admin/netinfo/127.0.0.1", admin),
+        ("GET /statistics", "/statistics", viewer)
+    ]
+
+    client = app.test_client()
+    capture.enabled = True
+    for name, path, token in routes:
+        capture.source = name
+        resp = await client.get(path, headers={"token": token})
+        if resp.status_code != 200:
+            print(f"Warning: {name} returned {resp.status_code}")
+
+    # Queries that don't go through a route
+    capture.source = "Supporter.get_chats"
+    supporter.get_chats(fixtures["viewer"])
+    capture.source = "AccSession.get_all"
+    AccSession.get_all(fixtures["viewer"])
+    capture.source = "security.get_account"
+    security.get_account(fixtures["profile_user"])
+    capture.source = "background_tasks_loop"
+    cutoff = int(time.time()) - 86400*365*10  # matches nothing, so nothing actually gets deleted
+    list(db.usersv0.find({"delete_after": {"$lt": cutoff}}, projection={"_id": 1}))
+    db.acc_sessions.delete_many({"refreshed_at": {"$lt": cutoff}})
+    db.posts.delete_many({"deleted_at": {"$lt": cutoff}})
+    db.post_revisions.delete_many({"time": {"$lt": cutoff}})
+    capture.enabled = False
+
+    return db, capture
+
+
+def run(args: argparse.Namespace) -> list[dict]:
+    db, capture = asyncio.run(capture_commands(args))
+    known_shapes = set()
+    if os.path.exists(args.known):
+        with open(args.known) as f:
+            known_shapes = set(json.load(f))
+
+    # Explain one example of every shape
+    results: dict[str, dict] = {}
+    for source, command_name, command in capture.commands:
+        collection = command[command_name]
+        if not isinstance(collection, str):  # e.g. aggregate: 1
+            continue
+        key = get_shape_key(collection, command_name, command)
+        if key in results:
+            results[key]["sources"].add(source)
+            continue
+
+        result = {
+            "shape": key,
+            "collection": collection,
+            "command": command_name,
+            "sources": {source},
+            "new": key not in known_shapes,
+            "plan": [],
+            "problems": []
+        }
+        try:
+            explain = db.command("explain", to_explainable(command_name, command), verbosity="queryPlanner")
+        except Exception as e:
+            result["problems"].append(f"explain failed: {e}")
+        else:
+            result["plan"], result["problems"] = analyze_plan(collection, explain)
+
+        if result["problems"] or result["new"]:
+            query_filter, sort = get_filter_and_sort(command_name, command)
+            result["recommendations"] = recommend_indexes(query_filter, sort)
+        results[key] = result
+
+    for result in results.values():
+        result["sources"] = sorted(result["sources"])
+    return list(results.values())
+
+
+def print_results(results: list[dict]):
+    for result in sorted(results, key=lambda result: (not result["problems"], result["collection"])):
+        status = "FAIL" if result["problems"] else ("NEW" if result["new"] else "OK")
+        shape_desc = json.loads(result["shape"])
+        print(f"[{status}] {result['collection']}.{result['command']} filter={json.dumps(shape_desc['filter'])} sort={json.dumps(shape_desc['sort'])}")
+        print(f"    plan: {' > '.join(result['plan']) or 'unknown'}")
+        print(f"    from: {', '.join(result['sources'])}")
+        for problem in result["problems"]:
+            print(f"    problem: {problem}")
+        for keys in result.get("recommendations", []):
+            print(f"    recommended index: db.{result['collection']}.create_index({keys})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that every captured query shape uses an index.")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--home-posts", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--chat-posts", type=int, default=100)
+    parser.add_argument("--known", default=KNOWN_SHAPES_PATH, help="file of known query shapes")
+    parser.add_argument("--update-known", action="store_true", help="accept the captured shapes as known")
+    parser.add_argument("--fail-on-new", action="store_true", help="also fail on shapes that aren't known yet")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017"))
+    parser.add_argument("--mongo-db", default="meowerbench")
+    parser.add_argument("--redis-uri", default="redis://127.0.0.1:6379/15")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    # Fail before seeding if there are no known shapes to compare against
+    if not args.update_known and not os.path.exists(args.known):
+        print(f"No known shapes at {args.known}, run with --update-known to record them")
+        sys.exit(1)
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+    if args.update_known:
+        with open(args.known, "w") as f:
+            json.dump(sorted(result["shape"] for result in results), f, indent=2)
+        print(f"\nWrote {len(results)} known shapes to {args.known}")
+
+    failed = [result for result in results if result["problems"] or (args.fail_on_new and result["new"])]
+    print(f"\n{len(results)} query shapes, {sum(1 for result in results if result['problems'])} failing, {sum(1 for result in results if result['new'])} new")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+REST API hot-path benchmark with query-count regression gates.
+
+Seeds a synthetic dataset (see seed.py) into a throwaway local MongoDB, then calls the hottest REST routes through
+Quart's test client (no HTTP server in between) and records, per route:
+    throughput and p50/p99 latency
+    the exact number of MongoDB commands a request makes (counted with a pymongo command listener)
+
+Usage:
+    python benchmarks/rest_hot_paths.py --update-baseline   # record a baseline
+    python benchmarks/rest_hot_paths.py                     # compare against it
+
+A run fails (exit code 1) when a route makes more MongoDB commands than its baseline, or when its p99 latency grows
+by more than --latency-tolerance. Latency baselines are only meaningful on the machine they were recorded on, so
+use --skip-latency-gate when comparing across machines (query counts still get checked).
+A missing baseline, or a route missing from it, also fails the run, so the gate can't pass without checking anything.
+"""
+
+import argparse, asyncio, json, os, sys, time
+
+from pymongo import monitoring
+
+from seed import setup_environment, seed
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rest_hot_paths.baseline.json")
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+        self.commands: dict[str, int] = {}
+
+    def reset(self):
+        self.count = 0
+        self.commands = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        self.count += 1
+        self.commands[event.command_name] = self.commands.get(event.command_name, 0) + 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        pass
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def get_routes(fixtures: dict) -> list[tuple[str, str, str]]:
+    # (name, path, token)
+    return [
+        ("GET /home", "/home?page=1", fixtures["viewer_token"]),
+        ("GET /posts/<chat_id>", f"/posts/{fixtures['chat_id']}?page=1", fixtures["viewer_token"]),
+        ("GET /posts/<dm_chat_id>", f"/posts/{fixtures['dm_chat_id']}?page=1", fixtures["viewer_token"]),
+        ("GET /chats", "/chats", fixtures["viewer_token"]),
+        ("GET /inbox", "/inbox?page=1", fixtures["viewer_token"]),
+        ("GET /search/home", f"/search/home?q={fixtures['search_term']}&page=1", fixtures["viewer_token"]),
+        ("GET /users/<username>/posts", f"/users/{fixtures['profile_user']}/posts?page=1", fixtures["viewer_token"]),
+        ("GET /admin/reports", "/admin/reports?page=1", fixtures["admin_token"])
+    ]
+
+
+async def bench_route(client, counter: CommandCounter, path: str, token: str, args: argparse.Namespace) -> dict:
+    headers = {"token": token}
+
+    # Warm up caches (token lookups etc.), so counts reflect the steady state
+    for _ in range(args.warmup):
+        resp = await client.get(path, headers=headers)
+        if resp.status_code != 200:
+            raise RuntimeError(f"{path} returned {resp.status_code}: {await resp.get_data(as_text=True)}")
+
+    # Sequential requests, for latency and exact command counts
+    latencies = []
+    command_counts = []
+    commands: dict[str, int] = {}
+    started_at = time.perf_counter()
+    for _ in range(args.iterations):
+        counter.reset()
+        request_started_at = time.perf_counter()
+        resp = await client.get(path, headers=headers)
+        await resp.get_data()
+        latencies.append(time.perf_counter() - request_started_at)
+        command_counts.append(counter.count)
+        for name, count in counter.commands.items():
+            commands[name] = max(commands.get(name, 0), count)
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "requests_per_sec": round(args.iterations / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mongo_commands": max(command_counts),
+        "mongo_commands_by_name": commands
+    }
+
+
+def check_baseline(results: dict[str, dict], baseline: dict[str, dict], args: argparse.Namespace) -> list[str]:
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if not expected:
+            failures.append(f"{name} has no baseline, run with --update-baseline to record one")
+            continue
+        if result["mongo_commands"] > expected["mongo_commands"]:
+            failures.append(f"{name} made {result['mongo_commands']} MongoDB commands (baseline {expected['mongo_commands']})")
+        if not args.skip_latency_gate:
+            limit = expected["p99_ms"] * (1 + args.latency_tolerance)
+            if result["p99_ms"] > limit and result["p99_ms"] - expected["p99_ms"] > args.latency_slack_ms:
+                failures.append(f"{name} p99 latency is {result['p99_ms']}ms (baseline {expected['p99_ms']}ms, limit {round(limit, 3)}ms)")
+    return failures
+
+
+async def run(args: argparse.Namespace) -> dict[str, dict]:
+    # Point the server modules at the benchmark databases before importing them
+    setup_environment(args.mongo_uri, args.mongo_db, args.redis_uri)
+    counter = CommandCounter()
+    monitoring.register(counter)
+
+    fixtures = seed(users=args.users, home_posts=args.home_posts, chats=args.chats, chat_posts=args.chat_posts)
+    from cloudlink import CloudlinkServer
+    from supporter import Supporter
+    from search_index import home_index
+    from rest_api import app
+
+    cl = CloudlinkServer()
+    supporter = Supporter(cl)
+    cl.supporter = supporter
+    app.cl = cl
+    app.supporter = supporter
+    if not args.no_search_index:
+        home_index.build()
+
+    results = {}
+    client = app.test_client()
+    for name, path, token in get_routes(fixtures):
+        if args.routes and name not in args.routes:
+            continue
+        results[name] = await bench_route(client, counter, path, token, args)
+    return results
+
+
+def print_results(results: dict[str, dict]):
+    columns = ["requests_per_sec", "p50_ms", "p99_ms", "mongo_commands"]
+    print(f"{'route':>32}  " + "  ".join(f"{column:>16}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:>32}  " + "  ".join(f"{str(result[column]):>16}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark REST API hot paths and gate on query counts.")
+    parser.add_argument("--iterations", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per route")
+    parser.add_argument("--routes", nargs="+", help="only run these routes (e.g. \"GET /home\")")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--home-posts", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--chat-posts", type=int, default=100)
+    parser.add_argument("--no-search-index", action="store_true", help="use the $text fallback for /search/home")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--latency-tolerance", type=float, default=0.25, help="allowed p99 growth over the baseline (0.25 = 25%%)")
+    parser.add_argument("--latency-slack-ms", type=float, default=1.0, help="p99 growth below this is never a failure")
+    parser.add_argument("--skip-latency-gate", action="store_true")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017"))
+    parser.add_argument("--mongo-db", default="meowerbench")
+    parser.add_argument("--redis-uri", default="redis://127.0.0.1:6379/15")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    # Fail before seeding and benchmarking if there's nothing to compare against
+    baseline: dict = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.update_baseline:
+        print(f"No baseline at {args.baseline}, run with --update-baseline to record one")
+        sys.exit(1)
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        # Keep baselines of routes that weren't run (when using --routes)
+        baseline.update({name: {
+            "mongo_commands": result["mongo_commands"],
+            "p99_ms": result["p99_ms"]
+        } for name, result in results.items()})
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Wrote baseline to {args.baseline}")
+        return
+
+    failures = check_baseline(results, baseline, args)
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
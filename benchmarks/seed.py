@@ -0,0 +1,245 @@
+"""
+Synthetic dataset shared by the benchmarks.
+
+setup_environment() resets the benchmark MongoDB database and Redis database, then points the server modules at them,
+so it has to run before anything imports the database module. seed() then fills the database with users, home posts
+(with replies, reactions, custom emojis and stickers), group chats, DMs, inbox posts and reports.
+"""
+
+from typing import TypedDict
+from random import Random
+import os, secrets, string, sys, time
+
+import pymongo, redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = (
+    "meower cat kitten purr meow whisker paw tail fish yarn nap sunbeam box zoomies treat "
+    "hello world today tomorrow pizza music game art code server update post chat friend"
+).split()
+REACTION_EMOJIS = ["👍", "😂", "❤️", "🎉", "😮", "😢", "🔥", "👀"]
+
+
+class Fixtures(TypedDict):
+    viewer: str
+    viewer_token: str
+    admin: str
+    admin_token: str
+    profile_user: str
+    chat_id: str
+    dm_chat_id: str
+    search_term: str
+
+
+def setup_environment(mongo_uri: str, mongo_db: str, redis_uri: str, extra_env: dict[str, str] = {}):
+    pymongo.MongoClient(mongo_uri).drop_database(mongo_db)
+    redis.from_url(redis_uri).flushdb()
+
+    os.environ.update({
+        "MONGO_URI": mongo_uri,
+        "MONGO_DB": mongo_db,
+        "REDIS_URI": redis_uri,
+        "CAPTCHA_SECRET": "",
+        "EMAIL_SMTP_HOST": "",
+        "SENTRY_DSN": "",
+        **extra_env
+    })
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def file_id(rand: Random) -> str:
+    return "".join(rand.choices(string.ascii_letters + string.digits, k=24))
+
+
+def seed(
+    users: int = 500,
+    home_posts: int = 5000,
+    chats: int = 50,
+    chat_posts: int = 100,
+    reports: int = 200,
+    random_seed: int = 0
+) -> Fixtures:
+    # Imported here so setup_environment can run first
+    from database import db, build_indexes
+    import security
+    from sessions import AccSession
+
+    # Build indexes before inserting, the server builds them in the background instead
+    build_indexes()
+
+    rand = Random(random_seed)
+    now = int(time.time())
+    all_permissions = sum(
+        value for name, value in vars(security.AdminPermissions).items() if not name.startswith("_")
+    )
+
+    # Users (every user shares one password hash, bcrypt is way too slow to run per user)
+    password_hash = security.hash_password(secrets.token_hex(16))
+    usernames = [f"bench{i}" for i in range(users)]
+    db.usersv0.insert_many([{
+        "_id": username,
+        "lower_username": username,
+        "uuid": secrets.token_hex(16),
+        "created": now - rand.randint(0, 86400*365),
+        "pfp_data": rand.randint(1, 30),
+        "avatar": "",
+        "avatar_color": "000000",
+        "quote": " ".join(rand.choices(WORDS, k=5)),
+        "email": "",
+        "normalized_email_hash": "",
+        "pswd": password_hash,
+        "mfa_recovery_code": secrets.token_hex(5),
+        "flags": 0,
+        "permissions": (all_permissions if i == 0 else 0),
+        "ban": {"state": "none", "restrictions": 0, "expires": 0, "reason": ""},
+        "last_seen": now - rand.randint(0, 86400*30),
+        "delete_after": None
+    } for i, username in enumerate(usernames)])
+
+    # Group chats with custom emojis and stickers
+    chat_docs = []
+    for i in range(chats):
+        owner = usernames[(i * 7) % users]
+        members = list({owner, usernames[1], *rand.sample(usernames, min(10, users))})
+        chat_docs.append({
+            "_id": secrets.token_hex(16),
+            "type": 0,
+            "nickname": f"Bench chat {i}",
+            "icon": "",
+            "icon_color": "000000",
+            "owner": owner,
+            "members": members,
+            "created": now - 86400*60,
+            "last_active": now - rand.randint(0, 86400*30),
+            "deleted": False,
+            "allow_pinning": False
+        })
+    db.chats.insert_many(chat_docs)
+    emojis = [{
+        "_id": file_id(rand),
+        "chat_id": chat_docs[0]["_id"],
+        "name": f"emoji{i}",
+        "animated": False,
+        "created_at": now,
+        "created_by": chat_docs[0]["owner"]
+    } for i in range(20)]
+    stickers = [{
+        "_id": file_id(rand),
+        "chat_id": chat_docs[0]["_id"],
+        "name": f"sticker{i}",
+        "animated": False,
+        "created_at": now,
+        "created_by": chat_docs[0]["owner"]
+    } for i in range(10)]
+    db.chat_emojis.insert_many(emojis)
+    db.chat_stickers.insert_many(stickers)
+
+    # DMs (every user has one with the next user)
+    dm_docs = [{
+        "_id": secrets.token_hex(16),
+        "type": 1,
+        "nickname": None,
+        "owner": None,
+        "members": [usernames[i], usernames[(i + 1) % users]],
+        "created": now - 86400*60,
+        "last_active": now - rand.randint(0, 86400*30),
+        "deleted": False
+    } for i in range(users)]
+    db.chats.insert_many(dm_docs)
+    db.user_settings.insert_many([{
+        "_id": username,
+        "active_dms": [dm_docs[i]["_id"], dm_docs[i-1]["_id"]],
+        "favorited_chats": [chat["_id"] for chat in chat_docs if username in chat["members"]][:5]
+    } for i, username in enumerate(usernames)])
+
+    # Posts
+    def make_post(origin: str, author: str, timestamp: int, reply_pool: list[str]) -> dict:
+        post_emojis = rand.sample(emojis, 2) if rand.random() < 0.1 else []
+        content = " ".join(rand.choices(WORDS, k=rand.randint(3, 30)))
+        content += "".join(f" <:{emoji['_id']}>" for emoji in post_emojis)
+        return {
+            "_id": secrets.token_hex(16),
+            "post_origin": origin,
+            "u": author,
+            "t": {"e": timestamp},
+            "p": content,
+            "attachments": [],
+            "isDeleted": False,
+            "pinned": False,
+            "reply_to": rand.sample(reply_pool, 1) if reply_pool and rand.random() < 0.2 else [],
+            "reactions": [],
+            "emojis": [emoji["_id"] for emoji in post_emojis],
+            "stickers": [sticker["_id"] for sticker in rand.sample(stickers, 1)] if rand.random() < 0.05 else []
+        }
+
+    posts = []
+    home_ids: list[str] = []
+    for i in range(home_posts):
+        post = make_post("home", rand.choice(usernames), now - ((home_posts - i) * 60), home_ids[-500:])
+        posts.append(post)
+        home_ids.append(post["_id"])
+    for chat in chat_docs + dm_docs[:chats]:
+        chat_ids: list[str] = []
+        for i in range(chat_posts):
+            post = make_post(chat["_id"], rand.choice(chat["members"]), now - ((chat_posts - i) * 300), chat_ids[-50:])
+            posts.append(post)
+            chat_ids.append(post["_id"])
+    for i in range(100):
+        posts.append(make_post("inbox", ("Server" if i % 2 else rand.choice(usernames[:10])), now - (i * 3600), []))
+
+    # Reactions
+    reactions = []
+    for post in posts:
+        if post["post_origin"] == "inbox" or rand.random() > 0.3:
+            continue
+        for emoji in rand.sample(REACTION_EMOJIS, rand.randint(1, 3)):
+            reactors = rand.sample(usernames, rand.randint(1, min(5, users)))
+            post["reactions"].append({"emoji": emoji, "count": len(reactors)})
+            reactions.extend({
+                "_id": {"post_id": post["_id"], "emoji": emoji, "user": reactor},
+                "time": post["t"]["e"]
+            } for reactor in reactors)
+    db.posts.insert_many(posts)
+    if reactions:
+        db.post_reactions.insert_many(reactions)
+
+    # Reports
+    db.reports.insert_many([{
+        "_id": secrets.token_hex(16),
+        "type": "post",
+        "content_id": post_id,
+        "status": "pending",
+        "escalated": False,
+        "reports": [{
+            "user": rand.choice(usernames),
+            "ip": f"10.0.{i // 256}.{i % 256}",
+            "reason": "Spam",
+            "comment": "",
+            "time": now - i
+        }]
+    } for i, post_id in enumerate(rand.sample(home_ids, min(reports, len(home_ids))))])
+
+    # Sessions
+    def create_session(username: str) -> str:
+        session = {
+            "_id": secrets.token_hex(16),
+            "user": username,
+            "ip": "127.0.0.1",
+            "user_agent": None,
+            "created_at": now,
+            "refreshed_at": now
+        }
+        db.acc_sessions.insert_one(session)
+        return AccSession(session).token
+
+    return {
+        "viewer": usernames[1],
+        "viewer_token": create_session(usernames[1]),
+        "admin": usernames[0],
+        "admin_token": create_session(usernames[0]),
+        "profile_user": usernames[2],
+        "chat_id": next(chat["_id"] for chat in chat_docs if usernames[1] in chat["members"]),
+        "dm_chat_id": dm_docs[1]["_id"],
+        "search_term": "kitten"
+    }
@@ -1,12 +1,64 @@
-import websockets, asyncio, json, time, requests, os
-from typing import Optional, Iterable, TypedDict, Literal, Any
+import websockets, asyncio, json, time, requests, os, threading, msgpack, zlib
+from typing import Optional, Iterable, TypedDict, Literal, Any, Callable, Awaitable
+from collections import deque
+from http import HTTPStatus
 from inspect import getfullargspec
+from functools import partial
 from urllib.parse import urlparse, parse_qs
 
 from utils import log, full_stack
+from write_behind import write_behind
+from loop_monitor import cl_monitor
+from metrics import query_stats, cl_connections, cl_packets, cl_fanout_clients, cl_fanout_duration, cl_handshake_rejections, ratelimit_rejections
+import netblocks
+import errors
 
 VERSION = "0.1.7.10"
 
+# Header containing the real client IP (when behind a reverse proxy)
+REAL_IP_HEADER = os.getenv("REAL_IP_HEADER")
+
+# Pooled connections for proxied API requests
+api_session = requests.Session()
+
+# Outbound send queue limits (in frames)
+SEND_QUEUE_HIGH_WATER = int(os.getenv("CL3_SEND_QUEUE_HIGH", 256))
+SEND_QUEUE_LOW_WATER = int(os.getenv("CL3_SEND_QUEUE_LOW", 64))
+SEND_QUEUE_LIMIT = int(os.getenv("CL3_SEND_QUEUE_LIMIT", 1024))
+SEND_QUEUE_EVICT_AFTER = int(os.getenv("CL3_SEND_QUEUE_EVICT_AFTER", 30))  # seconds
+
+# Per-IP handshake rate limit (token bucket), off by default as schools and other shared IPs reconnect en masse after a restart
+CONN_RATE_BURST = int(os.getenv("CL3_CONN_RATE_BURST", 0))  # connections allowed at once, 0 disables the limit
+CONN_RATE_REFILL = float(os.getenv("CL3_CONN_RATE_REFILL", 0.5))  # connections regained per second
+
+# Frames that get shed first when a client is lagging
+LOW_PRIORITY_CMDS = {"typing", "ulist"}
+
+# Wire formats (selected by the v and deflate query params)
+WIRE_V0_JSON = 0
+WIRE_V1_JSON = 1
+WIRE_V2_MSGPACK = 2
+WIRE_V2_MSGPACK_DEFLATE = 3
+WIRE_FORMAT_NAMES = {  # metric labels (the v param is client-supplied, so it can't be used as a label)
+    WIRE_V0_JSON: "v0_json",
+    WIRE_V1_JSON: "v1_json",
+    WIRE_V2_MSGPACK: "v2_msgpack",
+    WIRE_V2_MSGPACK_DEFLATE: "v2_msgpack_deflate"
+}
+
+# Preset dictionary for deflated v2 frames, made from the most common keys and values.
+# It gets sent to deflate clients as the first (uncompressed) frame.
+V2_ZDICT = msgpack.packb([
+    "I:100 | OK", "E:106 | Too many requests", "statuscode", "listener", "ulist",
+    "update_config", "update_profile", "update_relationship",
+    "create_chat", "update_chat", "delete_chat", "nickname", "owner", "members", "last_active",
+    "post_reaction_add", "post_reaction_remove", "emoji", "count", "user_reacted",
+    "inbox_message", "update_post", "delete_post", "chat_id", "post_id", "username",
+    "author", "uuid", "flags", "pfp_data", "avatar", "avatar_color",
+    "attachments", "isDeleted", "pinned", "reply_to", "reactions", "emojis", "stickers", "nonce",
+    "typing", "post", "post_origin", "home", "type", "_id", "u", "t", "e", "p", "cmd", "val"
+])
+
 class CloudlinkPacket(TypedDict):
     cmd: str
     val: any
@@ -15,6 +67,123 @@ class CloudlinkPacket(TypedDict):
     origin: Optional[str]
     listener: Optional[str]
 
+def get_remote_ip(request_headers, remote_address) -> str:
+    if REAL_IP_HEADER and REAL_IP_HEADER in request_headers:
+        return request_headers[REAL_IP_HEADER]
+    elif type(remote_address) == tuple:
+        return remote_address[0]
+    else:
+        return remote_address
+
+class ConnectionRateLimiter:
+    __slots__ = ("burst", "refill", "buckets", "last_prune")
+
+    def __init__(self, burst: int, refill: float):
+        self.burst = burst
+        self.refill = refill
+        self.buckets: dict[str, list[float]] = {}  # {"ip": [tokens, last_updated]}
+        self.last_prune = time.monotonic()
+
+    def allow(self, ip: str) -> bool:
+        now = time.monotonic()
+        self.prune(now)
+
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            self.buckets[ip] = [self.burst - 1, now]
+            return True
+
+        # Refill bucket
+        bucket[0] = min(self.burst, bucket[0] + ((now - bucket[1]) * self.refill))
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now: float):
+        # Forget IPs that would have a full bucket again
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        full_after = self.burst / self.refill
+        for ip, (_, last_updated) in list(self.buckets.items()):
+            if now - last_updated >= full_after:
+                del self.buckets[ip]
+
+class CloudlinkServerProtocol(websockets.WebSocketServerProtocol):
+    def __init__(self, *args, cl_server: "CloudlinkServer", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cl_server = cl_server
+        self.app_deflate = False
+
+    async def process_request(self, path: str, request_headers):
+        # v2 clients using deflate=1 already get deflated frames, so they don't need permessage-deflate on top
+        req_params = parse_qs(urlparse(path).query)
+        self.app_deflate = req_params.get("v") == ["2"] and req_params.get("deflate") == ["1"]
+
+        # Reject blocked and flooding IPs before the upgrade
+        ip = get_remote_ip(request_headers, self.remote_address)
+        try:
+            blocked = netblocks.is_blocked(ip)
+        except errors.NetblocksNotLoaded:
+            cl_handshake_rejections.labels("netblocks_not_loaded").inc()
+            return HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", str(netblocks.LOAD_RETRY_MIN))], b"Starting up\n"
+        if blocked:
+            self.cl_server.rejected_blocked += 1
+            cl_handshake_rejections.labels("blocked").inc()
+            return HTTPStatus.FORBIDDEN, [], b"IP blocked\n"
+        if CONN_RATE_BURST and not self.cl_server.conn_limiter.allow(ip):
+            self.cl_server.rejected_ratelimited += 1
+            cl_handshake_rejections.labels("ratelimited").inc()
+            ratelimit_rejections.labels("cl_handshake").inc()
+            return HTTPStatus.TOO_MANY_REQUESTS, [("Retry-After", str(int(1 / CONN_RATE_REFILL) or 1))], b"Too many connections\n"
+
+        return await super().process_request(path, request_headers)
+
+    def process_extensions(self, headers, available_extensions):
+        # Runs after process_request, don't negotiate any extensions for app-level deflate clients
+        if self.app_deflate:
+            available_extensions = None
+        return super().process_extensions(headers, available_extensions)
+
+class CloudlinkCommand:
+    __slots__ = ("name", "func", "pass_id", "pass_name", "calls", "errors", "total_time", "max_time", "packets")
+
+    def __init__(self, name: str, func: Callable[..., Awaitable]):
+        self.name = name
+        self.func = func
+
+        # Extra args mainly used for pmsg, gvar, and pvar
+        args = getfullargspec(func).args
+        self.pass_id = "id" in args
+        self.pass_name = "name" in args
+
+        # Latency counters
+        self.calls: int = 0
+        self.errors: int = 0
+        self.total_time: float = 0.0
+        self.max_time: float = 0.0
+        self.packets = cl_packets.labels(name)
+
+    def record(self, duration: float, error: bool = False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round((self.total_time/self.calls)*1000, 3) if self.calls else 0,
+            "max_ms": round(self.max_time*1000, 3)
+        }
+
 class CloudlinkServer:
     def __init__(self):
         self.statuscodes: dict[str, str] = {
@@ -41,11 +210,11 @@ class CloudlinkServer:
             "Blocked": "E:119 | IP Blocked",
             #"IPRequred": "E:120 | IP Address required",  -- deprecated
             #"TooManyUserNameChanges": "E:121 | Too Many Username Changes",  -- deprecated
-            #"Disabled": "E:122 | Command disabled by sysadmin",  -- deprecated
+            "Disabled": "E:122 | Command disabled by sysadmin",
             "PasswordInvalid": "I:011 | Invalid Password",
             "IDExists": "I:015 | Account exists",
             "2FARequired": "I:016 | 2FA Required",
-            #"MissingPermissions": "I:017 | Missing permissions",  -- deprecated
+            "MissingPermissions": "I:017 | Missing permissions",
             "Banned": "E:018 | Account Banned",
             #"IllegalChars": "E:019 | Illegal characters detected",  -- deprecated
             #"Kicked": "E:020 | Kicked",  -- deprecated
@@ -54,24 +223,56 @@ class CloudlinkServer:
             "Deleted": "E:025 | Deleted",
             "AccountLocked": "E:026 | Account Locked"
         }
-        self.commands: dict[str, function] = {
+        self.commands: dict[str, CloudlinkCommand] = {}
+        for name, func in {
             # Core commands
             "ping": CloudlinkCommands.ping,
             "get_ulist": CloudlinkCommands.get_ulist,
 
             # Authentication
             "authpswd": CloudlinkCommands.authpswd,
-            "gen_account": CloudlinkCommands.gen_account
-        }
+            "gen_account": CloudlinkCommands.gen_account,
+
+            # Posting
+            "create_post": CloudlinkCommands.create_post,
+            "typing": CloudlinkCommands.typing,
+            "add_reaction": CloudlinkCommands.add_reaction,
+            "remove_reaction": CloudlinkCommands.remove_reaction
+        }.items():
+            self.register_command(name, func)
         self.clients: set[CloudlinkClient] = set()
         self.usernames: dict[str, list[CloudlinkClient]] = {}  # {"username": [cl_client1, cl_client2, ...]}
+        self.chats: dict[str, set[CloudlinkClient]] = {}  # {"chat_id": {cl_client1, cl_client2, ...}}
+
+        # Handshake admission control
+        self.conn_limiter = ConnectionRateLimiter(CONN_RATE_BURST, CONN_RATE_REFILL)
+        self.rejected_blocked: int = 0
+        self.rejected_ratelimited: int = 0
+
+        # Event loop the server is running on (set in run)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
     
+    def register_command(self, name: str, func: Callable[..., Awaitable]):
+        self.commands[name] = CloudlinkCommand(name, func)
+
+    def get_command_stats(self) -> dict[str, dict[str, Any]]:
+        return {name: command.stats for name, command in self.commands.items()}
+
     async def client_handler(self, websocket: websockets.WebSocketServerProtocol):
         # Create CloudlinkClient
         cl_client = CloudlinkClient(self, websocket)
 
         # Add to websockets and clients sets
         self.clients.add(cl_client)
+        cl_connections.labels(WIRE_FORMAT_NAMES[cl_client.wire_format]).inc()
+
+        # Start send queue writer
+        writer_task = asyncio.create_task(cl_client.send_queue_writer())
+
+        # Send preset dictionary to deflate clients
+        if cl_client.wire_format == WIRE_V2_MSGPACK_DEFLATE:
+            cl_client.enqueue("zdict", msgpack.packb({"cmd": "zdict", "val": V2_ZDICT}))
 
         # Send ulist
         cl_client.send("ulist", self.get_ulist())
@@ -85,9 +286,12 @@ class CloudlinkServer:
         # Process incoming packets until WebSocket closes
         try:
             async for packet in websocket:
-                # Parse packet
+                # Parse packet (binary frames are msgpack)
                 try:
-                    packet: CloudlinkPacket = json.loads(packet)
+                    if isinstance(packet, bytes):
+                        packet: CloudlinkPacket = msgpack.unpackb(packet)
+                    else:
+                        packet: CloudlinkPacket = json.loads(packet)
                 except:
                     cl_client.send_statuscode("Syntax")
                     continue
@@ -122,28 +326,38 @@ class CloudlinkServer:
                         cl_client.send_statuscode("Syntax", packet.get("listener"))
                         continue
 
-                # Get command function
-                cmd_func = self.commands.get(packet["cmd"])
-                if not cmd_func:
+                # Get command
+                command = self.commands.get(packet["cmd"])
+                if not command:
+                    cl_packets.labels("invalid").inc()
                     cl_client.send_statuscode("Invalid", packet.get("listener"))
                     continue
+                command.packets.inc()
 
                 # Execute command
+                extra_args = {}
+                if command.pass_id:
+                    extra_args["id"] = packet.get("id")
+                if command.pass_name:
+                    extra_args["name"] = packet.get("name")
+                started_at = time.perf_counter()
+                tally_token = query_stats.start(f"cl:{packet['cmd']}")
                 try:
-                    # Extra args mainly used for pmsg, gvar, and pvar
-                    extra_args = {}
-                    if "id" in getfullargspec(cmd_func).args:
-                        extra_args["id"] = packet.get("id")
-                    if "name" in getfullargspec(cmd_func).args:
-                        extra_args["name"] = packet.get("name")
-                    
-                    await cmd_func(cl_client, packet["val"], packet.get("listener"), **extra_args)
+                    await command.func(cl_client, packet["val"], packet.get("listener"), **extra_args)
                 except:
+                    command.record(time.perf_counter()-started_at, error=True)
                     print(full_stack())
                     cl_client.send_statuscode("InternalServerError", packet.get("listener"))
+                else:
+                    command.record(time.perf_counter()-started_at)
+                finally:
+                    query_stats.finish(tally_token)
         except: pass
         finally:
+            writer_task.cancel()
+            cl_client.send_queue.clear()
             self.clients.remove(cl_client)
+            cl_connections.labels(WIRE_FORMAT_NAMES[cl_client.wire_format]).dec()
             cl_client.logout()
 
     def send_event(
@@ -152,55 +366,173 @@ class CloudlinkServer:
         val: Any,
         extra: Optional[dict] = None,
         clients: Optional[Iterable] = None,
-        usernames: Optional[Iterable] = None
+        usernames: Optional[Iterable] = None,
+        chat_id: Optional[str] = None
     ):
         if extra is None:
             extra = {}
 
+        # Parse post
+        if cmd == "post" or cmd == "update_post":
+            val = self.supporter.parse_posts_v0([val])[0]
+
+        # Queue the packet on the event loop (send_event gets called from REST API threads)
+        self.call_soon(self.fan_out, cmd, val, extra, clients, usernames, chat_id)
+
+    def fan_out(
+        self,
+        cmd: str,
+        val: Any,
+        extra: dict,
+        clients: Optional[Iterable] = None,
+        usernames: Optional[Iterable] = None,
+        chat_id: Optional[str] = None
+    ):
+        started_at = time.perf_counter()
+
+        # Keep chat index up to date with membership events
+        if cmd in {"create_chat", "update_chat", "delete_chat"}:
+            self.update_chat_index(cmd, val, usernames)
+
         # Get clients
-        if clients is None and usernames is None:
+        if chat_id is not None:
+            clients = self.chats.get(chat_id, ())
+        elif clients is None and usernames is None:
             clients = self.clients
         else:
-            clients = [] if clients is None else clients
+            clients = set() if clients is None else set(clients)
             if usernames is not None:
                 for username in usernames:
-                    clients += self.usernames.get(username, [])
-
-        # Parse post
-        if cmd == "post" or cmd == "update_post":
-            val = self.supporter.parse_posts_v0([val])[0]
+                    clients.update(self.usernames.get(username, ()))
+
+        # Serialize the packet once per wire format
+        frames: dict[int, str|bytes] = {}
+        sent = 0
+        for client in clients:
+            frame = frames.get(client.wire_format)
+            if frame is None:
+                frame = frames[client.wire_format] = self.encode_packet(client.wire_format, cmd, val, extra)
+            client.enqueue(cmd, frame)
+            sent += 1
+
+        cl_fanout_clients.labels(cmd).observe(sent)
+        cl_fanout_duration.labels(cmd).observe(time.perf_counter()-started_at)
+
+    def encode_packet(self, wire_format: int, cmd: str, val: Any, extra: dict) -> str|bytes:
+        if wire_format == WIRE_V0_JSON:
+            return json.dumps(self.v0_packet(cmd, val, extra))
+
+        packet = {"cmd": cmd, "val": val, **extra}
+        if wire_format == WIRE_V1_JSON:
+            return json.dumps(packet)
+
+        frame = msgpack.packb(packet)
+        if wire_format == WIRE_V2_MSGPACK_DEFLATE:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=V2_ZDICT)
+            frame = compressor.compress(frame) + compressor.flush()
+        return frame
+
+    def v0_packet(self, cmd: str, val: Any, extra: dict) -> dict:
+        if cmd in ["statuscode", "ulist", "pmsg", "pvar"]:  # root commands
+            return {"cmd": cmd, "val": val, **extra}
 
-        # Send v1 packet
-        websockets.broadcast({
-            client.websocket for client in clients
-            if client.proto_version == 1
-        }, json.dumps({"cmd": cmd, "val": val, **extra}))
+        if cmd == "post":
+            if val.get("post_origin") == "home":
+                val = {"mode": 1, **val}
+            else:
+                val = {"state": 2, **val}
+        elif cmd == "typing":
+            if val.get("chat_id") == "home":
+                val = {"state": 101, "chatid": "livechat", "u": val.get("username")}
+            else:
+                val = {"state": 100, "chatid": val.get("chat_id"), "u": val.get("username")}
+        elif cmd == "delete_chat":
+            val = {"mode": "delete", "id": val.get("chat_id")}
+        elif cmd == "delete_post":
+            val = {"mode": "delete", "id": val.get("post_id")}
+        else:
+            val = {"mode": cmd, "payload": val}
+        return {"cmd": "direct", "val": val, **extra}
 
-        # Send v0 packet
-        if cmd in ["statuscode", "ulist", "pmsg", "pvar"]:  # root commands
-            val = {"cmd": cmd, "val": val, **extra}
+    def call_soon(self, callback, *args):
+        if self.loop is None or threading.get_ident() == self.loop_thread_id:
+            callback(*args)
         else:
-            if cmd == "post":
-                if val.get("post_origin") == "home":
-                    val = {"mode": 1, **val}
-                else:
-                    val = {"state": 2, **val}
-            elif cmd == "typing":
-                if val.get("chat_id") == "home":
-                    val = {"state": 101, "chatid": "livechat", "u": val.get("username")}
-                else:
-                    val = {"state": 100, "chatid": val.get("chat_id"), "u": val.get("username")}
-            elif cmd == "delete_chat":
-                val = {"mode": "delete", "id": val.get("chat_id")}
-            elif cmd == "delete_post":
-                val = {"mode": "delete", "id": val.get("post_id")}
-            else:
-                val = {"mode": cmd, "payload": val}
-            val = {"cmd": "direct", "val": val, **extra}
-        websockets.broadcast({
-            client.websocket for client in clients
-            if client.proto_version == 0
-        }, json.dumps(val))
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def kick_blocked_clients(self):
+        if not netblocks.loaded.is_set():  # nobody can be connected yet
+            return
+        for client in list(self.clients):
+            if netblocks.is_blocked(client.ip):
+                asyncio.create_task(client.kick())
+
+    def get_send_queue_stats(self, limit: int = 50) -> dict[str, Any]:
+        now = time.monotonic()
+        clients = list(self.clients)
+        lagging = sorted(
+            (client for client in clients if client.lagging_since is not None),
+            key=lambda client: len(client.send_queue),
+            reverse=True
+        )
+        return {
+            "clients": len(clients),
+            "queued_frames": sum(len(client.send_queue) for client in clients),
+            "dropped_frames": sum(client.dropped_frames for client in clients),
+            "high_water": SEND_QUEUE_HIGH_WATER,
+            "low_water": SEND_QUEUE_LOW_WATER,
+            "limit": SEND_QUEUE_LIMIT,
+            "lagging": [{
+                "username": client.username,
+                "ip": client.ip,
+                "proto_version": client.proto_version,
+                "queued_frames": len(client.send_queue),
+                "dropped_frames": client.dropped_frames,
+                "lagging_for": round(now-client.lagging_since, 3)
+            } for client in lagging[:limit]]
+        }
+
+    def join_chat(self, client: "CloudlinkClient", chat_id: str):
+        self.chats.setdefault(chat_id, set()).add(client)
+        client.chat_ids.add(chat_id)
+
+    def leave_chat(self, client: "CloudlinkClient", chat_id: str):
+        clients = self.chats.get(chat_id)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.chats[chat_id]
+        client.chat_ids.discard(chat_id)
+
+    def add_chat_members(self, chat_id: str, usernames: Iterable[str]):
+        for username in usernames:
+            for client in self.usernames.get(username, ()):
+                self.join_chat(client, chat_id)
+
+    def remove_chat_members(self, chat_id: str, usernames: Iterable[str]):
+        for username in usernames:
+            for client in self.usernames.get(username, ()):
+                self.leave_chat(client, chat_id)
+
+    def set_chat_members(self, chat_id: str, usernames: Iterable[str]):
+        usernames = set(usernames)
+        for client in list(self.chats.get(chat_id, ())):
+            if client.username not in usernames:
+                self.leave_chat(client, chat_id)
+        self.add_chat_members(chat_id, usernames)
+
+    def update_chat_index(self, cmd: str, val: dict, usernames: Optional[Iterable[str]]):
+        # The chat index must only be touched from the event loop
+        match cmd:
+            case "create_chat":
+                if usernames is not None:
+                    self.add_chat_members(val["_id"], usernames)
+            case "update_chat":
+                if "members" in val:
+                    self.set_chat_members(val["_id"], val["members"])
+            case "delete_chat":
+                if usernames is not None:
+                    self.remove_chat_members(val["chat_id"], usernames)
 
     def get_ulist(self):
         ulist = ";".join(self.usernames.keys())
@@ -212,12 +544,27 @@ class CloudlinkServer:
         return self.send_event("ulist", self.get_ulist())
 
     async def run(self, host: str = "0.0.0.0", port: int = 3000):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        cl_monitor.start()
         self.stop = asyncio.Future()
-        self.server = await websockets.serve(self.client_handler, host, port)
+        self.server = await websockets.serve(
+            self.client_handler,
+            host,
+            port,
+            create_protocol=partial(CloudlinkServerProtocol, cl_server=self),
+            compression=("deflate" if os.getenv("CL3_PERMESSAGE_DEFLATE", "1") == "1" else None)
+        )
         await self.stop
         await self.server.close()
 
 class CloudlinkClient:
+    __slots__ = (
+        "server", "websocket", "req_params", "ip", "user_agent",
+        "acc_session_id", "username", "flags", "chat_ids", "proto_version", "wire_format", "trusted",
+        "send_queue", "send_queue_ready", "lagging_since", "dropped_frames", "ulist_stale", "evicted"
+    )
+
     def __init__(
         self,
         server: CloudlinkServer,
@@ -227,15 +574,39 @@ class CloudlinkClient:
         self.server = server
         self.websocket = websocket
 
-        # Set account session ID, username, protocol version, IP, and trusted status
+        # Parse handshake details once
+        self.req_params: dict[str, list[str]] = parse_qs(urlparse(websocket.path).query)
+        self.ip: str = get_remote_ip(websocket.request_headers, websocket.remote_address)
+        self.user_agent: Optional[str] = websocket.request_headers.get("User-Agent")
+
+        # Set account session ID, username, flags, protocol version, and trusted status
         self.acc_session_id: Optional[str] = None
         self.username: Optional[str] = None
+        self.flags: int = 0
+        self.chat_ids: set[str] = set()
         try:
             self.proto_version: int = int(self.req_params.get("v")[0])
         except:
             self.proto_version: int = 0
+        if self.proto_version == 0:
+            self.wire_format: int = WIRE_V0_JSON
+        elif self.proto_version == 2:
+            if self.req_params.get("deflate") == ["1"]:
+                self.wire_format: int = WIRE_V2_MSGPACK_DEFLATE
+            else:
+                self.wire_format: int = WIRE_V2_MSGPACK
+        else:
+            self.wire_format: int = WIRE_V1_JSON
         self.trusted: bool = False
 
+        # Outbound send queue
+        self.send_queue: deque[tuple[str, str|bytes]] = deque()
+        self.send_queue_ready = asyncio.Event()
+        self.lagging_since: Optional[float] = None
+        self.dropped_frames: int = 0
+        self.ulist_stale: bool = False
+        self.evicted: bool = False
+
         # Automatic login
         if "token" in self.req_params:
             token = self.req_params.get("token")[0]
@@ -244,19 +615,6 @@ class CloudlinkClient:
                 del account["error"]
                 self.authenticate(account, token)
 
-    @property
-    def req_params(self):
-        return parse_qs(urlparse(self.websocket.path).query)
-
-    @property
-    def ip(self):
-        if "REAL_IP_HEADER" in os.environ and os.environ["REAL_IP_HEADER"] in self.websocket.request_headers:
-            return self.websocket.request_headers[os.environ["REAL_IP_HEADER"]]
-        elif type(self.websocket.remote_address) == tuple:
-            return self.websocket.remote_address[0]
-        else:
-            return self.websocket.remote_address
-
     def authenticate(self, acc_session: dict[str, Any], token: str, account: dict[str, Any], listener: Optional[str] = None):
         if self.username:
             self.logout()
@@ -269,12 +627,17 @@ class CloudlinkClient:
         # Authenticate
         self.acc_session_id = acc_session["_id"]
         self.username = account["_id"]
+        self.flags = account["flags"]
         if self.username in self.server.usernames:
             self.server.usernames[self.username].append(self)
         else:
             self.server.usernames[self.username] = [self]
             self.server.send_ulist()
 
+        # Add to chat index
+        for chat_id in self.server.supporter.get_chat_ids(self.username):
+            self.server.join_chat(self, chat_id)
+
         # Send auth payload
         self.send("auth", {
             "username": self.username,
@@ -291,8 +654,11 @@ class CloudlinkClient:
         if not self.username:
             return
 
-        # Trigger last_seen update
-        self.proxy_api_request("/me", "get")
+        # Update last_seen
+        write_behind.touch_last_seen(self.username)
+
+        for chat_id in list(self.chat_ids):
+            self.server.leave_chat(self, chat_id)
 
         self.server.usernames[self.username].remove(self)
         if len(self.server.usernames[self.username]) == 0:
@@ -303,21 +669,22 @@ class CloudlinkClient:
     def proxy_api_request(
         self, endpoint: str,
         method: Literal["get", "post", "patch", "delete"],
-        headers: dict[str, str] = {},
+        headers: Optional[dict[str, str]] = None,
         json: Optional[dict[str, Any]] = None,
         listener: Optional[str] = None,
     ):
         # Set headers
-        headers.update({
+        headers = {
+            **(headers or {}),
             "X-Internal-Token": os.environ["INTERNAL_API_TOKEN"],
             "X-Internal-Ip": self.ip,
-            "X-Internal-UA": self.websocket.request_headers.get("User-Agent"),
-        })
+            "X-Internal-UA": self.user_agent,
+        }
         if self.username:
             headers["X-Internal-Username"] = self.username
 
         # Make request
-        resp = getattr(requests, method)(
+        resp = getattr(api_session, method)(
             f"{os.environ['INTERNAL_API_ENDPOINT']}{endpoint}",
             headers=headers,
             json=json,
@@ -325,28 +692,37 @@ class CloudlinkClient:
         if not resp["error"]:
             return resp
         else:
-            match resp["type"]:
-                case "ipBlocked"|"registrationBlocked":
-                    self.send_statuscode("Blocked", listener)
-                case "badRequest":
-                    self.send_statuscode("Syntax", listener)
-                case "usernameExists":
-                    self.send_statuscode("IDExists", listener)
-                case "Unauthorized":
-                    self.send_statuscode("PasswordInvalid", listener)
-                case "mfaRequired":
-                    self.send_statuscode("2FARequired", listener)
-                case "accountDeleted":
-                    self.send_statuscode("Deleted", listener)
-                case "accountLocked":
-                    self.send_statuscode("AccountLocked", listener)
-                case "accountBanned":
-                    self.send_statuscode("Banned", listener)
-                case "tooManyRequests":
-                    self.send_statuscode("RateLimit", listener)
-                case _:
-                    log(f"Unknown error type received from '{endpoint}' API endpoint: {resp['type']}")
-                    self.send_statuscode("InternalServerError", listener)
+            self.send_api_error(resp["type"], listener, endpoint=endpoint)
+
+    def send_api_error(self, error_type: str, listener: Optional[str] = None, endpoint: Optional[str] = None):
+        match error_type:
+            case "ipBlocked"|"registrationBlocked":
+                self.send_statuscode("Blocked", listener)
+            case "badRequest"|"tooManyAttachments"|"tooManyReplies"|"tooManyStickers"|"tooManyReactions":
+                self.send_statuscode("Syntax", listener)
+            case "notFound":
+                self.send_statuscode("IDNotFound", listener)
+            case "missingPermissions":
+                self.send_statuscode("MissingPermissions", listener)
+            case "usernameExists":
+                self.send_statuscode("IDExists", listener)
+            case "Unauthorized":
+                self.send_statuscode("PasswordInvalid", listener)
+            case "mfaRequired":
+                self.send_statuscode("2FARequired", listener)
+            case "accountDeleted":
+                self.send_statuscode("Deleted", listener)
+            case "accountLocked":
+                self.send_statuscode("AccountLocked", listener)
+            case "accountBanned":
+                self.send_statuscode("Banned", listener)
+            case "tooManyRequests":
+                self.send_statuscode("RateLimit", listener)
+            case "repairModeEnabled":
+                self.send_statuscode("Disabled", listener)
+            case _:
+                log(f"Unknown error type received from '{endpoint or 'supporter'}': {error_type}")
+                self.send_statuscode("InternalServerError", listener)
 
     def send(self, cmd: str, val: Any, extra: Optional[dict] = None, listener: Optional[str] = None):
         if extra is None:
@@ -358,6 +734,68 @@ class CloudlinkClient:
     def send_statuscode(self, statuscode: str, listener: Optional[str] = None):
         return self.send("statuscode", self.server.statuscodes[statuscode], listener=listener)
 
+    def enqueue(self, cmd: str, frame: str|bytes):
+        if self.evicted:
+            return
+
+        if len(self.send_queue) >= SEND_QUEUE_HIGH_WATER:
+            # Start shedding low priority frames once the client starts lagging
+            if self.lagging_since is None:
+                self.lagging_since = time.monotonic()
+                self.shed_low_priority()
+            if cmd in LOW_PRIORITY_CMDS:
+                if cmd == "ulist":
+                    self.ulist_stale = True
+                self.dropped_frames += 1
+                return
+
+            # Disconnect clients that are stuck above the limit
+            if len(self.send_queue) >= SEND_QUEUE_LIMIT or \
+                (time.monotonic()-self.lagging_since) > SEND_QUEUE_EVICT_AFTER:
+                return self.evict()
+
+        self.send_queue.append((cmd, frame))
+        self.send_queue_ready.set()
+
+    def shed_low_priority(self):
+        kept = deque()
+        for cmd, frame in self.send_queue:
+            if cmd in LOW_PRIORITY_CMDS:
+                if cmd == "ulist":
+                    self.ulist_stale = True
+                self.dropped_frames += 1
+            else:
+                kept.append((cmd, frame))
+        self.send_queue = kept
+
+    def evict(self):
+        log(f"Evicting slow Cloudlink client {self.username or self.ip} ({len(self.send_queue)} queued frames)")
+        self.evicted = True
+        self.dropped_frames += len(self.send_queue)
+        self.send_queue.clear()
+        asyncio.ensure_future(self.websocket.close(1013, "Send queue overflow"))
+
+    async def send_queue_writer(self):
+        try:
+            while True:
+                if not self.send_queue:
+                    self.send_queue_ready.clear()
+                    await self.send_queue_ready.wait()
+                    continue
+
+                # websocket.send waits for the transport to drain, so slow clients back up here
+                _, frame = self.send_queue.popleft()
+                await self.websocket.send(frame)
+
+                # Stop lagging once the queue has drained below the low water mark
+                if self.lagging_since is not None and len(self.send_queue) <= SEND_QUEUE_LOW_WATER:
+                    self.lagging_since = None
+                    if self.ulist_stale:
+                        self.ulist_stale = False
+                        self.send("ulist", self.server.get_ulist())
+        except websockets.ConnectionClosed:
+            pass
+
     async def kick(self):
         await self.websocket.close()
 
@@ -423,3 +861,120 @@ class CloudlinkCommands:
                 
                 # Tell the client it is authenticated
                 client.send_statuscode("OK", listener)
+
+
+    @staticmethod
+    async def create_post(client: CloudlinkClient, val, listener: Optional[str] = None):
+        # Make sure the client is authenticated
+        if not client.username:
+            return client.send_statuscode("IDRequired", listener)
+
+        # Check val datatype
+        if not isinstance(val, dict):
+            return client.send_statuscode("Datatype", listener)
+        chat_id = val.get("chat_id", "home")
+        content = val.get("content", "")
+        nonce = val.get("nonce")
+        attachments = val.get("attachments", [])
+        reply_to = val.get("reply_to", [])
+        stickers = val.get("stickers", [])
+        if not isinstance(chat_id, str) or \
+            not isinstance(content, str) or \
+            not (nonce is None or isinstance(nonce, str)) or \
+            not all(isinstance(l, list) and all(isinstance(i, str) for i in l) for l in (attachments, reply_to, stickers)):
+            return client.send_statuscode("Datatype", listener)
+        content = content.strip()
+        if len(content) > 4000 or (nonce and len(nonce) > 64):
+            return client.send_statuscode("Syntax", listener)
+
+        # Create post
+        try:
+            client.flags = await asyncio.to_thread(client.server.supporter.get_actor_flags, client.username)
+            await asyncio.to_thread(
+                client.server.supporter.submit_post,
+                chat_id,
+                client.username,
+                client.flags,
+                content,
+                attachment_ids=attachments,
+                sticker_ids=stickers,
+                reply_to_ids=reply_to,
+                nonce=nonce
+            )
+        except errors.APIError as e:
+            client.send_api_error(e.type, listener)
+        else:
+            client.send_statuscode("OK", listener)
+
+    @staticmethod
+    async def typing(client: CloudlinkClient, val, listener: Optional[str] = None):
+        # Make sure the client is authenticated
+        if not client.username:
+            return client.send_statuscode("IDRequired", listener)
+
+        # Check val datatype
+        if not isinstance(val, dict) or not isinstance(val.get("chat_id"), str):
+            return client.send_statuscode("Datatype", listener)
+
+        # Send typing event
+        try:
+            client.flags = await asyncio.to_thread(client.server.supporter.get_actor_flags, client.username)
+            await asyncio.to_thread(client.server.supporter.emit_typing, val["chat_id"], client.username)
+        except errors.APIError as e:
+            client.send_api_error(e.type, listener)
+        else:
+            client.send_statuscode("OK", listener)
+
+    @staticmethod
+    async def add_reaction(client: CloudlinkClient, val, listener: Optional[str] = None):
+        # Make sure the client is authenticated
+        if not client.username:
+            return client.send_statuscode("IDRequired", listener)
+
+        # Check val datatype
+        if not isinstance(val, dict) or \
+            not isinstance(val.get("post_id"), str) or \
+            not isinstance(val.get("emoji"), str):
+            return client.send_statuscode("Datatype", listener)
+
+        # Add reaction
+        try:
+            client.flags = await asyncio.to_thread(client.server.supporter.get_actor_flags, client.username)
+            await asyncio.to_thread(
+                client.server.supporter.add_post_reaction,
+                val["post_id"],
+                val["emoji"],
+                client.username
+            )
+        except errors.APIError as e:
+            client.send_api_error(e.type, listener)
+        else:
+            client.send_statuscode("OK", listener)
+
+    @staticmethod
+    async def remove_reaction(client: CloudlinkClient, val, listener: Optional[str] = None):
+        # Make sure the client is authenticated
+        if not client.username:
+            return client.send_statuscode("IDRequired", listener)
+
+        # Check val datatype
+        if not isinstance(val, dict) or \
+            not isinstance(val.get("post_id"), str) or \
+            not isinstance(val.get("emoji"), str) or \
+            not isinstance(val.get("username", client.username), str):
+            return client.send_statuscode("Datatype", listener)
+
+        # Remove reaction
+        try:
+            client.flags = await asyncio.to_thread(client.server.supporter.get_actor_flags, client.username)
+            await asyncio.to_thread(
+                client.server.supporter.remove_post_reaction,
+                val["post_id"],
+                val["emoji"],
+                val.get("username", client.username),
+                client.username
+            )
+        except errors.APIError as e:
+            client.send_api_error(e.type, listener)
+        else:
+            client.send_statuscode("OK", listener)
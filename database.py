@@ -1,21 +1,15 @@
 import pymongo
 import pymongo.errors
-import redis
 import os
 import secrets
-import time
-from radix import Radix
-from hashlib import sha256
-from base64 import urlsafe_b64encode
 
 from utils import log
-
-CURRENT_DB_VERSION = 10
+from metrics import InstrumentedRedis, MongoCommandListener
 
 # Create Redis connection
 log("Connecting to Redis...")
 try:
-    rdb = redis.from_url(os.getenv("REDIS_URI", "redis://127.0.0.1:6379/0"))
+    rdb = InstrumentedRedis.from_url(os.getenv("REDIS_URI", "redis://127.0.0.1:6379/0"))
 except Exception as e:
     log(f"Failed to connect to database! Error: {e}")
     exit()
@@ -26,7 +20,10 @@ else:
 # Create database connection
 log("Connecting to database...")
 try:
-    db = pymongo.MongoClient(os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017"))[os.getenv("MONGO_DB", "meowerserver")]
+    db = pymongo.MongoClient(
+        os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017"),
+        event_listeners=[MongoCommandListener()]
+    )[os.getenv("MONGO_DB", "meowerserver")]
     db.command("ping")
 except Exception as e:
     log(f"Failed to connect to database! Error: {e}")
@@ -35,195 +32,220 @@ else:
     log("Successfully connected to database!")
 
 
-# Create database collections
-existing_collections = db.list_collection_names()
-for collection_name in []:
-    if collection_name not in existing_collections:
-        log(f"Creating {collection_name} database collection...")
-        db.create_collection(collection_name)
-
-# Create usersv0 indexes
-try: db.usersv0.create_index([("lower_username", pymongo.ASCENDING)], name="lower_username", unique=True)
-except: pass
-try: db.usersv0.create_index([("email", pymongo.ASCENDING)], name="email", unique=True)
-except: pass
-try: db.usersv0.create_index([("normalized_email_hash", pymongo.ASCENDING)], name="normalized_email_hash", unique=True)
-except: pass
-try: db.usersv0.create_index([("created", pymongo.DESCENDING)], name="recent_users")
-except: pass
-try:
-    db.usersv0.create_index([
-        ("lower_username", pymongo.TEXT),
-        ("quote", pymongo.TEXT)
-    ], name="search", partialFilterExpression={"pswd": {"$type": "string"}})
-except: pass
-try: db.usersv0.create_index([
-        ("delete_after", pymongo.ASCENDING)
-    ], name="scheduled_deletions", partialFilterExpression={"delete_after": {"$type": "number"}})
-except: pass
-
-# Create authenticators indexes
-try: db.authenticators.create_index([("user", pymongo.ASCENDING)], name="user")
-except: pass
-
-# Create account sessions indexes
-try: db.acc_sessions.create_index([("user", pymongo.ASCENDING)], name="user")
-except: pass
-try: db.acc_sessions.create_index([("ip", pymongo.ASCENDING)], name="ip")
-except: pass
-try: db.acc_sessions.create_index([("refreshed_at", pymongo.ASCENDING)], name="refreshed_at")
-except: pass
-
-# Create security log indexes
-try: db.security_log.create_index([("user", pymongo.ASCENDING)], name="user")
-except: pass
-
-# Create data exports indexes
-try: db.data_exports.create_index([("user", pymongo.ASCENDING)], name="user")
-except: pass
-
-# Create relationships indexes
-try: db.relationships.create_index([("_id.from", pymongo.ASCENDING)], name="from")
-except: pass
-
-# Create posts indexes
-try:
-    db.posts.create_index([
-        ("post_origin", pymongo.ASCENDING),
-        ("isDeleted", pymongo.ASCENDING),
-        ("t.e", pymongo.DESCENDING),
-        ("u", pymongo.ASCENDING)
-    ], name="default")
-except: pass
-try:
-    db.posts.create_index([
-        ("u", pymongo.ASCENDING)
-    ], name="user")
-except: pass
-try:
-    db.posts.create_index([
-        ("p", pymongo.TEXT)
-    ], name="search", partialFilterExpression={"post_origin": "home", "isDeleted": False})
-except: pass
-
-try:
-    db.posts.create_index([
-        ("deleted_at", pymongo.ASCENDING)
-    ], name="scheduled_purges", partialFilterExpression={"isDeleted": True, "mod_deleted": False})
-except: pass
-
-try:
-    db.posts.create_index([
-        ("post_origin", pymongo.ASCENDING),
-        ("pinned", pymongo.ASCENDING),
-        ("t.e", pymongo.DESCENDING)
-    ], name="pinned_posts", partialFilterExpression={"pinned": True})
-except: pass
-
-# Create post revisions indexes
-try:
-    db.post_revisions.create_index([
-        ("post_id", pymongo.ASCENDING),
-        ("time", pymongo.DESCENDING)
-    ], name="post_revisions")
-except: pass
-try:
-    db.post_revisions.create_index([
-        ("time", pymongo.ASCENDING)
-    ], name="scheduled_purges")
-except: pass
-
-# Create chats indexes
-try:
-    db.chats.create_index([
-        ("members", pymongo.ASCENDING),
-        ("type", pymongo.ASCENDING),
-    ], name="user_chats")
-except: pass
-
-# Create chat_emojis indexes
-try:
-    db.chat_emojis.create_index([
-        ("chat_id", pymongo.ASCENDING),
-    ], name="chat_id")
-except: pass
-
-# Create chat_stickers indexes
-try:
-    db.chat_stickers.create_index([
-        ("chat_id", pymongo.ASCENDING),
-    ], name="chat_id")
-except: pass
-
-# Create reports indexes
-try:
-    db.reports.create_index([
-        ("content_id", pymongo.ASCENDING)
-    ], name="pending_reports", partialFilterExpression={"status": "pending"})
-except: pass
-try:
-    db.reports.create_index([
-        ("escalated", pymongo.DESCENDING),
-        ("reports.time", pymongo.DESCENDING),
-        ("status", pymongo.ASCENDING),
-        ("type", pymongo.ASCENDING)
-    ], name="all_reports")
-except: pass
-
-# Create audit log indexes
-try:
-    db.audit_log.create_index([
-        ("time", pymongo.ASCENDING),
-        ("type", pymongo.ASCENDING)
-    ], name="scheduled_purges")
-except: pass
-
-# Create post reactions index
-try:
-    db.post_reactions.create_index([("_id.post_id", 1), ("_id.emoji", 1)])
-except: pass
-
-
-# Create default database items
-try:
-    db.config.insert_one({
+# Indexes that should exist on each collection (built by build_indexes, unique ones before serving)
+INDEXES: dict[str, list[dict]] = {
+    "usersv0": [
+        {"name": "lower_username", "keys": [("lower_username", pymongo.ASCENDING)], "unique": True},
+        {"name": "email", "keys": [("email", pymongo.ASCENDING)], "unique": True},
+        {"name": "normalized_email_hash", "keys": [("normalized_email_hash", pymongo.ASCENDING)], "unique": True},
+        {"name": "recent_users", "keys": [("created", pymongo.DESCENDING)]},
+        {"name": "search", "keys": [
+            ("lower_username", pymongo.TEXT),
+            ("quote", pymongo.TEXT)
+        ], "partialFilterExpression": {"pswd": {"$type": "string"}}},
+        {"name": "scheduled_deletions", "keys": [
+            ("delete_after", pymongo.ASCENDING)
+        ], "partialFilterExpression": {"delete_after": {"$type": "number"}}}
+    ],
+    "authenticators": [
+        {"name": "user", "keys": [("user", pymongo.ASCENDING)]}
+    ],
+    "acc_sessions": [
+        {"name": "user", "keys": [("user", pymongo.ASCENDING)]},
+        {"name": "ip", "keys": [("ip", pymongo.ASCENDING)]},
+        {"name": "refreshed_at", "keys": [("refreshed_at", pymongo.ASCENDING)]}
+    ],
+    "security_log": [
+        {"name": "user", "keys": [("user", pymongo.ASCENDING)]}
+    ],
+    "data_exports": [
+        {"name": "user", "keys": [("user", pymongo.ASCENDING)]}
+    ],
+    "relationships": [
+        {"name": "from", "keys": [("_id.from", pymongo.ASCENDING)]}
+    ],
+    "posts": [
+        {"name": "default", "keys": [
+            ("post_origin", pymongo.ASCENDING),
+            ("isDeleted", pymongo.ASCENDING),
+            ("t.e", pymongo.DESCENDING),
+            ("u", pymongo.ASCENDING)
+        ]},
+        {"name": "user", "keys": [("u", pymongo.ASCENDING)]},
+        {"name": "search", "keys": [
+            ("p", pymongo.TEXT)
+        ], "partialFilterExpression": {"post_origin": "home", "isDeleted": False}},
+        {"name": "scheduled_purges", "keys": [
+            ("deleted_at", pymongo.ASCENDING)
+        ], "partialFilterExpression": {"isDeleted": True, "mod_deleted": False}},
+        {"name": "pinned_posts", "keys": [
+            ("post_origin", pymongo.ASCENDING),
+            ("pinned", pymongo.ASCENDING),
+            ("t.e", pymongo.DESCENDING)
+        ], "partialFilterExpression": {"pinned": True}}
+    ],
+    "post_revisions": [
+        {"name": "post_revisions", "keys": [
+            ("post_id", pymongo.ASCENDING),
+            ("time", pymongo.DESCENDING)
+        ]},
+        {"name": "scheduled_purges", "keys": [("time", pymongo.ASCENDING)]}
+    ],
+    "chats": [
+        {"name": "user_chats", "keys": [
+            ("members", pymongo.ASCENDING),
+            ("type", pymongo.ASCENDING)
+        ]}
+    ],
+    "chat_emojis": [
+        {"name": "chat_id", "keys": [("chat_id", pymongo.ASCENDING)]}
+    ],
+    "chat_stickers": [
+        {"name": "chat_id", "keys": [("chat_id", pymongo.ASCENDING)]}
+    ],
+    "reports": [
+        {"name": "pending_reports", "keys": [
+            ("content_id", pymongo.ASCENDING)
+        ], "partialFilterExpression": {"status": "pending"}},
+        {"name": "all_reports", "keys": [
+            ("escalated", pymongo.DESCENDING),
+            ("reports.time", pymongo.DESCENDING),
+            ("status", pymongo.ASCENDING),
+            ("type", pymongo.ASCENDING)
+        ]}
+    ],
+    "audit_log": [
+        {"name": "scheduled_purges", "keys": [
+            ("time", pymongo.ASCENDING),
+            ("type", pymongo.ASCENDING)
+        ]}
+    ],
+    "post_reactions": [
+        {"name": "_id.post_id_1__id.emoji_1", "keys": [  # default name, it was created without one
+            ("_id.post_id", pymongo.ASCENDING),
+            ("_id.emoji", pymongo.ASCENDING)
+        ]}
+    ],
+    "email_outbox": [
+        {"name": "pending_emails", "keys": [
+            ("status", pymongo.ASCENDING),
+            ("available_at", pymongo.ASCENDING)
+        ]},
+        {"name": "failed_emails", "keys": [("failed_at", pymongo.ASCENDING)], "expireAfterSeconds": 86400*7}  # 7 days
+    ]
+}
+INDEX_OPTIONS = ("unique", "partialFilterExpression", "expireAfterSeconds")  # options that change what an index does
+index_status = {
+    "missing": [],
+    "building": None,
+    "built": [],
+    "failed": {}  # {"collection.index": "error"}
+}
+
+
+def get_missing_indexes() -> list[tuple[str, dict]]:
+    # Diff the manifest against the indexes that exist (one listIndexes per collection)
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = {index["name"]: index for index in db[collection].list_indexes()}
+        for index in indexes:
+            if index["name"] not in existing:
+                missing.append((collection, index))
+                continue
+
+            # Text indexes are stored with internal keys, so only compare regular indexes
+            if not any(direction == pymongo.TEXT for _, direction in index["keys"]):
+                existing_keys = [
+                    (field, int(direction) if isinstance(direction, (int, float)) else direction)
+                    for field, direction in existing[index["name"]]["key"].items()
+                ]
+                if existing_keys != index["keys"]:
+                    index_status["failed"][f"{collection}.{index['name']}"] = f"exists with different keys: {existing_keys}"
+                    continue
+
+            # An index with the right keys but e.g. without unique doesn't count as present
+            existing_options = {key: existing[index["name"]].get(key) for key in INDEX_OPTIONS}
+            expected_options = {key: index.get(key) for key in INDEX_OPTIONS}
+            existing_options["unique"] = bool(existing_options["unique"])
+            expected_options["unique"] = bool(expected_options["unique"])
+            if existing_options != expected_options:
+                index_status["failed"][f"{collection}.{index['name']}"] = f"exists with different options: {existing_options}"
+    return missing
+
+
+def build_indexes(unique_only: bool = False):
+    # Unique indexes have to exist before serving, otherwise duplicates could get in and make them fail to build
+    # Indexes that already failed in an earlier pass get skipped (retrying them means another full collection scan)
+    index_status["failed"].pop("*", None)
+    already_failed = set(index_status["failed"])
+    try:
+        missing = get_missing_indexes()
+    except Exception as e:
+        log(f"Failed to check database indexes! Error: {e}")
+        index_status["failed"]["*"] = str(e)
+        return
+    missing = [(collection, index) for collection, index in missing if f"{collection}.{index['name']}" not in already_failed]
+    if unique_only:
+        missing = [(collection, index) for collection, index in missing if index.get("unique")]
+    index_status["missing"] = [f"{collection}.{index['name']}" for collection, index in missing]
+    for name, error in index_status["failed"].items():
+        if name not in already_failed:
+            log(f"Database index {name} {error}")
+    if not missing:
+        return
+
+    # Build missing indexes one at a time
+    log(f"Building {len(missing)} missing database index(es)...")
+    for collection, index in missing:
+        name = f"{collection}.{index['name']}"
+        index_status["building"] = name
+        options = {key: value for key, value in index.items() if key != "keys"}
+        try:
+            db[collection].create_index(index["keys"], **options)
+        except Exception as e:
+            log(f"Failed to build database index {name}! Error: {e}")
+            index_status["failed"][name] = str(e)
+        else:
+            index_status["built"].append(name)
+    index_status["building"] = None
+    log(f"Finished building database indexes ({len(index_status['built'])} built, {len(index_status['failed'])} failed)")
+
+
+# Create default database items (one round trip when they already exist)
+config_defaults = [
+    {
         "_id": "migration",
         "database": 1
-    })
-except pymongo.errors.DuplicateKeyError: pass
-try:
-    db.config.insert_one({
+    },
+    {
         "_id": "status",
         "repair_mode": False,
         "registration": True
-    })
-except pymongo.errors.DuplicateKeyError: pass
-try:
-    db.config.insert_one({
+    },
+    {
+        "_id": "inbox",
+        "epoch": 0
+    },
+    {
         "_id": "signing_keys",
         "acc": secrets.token_bytes(64),
         "email": secrets.token_bytes(64)
-    })
-except pymongo.errors.DuplicateKeyError: pass
+    }
+]
+config = {item["_id"]: item for item in db.config.find({"_id": {"$in": [item["_id"] for item in config_defaults]}})}
+missing_config = [item for item in config_defaults if item["_id"] not in config]
+if missing_config:
+    try:
+        db.config.insert_many(missing_config, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        # Another process inserted some of them first
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+    config.update({item["_id"]: item for item in db.config.find({"_id": {"$in": [item["_id"] for item in missing_config]}})})
 
 
 # Load signing keys
-signing_keys = db.config.find_one({"_id": "signing_keys"})
-
-
-# Load netblocks
-blocked_ips = Radix()
-registration_blocked_ips = Radix()
-for netblock in db.netblock.find({}):
-    try:
-        if netblock["type"] == 0:
-            blocked_ips.add(netblock["_id"])
-        if netblock["type"] == 1:
-            registration_blocked_ips.add(netblock["_id"])
-    except Exception as e:
-        log(f"Failed to load netblock {netblock['_id']}: {e}")
-log(f"Successfully loaded {len(blocked_ips.nodes())} netblock(s) into Radix!")
-log(f"Successfully loaded {len(registration_blocked_ips.nodes())} registration netblock(s) into Radix!")
+signing_keys = config["signing_keys"]
 
 
 def get_total_pages(collection: str, query: dict, page_size: int = 25) -> int:
@@ -233,110 +255,5 @@ def get_total_pages(collection: str, query: dict, page_size: int = 25) -> int:
         pages += 1
     return pages
 
-if db.config.find_one({"_id": "migration", "database": {"$ne": CURRENT_DB_VERSION}}):
-    log(f"[Migrator] Migrating DB to version {CURRENT_DB_VERSION}. ")
-    log(f"[Migrator] Please do not shut the server down until it is done.")
-
-    # Chat pinning
-    log("[Migrator] Adding pinned messages to database")
-    db.posts.update_many({"pinned": {"$exists": False}}, {"$set": {"pinned": False}})
-
-    log("[Migrator] Adding perm for pinning posts")
-    db.chats.update_many({"allow_pinning": {"$exists": False}}, {"$set": {"allow_pinning": False}})
-
-    # Experiments
-    log("[Migrator] Removing experiments from database")
-    db.usersv0.update_many({"experiments": {"$exists": True}}, {"$unset": {"experiments": ""}})
-
-    # Custom profile pictures
-    log("[Migrator] Adding custom profile pictures to database")
-    db.usersv0.update_many({"pswd": {"$ne": None}, "avatar": {"$exists": False}}, {"$set": {"avatar": ""}})
-    db.usersv0.update_many({"pswd": {"$ne": None}, "avatar_color": {"$exists": False}}, {"$set": {"avatar_color": "000000"}})
-
-    # Chat icons
-    log("[Migrator] Adding chat icons to database")
-    db.chats.update_many({"icon": {"$exists": False}}, {"$set": {"icon": ""}})
-    db.chats.update_many({"icon_color": {"$exists": False}}, {"$set": {"icon_color": "000000"}})
-
-    # Post attachments
-    log("[Migrator] Adding post attachments to database")
-    db.posts.update_many({"attachments": {"$exists": False}}, {"$set": {"attachments": []}})
-
-    # Profanity filter
-    log("[Migrator] Removing profanity filter")
-    db.config.delete_one({"_id": "filter"})
-    db.posts.update_many({"unfiltered_p": {"$exists": True}}, [{"$set": {"p": "$unfiltered_p"}}])
-    db.posts.update_many({"unfiltered_p": {"$exists": True}}, {"$unset": {"unfiltered_p": ""}})
-
-    # MFA recovery codes
-    log("[Migrator] Adding MFA recovery codes")
-    for user in db.usersv0.find({"pswd": {"$ne": None}, "mfa_recovery_code": {"$exists": False}}, projection={"_id": 1}):
-        db.usersv0.update_one({"_id": user["_id"]}, {"$set": {
-            "mfa_recovery_code": secrets.token_hex(5)
-        }})
-    
-    # Post reactions
-    log("[Migrator] Adding post reactions to database")
-    db.posts.update_many({"reactions": {"$exists": False}}, {"$set": {"reactions": []}})
-
-    # Remove type and post_id fields in posts database
-    log("[Migrator] Removing type and post_id fields from posts database")
-    db.posts.update_many({}, {"$unset": {"type": "", "post_id": ""}})
-
-    # Post replies
-    log("[Migrator] Adding post replies to database")
-    db.posts.update_many({"reply_to": {"$exists": False}}, {"$set": {"reply_to": []}})
-
-    # Fix MFA recovery codes
-    log("[Migrator] Fixing MFA recovery codes")
-    for user in db.usersv0.aggregate([
-        {"$match": {"mfa_recovery_code": {"$ne": None}}},
-        {"$project": {
-            "mfa_recovery_code": 1,
-            "length": {"$strLenCP": "$mfa_recovery_code"}
-        }},
-        {"$match": {
-            "length": {"$gt": 10}
-        }}
-    ]):
-        db.usersv0.update_one({"_id": user["_id"]}, {"$set": {
-            "mfa_recovery_code": user["mfa_recovery_code"][:10]
-        }})
-
-    # Delete system users from DB
-    log("[Migrator] Deleting system users from DB")
-    db.usersv0.delete_many({"_id": {"$in": ["Server", "Deleted", "Meower", "Admin", "username"]}})
-
-    # Emails
-    log("[Migrator] Adding email addresses")
-    db.usersv0.update_many({"email": {"$exists": False}}, {"$set": {
-        "email": "",
-        "normalized_email_hash": ""
-    }})
-
-    # New sessions
-    log("[Migrator] Adding new sessions")
-    for user in db.usersv0.find({
-        "tokens": {"$exists": True},
-        "last_seen": {"$ne": None, "$gt": int(time.time())-(86400*21)},
-    }, projection={"_id": 1, "tokens": 1}):
-        if user["tokens"]:
-            for token in user["tokens"]:
-                rdb.set(
-                    urlsafe_b64encode(sha256(token.encode()).digest()),
-                    user["_id"],
-                    ex=86400*21  # 21 days
-                )
-    db.usersv0.update_many({}, {"$unset": {"tokens": ""}})
-    try: db.usersv0.drop_index("tokens")
-    except: pass
-
-    # No more netinfo and netlog
-    log("[Migrator] Removing netinfo and netlog")
-    db.netinfo.drop()
-    db.netlog.drop()
-
-    db.config.update_one({"_id": "migration"}, {"$set": {"database": CURRENT_DB_VERSION}})
-    log(f"[Migrator] Finished Migrating DB to version {CURRENT_DB_VERSION}")
 
 print("") # finished startup logs
@@ -4,4 +4,16 @@ class AccSessionTokenExpired(Exception): pass
 
 class AccSessionNotFound(Exception): pass
 
-class EmailTicketExpired(Exception): pass
\ No newline at end of file
+class EmailTicketExpired(Exception): pass
+
+class MigrationLeaseLost(Exception): pass
+
+class NetblocksNotLoaded(Exception): pass
+
+class InvalidSearchCursor(Exception): pass
+
+class APIError(Exception):
+    def __init__(self, error_type: str, status: int):
+        super().__init__(error_type)
+        self.type = error_type
+        self.status = status
\ No newline at end of file
@@ -0,0 +1,173 @@
+from typing import Optional
+from bisect import bisect_right
+import os, sys, csv, mmap, heapq, struct, ipaddress, msgpack
+
+from utils import log
+
+"""
+Meower IP Intelligence Module
+This module provides offline IP lookups (geo, ASN, ISP and VPN/hosting state) from a memory-mapped,
+binary-searchable database built from a CSV export.
+
+Build a database with:
+    python ip_intel.py build <input.csv> <output.bin>
+
+The CSV needs a header row with either "network" (CIDR) or "start_ip" and "end_ip" columns, plus any of
+"country_code", "country_name", "region", "city", "timezone", "currency", "as", "isp" and "vpn".
+Overlapping ranges are allowed, the narrowest range covering an IP wins (later rows win ties).
+"""
+
+MAGIC = b"MIPI"
+VERSION = 1
+HEADER = struct.Struct(">4sHII")  # magic, version, record count, info table offset
+RECORD = struct.Struct(">16s16sI")  # range start, range end, info offset
+INFO_LEN = struct.Struct(">I")
+INFO_CACHE_SIZE = 4096
+
+INFO_FIELDS = ("country_code", "country_name", "region", "city", "timezone", "currency", "as", "isp")
+
+
+def pack_ip(ip_address: str) -> bytes:
+    # IPv4 addresses get mapped into IPv6 (::ffff:0:0/96) so both fit in one sorted table
+    ip = ipaddress.ip_address(ip_address)
+    if ip.version == 4:
+        ip = ipaddress.IPv6Address(f"::ffff:{ip}")
+    return ip.packed
+
+
+class _RangeStarts:
+    # Sequence view over the record starts, so bisect can search the mmap directly
+    def __init__(self, buf: mmap.mmap, count: int):
+        self.buf = buf
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        offset = HEADER.size + (i * RECORD.size)
+        return self.buf[offset:offset+16]
+
+
+class IPIntelDB:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, self._info_offset = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a v{VERSION} IP intelligence database")
+        self._starts = _RangeStarts(self._buf, self.count)
+        self._info_cache: dict[int, dict] = {}
+
+    def lookup(self, ip_address: str) -> Optional[dict]:
+        try:
+            key = pack_ip(ip_address)
+        except ValueError:
+            return None
+
+        i = bisect_right(self._starts, key) - 1
+        if i < 0:
+            return None
+        _, end, info_offset = RECORD.unpack_from(self._buf, HEADER.size + (i * RECORD.size))
+        if key > end:
+            return None
+        return dict(self._get_info(info_offset))
+
+    def _get_info(self, info_offset: int) -> dict:
+        info = self._info_cache.get(info_offset)
+        if info is None:
+            offset = self._info_offset + info_offset
+            length, = INFO_LEN.unpack_from(self._buf, offset)
+            info = msgpack.unpackb(self._buf[offset+INFO_LEN.size:offset+INFO_LEN.size+length])
+            if len(self._info_cache) >= INFO_CACHE_SIZE:
+                self._info_cache.clear()
+            self._info_cache[info_offset] = info
+        return info
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
+
+
+def flatten(ranges: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+    # Split (start, end, info offset) ranges into sorted, non-overlapping ones, where the narrowest range covering an IP wins
+    boundaries = sorted({start for start, _, _ in ranges} | {end+1 for _, end, _ in ranges})
+    by_start = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    active: list[tuple[int, int, int, int]] = []  # heap of (size, -row, end, info offset)
+    flat: list[tuple[int, int, int]] = []
+    j = 0
+    for point, next_point in zip(boundaries, boundaries[1:]):
+        # Add ranges starting here, and drop ranges that have ended
+        while j < len(by_start) and ranges[by_start[j]][0] <= point:
+            start, end, info_offset = ranges[by_start[j]]
+            heapq.heappush(active, (end-start, -by_start[j], end, info_offset))
+            j += 1
+        while active and active[0][2] < point:
+            heapq.heappop(active)
+        if not active:
+            continue
+
+        # Extend the previous range if it's adjacent with the same info
+        info_offset = active[0][3]
+        if flat and flat[-1][1] == point-1 and flat[-1][2] == info_offset:
+            flat[-1] = (flat[-1][0], next_point-1, info_offset)
+        else:
+            flat.append((point, next_point-1, info_offset))
+    return flat
+
+
+def build(csv_path: str, output_path: str):
+    ranges: list[tuple[int, int, int]] = []
+    info_table = bytearray()
+    info_offsets: dict[bytes, int] = {}  # deduplicate identical info blobs
+
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row.get("network"):
+                network = ipaddress.ip_network(row["network"], strict=False)
+                start, end = str(network[0]), str(network[-1])
+            else:
+                start, end = row["start_ip"], row["end_ip"]
+
+            info = {field: (row.get(field) or "Unknown") for field in INFO_FIELDS}
+            info["vpn"] = (row.get("vpn") or "").strip().lower() in {"1", "true", "yes"}
+            blob = msgpack.packb(info)
+            if blob not in info_offsets:
+                info_offsets[blob] = len(info_table)
+                info_table += INFO_LEN.pack(len(blob)) + blob
+
+            ranges.append((int.from_bytes(pack_ip(start), "big"), int.from_bytes(pack_ip(end), "big"), info_offsets[blob]))
+
+    records = [(start.to_bytes(16, "big"), end.to_bytes(16, "big"), info_offset) for start, end, info_offset in flatten(ranges)]
+    info_offset = HEADER.size + (len(records) * RECORD.size)
+    with open(output_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), info_offset))
+        for record in records:
+            f.write(RECORD.pack(*record))
+        f.write(info_table)
+
+    return len(records)
+
+
+# Load database
+ip_db: Optional[IPIntelDB] = None
+if os.getenv("IP_INTEL_DB"):
+    try:
+        ip_db = IPIntelDB(os.environ["IP_INTEL_DB"])
+        log(f"Loaded {ip_db.count} IP ranges from {os.environ['IP_INTEL_DB']}")
+    except Exception as e:
+        log(f"Unable to load IP intelligence database: {e}")
+
+
+def lookup(ip_address: str) -> Optional[dict]:
+    if ip_db:
+        return ip_db.lookup(ip_address)
+    return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "build":
+        print("Usage: python ip_intel.py build <input.csv> <output.bin>")
+        sys.exit(1)
+    print(f"Wrote {build(sys.argv[2], sys.argv[3])} IP ranges to {sys.argv[3]}")
@@ -0,0 +1,132 @@
+from threading import get_ident
+from typing import Optional
+from collections import deque
+import asyncio, os, sys, time, traceback, sentry_sdk
+
+from utils import log
+from metrics import event_loop_lag, event_loop_stalls, get_task_activity
+
+"""
+Meower Loop Monitor Module
+This module measures event loop lag on the REST API (uvicorn) and Cloudlink loops, and catches blocking calls.
+
+Each loop runs a heartbeat task that notes how late it wakes up. A watchdog thread checks the heartbeats,
+and when a loop hasn't beaten for longer than LOOP_LAG_THRESHOLD, it captures the loop thread's current stack
+(the call that's blocking it) along with the route or Cloudlink command it's running, and reports it.
+"""
+
+LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", 0.5))  # seconds, 0 disables the monitor
+HEARTBEAT_INTERVAL = 0.25  # seconds
+WATCHDOG_INTERVAL = 0.1  # seconds
+MAX_STACK_FRAMES = 30
+
+
+class LoopMonitor:
+    def __init__(self, name: str):
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+
+        self.last_beat = time.monotonic()
+        self.reported_beat: Optional[float] = None
+        self.current_stall: Optional[dict] = None
+        self.stalls: deque[dict] = deque(maxlen=20)
+        self.max_lag: float = 0.0
+
+        self.lag_histogram = event_loop_lag.labels(name)
+        self.stall_counter = event_loop_stalls.labels(name)
+
+    def start(self):
+        # Must be called from the loop being monitored
+        if not LAG_THRESHOLD:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = get_ident()
+        self.last_beat = time.monotonic()
+        self.task = self.loop.create_task(self.heartbeat())
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            lag = max(now - self.last_beat - HEARTBEAT_INTERVAL, 0)
+            self.last_beat = now
+
+            self.lag_histogram.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            # Record how long the reported stall ended up lasting
+            if self.current_stall:
+                self.current_stall["duration"] = round(lag, 3)
+                self.current_stall = None
+
+    def check(self, now: float):
+        if self.thread_id is None:
+            return
+
+        # Only report a stall once
+        last_beat = self.last_beat
+        stalled_for = now - last_beat - HEARTBEAT_INTERVAL
+        if stalled_for < LAG_THRESHOLD or self.reported_beat == last_beat:
+            return
+        self.reported_beat = last_beat
+
+        # Get what the loop is stuck on
+        frame = sys._current_frames().get(self.thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=MAX_STACK_FRAMES)) if frame else ""
+        task = asyncio.current_task(self.loop)
+        activity = get_task_activity(task) or (task.get_name() if task else "callback")
+
+        stall = {
+            "activity": activity,
+            "stalled_for": round(stalled_for, 3),
+            "duration": None,  # filled in once the loop recovers
+            "stack": stack,
+            "time": int(time.time())
+        }
+        self.current_stall = stall
+        self.stalls.append(stall)
+        self.stall_counter.inc()
+        self.report(stall)
+
+    def report(self, stall: dict):
+        log(f"{self.name} event loop blocked for over {stall['stalled_for']}s by {stall['activity']}:\n{stall['stack']}")
+        with sentry_sdk.push_scope() as scope:
+            scope.set_tag("loop", self.name)
+            scope.set_tag("activity", stall["activity"])
+            scope.set_extra("stalled_for", stall["stalled_for"])
+            scope.set_extra("stack", stall["stack"])
+            sentry_sdk.capture_message(f"{self.name} event loop blocked by {stall['activity']}", level="warning")
+
+    def get_stats(self) -> dict:
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "max_lag": round(self.max_lag, 3),
+            "stalls": list(self.stalls)
+        }
+
+
+api_monitor = LoopMonitor("api")
+cl_monitor = LoopMonitor("cloudlink")
+monitors = (api_monitor, cl_monitor)
+
+
+def watchdog():
+    if not LAG_THRESHOLD:
+        return
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        now = time.monotonic()
+        for monitor in monitors:
+            try:
+                monitor.check(now)
+            except Exception as e:
+                log(f"Unable to check {monitor.name} event loop: {e}")
+
+
+def get_stats() -> dict:
+    return {
+        "threshold": LAG_THRESHOLD,
+        "loops": {monitor.name: monitor.get_stats() for monitor in monitors}
+    }
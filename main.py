@@ -3,7 +3,10 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import asyncio
+import atexit
 import os
+import signal
+import sys
 import uvicorn
 import sentry_sdk
 
@@ -11,7 +14,10 @@ from threading import Thread
 
 from cloudlink import CloudlinkServer
 from supporter import Supporter
-from security import background_tasks_loop
+from security import background_tasks_loop, security_log_sink
+from write_behind import write_behind
+import database, outbox, metrics, loop_monitor, migrations
+from search_index import home_index, username_index
 from grpc_auth import service as grpc_auth
 from rest_api import app as rest_api
 
@@ -27,9 +33,41 @@ if __name__ == "__main__":
     supporter = Supporter(cl)
     cl.supporter = supporter
 
+    # Build missing database indexes (unique ones before serving, the rest in the background)
+    database.build_indexes(unique_only=True)
+    Thread(target=database.build_indexes, daemon=True).start()
+
+    # Start database migrations (serves in compatible mode until they're done)
+    Thread(target=migrations.migrator.run, daemon=True).start()
+
     # Start background tasks loop
     Thread(target=background_tasks_loop, daemon=True).start()
 
+    # Start security log sink
+    Thread(target=security_log_sink, daemon=True).start()
+
+    # Start email outbox workers
+    outbox.start()
+
+    # Build home search index and merge its segments in the background
+    Thread(target=home_index.run, daemon=True).start()
+
+    # Build username index
+    Thread(target=username_index.build, daemon=True).start()
+
+    # Start write-behind queue worker
+    Thread(target=write_behind.run, daemon=True).start()
+
+    # Flush the write-behind queue on exit (SIGTERM exits through sys.exit, so exit handlers run)
+    atexit.register(write_behind.stop)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # Start metrics server
+    Thread(target=metrics.serve, daemon=True).start()
+
+    # Start event loop watchdog
+    Thread(target=loop_monitor.watchdog, daemon=True).start()
+
     # Start gRPC services
     Thread(target=grpc_auth.serve, daemon=True).start()
 
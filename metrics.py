@@ -0,0 +1,426 @@
+from contextvars import ContextVar, Token
+from contextlib import contextmanager
+from threading import Lock
+from typing import Optional, Iterator
+from collections import Counter, deque
+from bisect import bisect_left
+from weakref import WeakKeyDictionary
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import monitoring
+import os, time, asyncio, redis
+
+from utils import log
+
+"""
+Meower Metrics Module
+This module attributes every MongoDB and Redis command to the REST route or Cloudlink command that issued it.
+
+Mongo commands are captured with a pymongo command listener and Redis commands with an instrumented client,
+both of which record into the query tally of the current activity (a context variable, which gets copied into
+asyncio.to_thread calls). Activities that go over their query budget get logged and counted.
+
+It also holds a small Prometheus-style registry (counters, gauges and histograms with labels), which gets served
+in the text exposition format on an internal port (METRICS_PORT). Updating a metric only takes an uncontended lock,
+so they're safe to use on hot paths; cache the result of labels() where a path is really hot.
+"""
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)  # 0 disables the metrics server
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)  # milliseconds
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)  # queries per activity
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # clients
+
+
+def parse_budgets(budgets: str) -> dict[str, int]:
+    # "GET /home=10,cl:direct=5" -> {"GET /home": 10, "cl:direct": 5}
+    parsed = {}
+    for budget in budgets.split(","):
+        activity, _, limit = budget.strip().rpartition("=")
+        if activity and limit.isdigit():
+            parsed[activity.strip()] = int(limit)
+    return parsed
+
+
+QUERY_BUDGET_DEFAULT = int(os.getenv("QUERY_BUDGET_DEFAULT", 50))  # 0 disables the default budget
+QUERY_BUDGETS = parse_budgets(os.getenv("QUERY_BUDGETS", ""))
+BUDGET_LOG_INTERVAL = 60  # seconds between budget violation logs per activity
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Value:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str, labels: str) -> list[str]:
+        return [f"{name}{labels} {format_value(self.value)}"]
+
+
+class Histogram:
+    __slots__ = ("_lock", "buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self._lock = Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at)
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Upper bound of the bucket the quantile falls into
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99)
+        }
+
+    def render(self, name: str, labelnames: tuple, values: tuple, scale: float = 1) -> list[str]:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = 'le="' + format_value(bucket * scale if bucket != float("inf") else bucket) + '"'
+            lines.append(f"{name}_bucket{format_labels(labelnames, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labelnames, values)} {format_value(total * scale)}")
+        lines.append(f"{name}_count{format_labels(labelnames, values)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = Lock()
+        self.collectors: list = []  # anything with a collect() method returning exposition lines
+
+    def register(self, collector):
+        with self._lock:
+            self.collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        with self._lock:
+            collectors = list(self.collectors)
+        lines = []
+        for collector in collectors:
+            lines.extend(collector.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = Lock()
+        self._children: dict[tuple, Value|Histogram] = {}
+        registry.register(self)
+
+    def _new_child(self) -> Value|Histogram:
+        return Value()
+
+    def labels(self, *values) -> Value|Histogram:
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            if isinstance(child, Histogram):
+                lines.extend(child.render(self.name, self.labelnames, values))
+            else:
+                lines.extend(child.render(self.name, format_labels(self.labelnames, values)))
+        return lines
+
+
+class CounterMetric(Metric):
+    type = "counter"
+
+
+class GaugeMetric(Metric):
+    type = "gauge"
+
+
+class HistogramMetric(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = SECONDS_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> Histogram:
+        return Histogram(self.buckets)
+
+
+# REST API
+http_requests = CounterMetric("http_requests_total", "REST API requests.", ("method", "route", "status"))
+http_request_duration = HistogramMetric("http_request_duration_seconds", "REST API request latency.", ("method", "route"))
+
+# Cloudlink
+cl_connections = GaugeMetric("cl_connections", "Open Cloudlink connections.", ("wire_format",))
+cl_packets = CounterMetric("cl_packets_total", "Inbound Cloudlink packets.", ("cmd",))
+cl_fanout_clients = HistogramMetric("cl_fanout_clients", "Clients an outbound Cloudlink event was sent to.", ("cmd",), buckets=FANOUT_BUCKETS)
+cl_fanout_duration = HistogramMetric("cl_fanout_duration_seconds", "Time spent encoding and queueing an outbound Cloudlink event.", ("cmd",))
+cl_handshake_rejections = CounterMetric("cl_handshake_rejections_total", "Cloudlink handshakes rejected before the upgrade.", ("reason",))
+
+# Rate limits
+ratelimit_rejections = CounterMetric("ratelimit_rejections_total", "Requests rejected by a rate limit.", ("bucket",))
+
+# Background tasks
+background_task_duration = HistogramMetric("background_task_duration_seconds", "Background task run time.", ("task",))
+
+# Event loops
+event_loop_lag = HistogramMetric("event_loop_lag_seconds", "How late event loop heartbeats ran.", ("loop",))
+event_loop_stalls = CounterMetric("event_loop_stalls_total", "Event loop stalls over the lag threshold.", ("loop",))
+
+
+class QueryTally:
+    __slots__ = ("activity", "count", "time_ms", "commands")
+
+    def __init__(self, activity: str):
+        self.activity = activity
+        self.count = 0
+        self.time_ms = 0.0
+        self.commands: Counter = Counter()
+
+
+current_tally: ContextVar[Optional[QueryTally]] = ContextVar("current_tally", default=None)
+
+# Tallies of running tasks, so other threads (like the loop monitor watchdog) can tell what a loop is doing
+task_tallies: WeakKeyDictionary[asyncio.Task, QueryTally] = WeakKeyDictionary()
+
+
+def get_task_activity(task: Optional[asyncio.Task]) -> Optional[str]:
+    tally = task_tallies.get(task) if task else None
+    return tally.activity if tally else None
+
+
+def _current_task() -> Optional[asyncio.Task]:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # no running loop
+        return None
+
+
+class QueryStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.commands: dict[tuple[str, str, str], Histogram] = {}  # {(activity, backend, command): latency}
+        self.activities: dict[str, Histogram] = {}  # {activity: queries per run}
+        self.over_budget: Counter = Counter()  # {activity: violations}
+        self.recent_violations: deque[dict] = deque(maxlen=50)
+        self._last_logged: dict[str, float] = {}
+
+    def record(self, backend: str, command: str, duration_ms: float, failed: bool = False):
+        tally = current_tally.get()
+        if tally:
+            tally.count += 1
+            tally.time_ms += duration_ms
+            tally.commands[f"{backend}:{command}"] += 1
+        activity = tally.activity if tally else "background"
+
+        key = (activity, backend, f"{command}:failed" if failed else command)
+        histogram = self.commands.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.commands.setdefault(key, Histogram(LATENCY_BUCKETS))
+        histogram.observe(duration_ms)
+
+    def start(self, activity: str) -> Token:
+        tally = QueryTally(activity)
+        task = _current_task()
+        if task:
+            task_tallies[task] = tally
+        return current_tally.set(tally)
+
+    def finish(self, token: Token):
+        tally = current_tally.get()
+        current_tally.reset(token)
+        task = _current_task()
+        if task:
+            task_tallies.pop(task, None)
+        if not tally:
+            return
+
+        histogram = self.activities.get(tally.activity)
+        if histogram is None:
+            with self._lock:
+                histogram = self.activities.setdefault(tally.activity, Histogram(QUERY_COUNT_BUCKETS))
+        histogram.observe(tally.count)
+
+        # Check query budget
+        budget = QUERY_BUDGETS.get(tally.activity, QUERY_BUDGET_DEFAULT)
+        if not budget or tally.count <= budget:
+            return
+        self.over_budget[tally.activity] += 1
+        violation = {
+            "activity": tally.activity,
+            "queries": tally.count,
+            "query_ms": round(tally.time_ms, 3),
+            "budget": budget,
+            "top_commands": dict(tally.commands.most_common(5)),
+            "time": int(time.time())
+        }
+        self.recent_violations.append(violation)
+        if time.time() - self._last_logged.get(tally.activity, 0) >= BUDGET_LOG_INTERVAL:
+            self._last_logged[tally.activity] = time.time()
+            log(f"{tally.activity} made {tally.count} queries ({round(tally.time_ms)}ms) with a budget of {budget}: {violation['top_commands']}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            commands = list(self.commands.items())
+            activities = list(self.activities.items())
+
+        stats = {
+            activity: {
+                "runs": histogram.count,
+                "queries": histogram.to_dict(),
+                "budget": QUERY_BUDGETS.get(activity, QUERY_BUDGET_DEFAULT),
+                "over_budget": self.over_budget[activity],
+                "commands": {}
+            }
+            for activity, histogram in activities
+        }
+        for (activity, backend, command), histogram in commands:
+            stats.setdefault(activity, {"commands": {}})["commands"][f"{backend}:{command}"] = histogram.to_dict()
+
+        return {
+            "activities": stats,
+            "recent_violations": list(self.recent_violations)
+        }
+
+    def collect(self) -> list[str]:
+        name = "db_command_duration_seconds"
+        labelnames = ("activity", "backend", "command")
+        lines = [f"# HELP {name} Database command latency by activity.", f"# TYPE {name} histogram"]
+        with self._lock:
+            commands = list(self.commands.items())
+        for values, histogram in commands:
+            lines.extend(histogram.render(name, labelnames, values, scale=0.001))
+        return lines
+
+
+query_stats = registry.register(QueryStats())
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._pending: dict[tuple, str] = {}  # {(connection_id, request_id): "command:collection"}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        self._pending[(event.connection_id, event.request_id)] = (
+            f"{event.command_name}:{collection}" if isinstance(collection, str) else event.command_name
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        command = self._pending.pop((event.connection_id, event.request_id), event.command_name)
+        query_stats.record("mongo", command, event.duration_micros / 1000)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        command = self._pending.pop((event.connection_id, event.request_id), event.command_name)
+        query_stats.record("mongo", command, event.duration_micros / 1000, failed=True)
+
+
+class InstrumentedRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            resp = super().execute_command(*args, **options)
+            failed = False
+            return resp
+        finally:
+            query_stats.record("redis", str(args[0]).lower(), (time.perf_counter() - started_at) * 1000, failed=failed)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    if not METRICS_PORT:
+        return
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    log(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}")
+    server.serve_forever()
@@ -0,0 +1,318 @@
+from typing import Any, Callable, Iterator, Optional
+from hashlib import sha256
+from base64 import urlsafe_b64encode
+import os, time, uuid, secrets, pymongo
+
+from database import db, rdb
+from utils import log
+from metrics import background_task_duration
+import errors
+
+"""
+Meower Migrations Module
+This module upgrades the database schema in the background, while the server keeps serving.
+
+Migrations are steps tagged with the database version they belong to. Only the node holding the lease on the
+migration config document runs them. Steps go through their collections in bounded batches (ordered by _id) and
+checkpoint after every batch, so a restarted or different node carries on where the last one stopped.
+
+Nodes keep serving during a migration, so every step has to leave documents in a shape the current code can handle.
+Code reading a field that a step adds has to fall back to the step's default (e.g. post.get("attachments", [])),
+and code that depends on a step that may not have run yet should check in_progress() (see legacy token logins).
+"""
+
+CURRENT_DB_VERSION = 10
+BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 500))
+BATCH_DELAY = float(os.getenv("MIGRATION_BATCH_DELAY", 0.05))  # seconds to sleep between batches
+LEASE_SECONDS = 60  # how long a node owns the migration before another node can take over
+LEASE_RETRY_INTERVAL = 30
+PROGRESS_LOG_INTERVAL = 10
+LEGACY_TOKEN_MAX_AGE = 86400*21  # legacy tokens of users not seen for longer than this don't get carried over
+
+
+class Migrator:
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self.running = False
+        self.step: Optional[str] = None
+        self.checkpoint: Any = None
+        self.processed: int = 0
+        self.total: int = 0
+        self.last_progress_log: float = 0.0
+
+    def acquire_lease(self) -> Optional[dict]:
+        # Returns the migration document if this node now holds the lease
+        now = time.time()
+        return db.config.find_one_and_update({
+            "_id": "migration",
+            "database": {"$lt": CURRENT_DB_VERSION},
+            "$or": [
+                {"lease_owner": {"$in": [None, self.node_id]}},
+                {"lease_expires": {"$lt": now}}
+            ]
+        }, {"$set": {
+            "lease_owner": self.node_id,
+            "lease_expires": now+LEASE_SECONDS
+        }}, return_document=pymongo.ReturnDocument.AFTER)
+
+    def save(self, updates: dict):
+        # Saves progress and renews the lease, fails if another node took the lease over
+        result = db.config.update_one({"_id": "migration", "lease_owner": self.node_id}, {"$set": {
+            **updates,
+            "lease_expires": time.time()+LEASE_SECONDS
+        }})
+        if not result.matched_count:
+            raise errors.MigrationLeaseLost
+
+    def release_lease(self):
+        db.config.update_one({"_id": "migration", "lease_owner": self.node_id}, {"$set": {
+            "lease_owner": None,
+            "lease_expires": 0
+        }})
+
+    def iter_batches(self, collection: str, query: dict, projection: Optional[dict] = None) -> Iterator[list[dict]]:
+        # Yields batches of matching documents, the checkpoint is saved once a batch has been processed
+        self.total = self.processed + db[collection].count_documents(
+            {"$and": [query, {"_id": {"$gt": self.checkpoint}}]} if self.checkpoint is not None else query
+        )
+        while True:
+            batch_query = query
+            if self.checkpoint is not None:
+                batch_query = {"$and": [query, {"_id": {"$gt": self.checkpoint}}]}
+            batch = list(db[collection].find(
+                batch_query,
+                projection=projection,
+                sort=[("_id", pymongo.ASCENDING)],
+                limit=BATCH_SIZE
+            ))
+            if not batch:
+                return
+
+            started_at = time.perf_counter()
+            yield batch
+            background_task_duration.labels("migration_batch").observe(time.perf_counter() - started_at)
+
+            # Checkpoint
+            self.checkpoint = batch[-1]["_id"]
+            self.processed += len(batch)
+            self.save({"checkpoint": self.checkpoint, "progress": {"processed": self.processed, "total": self.total}})
+            if time.time() - self.last_progress_log > PROGRESS_LOG_INTERVAL:
+                self.last_progress_log = time.time()
+                log(f"[Migrator] {self.step}: {self.processed}/{self.total} documents")
+
+            # Throttle, so the migration doesn't starve requests
+            if len(batch) < BATCH_SIZE:
+                return
+            time.sleep(BATCH_DELAY)
+
+    def update_in_batches(self, collection: str, query: dict, update: Any):
+        for batch in self.iter_batches(collection, query, projection={"_id": 1}):
+            # Re-check the query, in case a document changed since it was read
+            db[collection].update_many({"$and": [query, {"_id": {"$in": [doc["_id"] for doc in batch]}}]}, update)
+
+    def migrate(self, migration: dict):
+        # Run the remaining steps, in order
+        done_steps = set(migration.get("done_steps", []))
+        for version, name, step in MIGRATIONS:
+            if version <= migration["database"] or name in done_steps:
+                continue
+
+            self.step = name
+            self.processed = (migration.get("progress") or {}).get("processed", 0) if migration.get("step") == name else 0
+            self.checkpoint = migration.get("checkpoint") if migration.get("step") == name else None
+            if self.checkpoint is not None:
+                log(f"[Migrator] Resuming {name} from {self.checkpoint}")
+            else:
+                log(f"[Migrator] Running {name}")
+                self.save({"step": name, "checkpoint": None, "progress": {"processed": 0, "total": 0}})
+
+            step(self)
+
+            done_steps.add(name)
+            self.save({"done_steps": list(done_steps), "step": None, "checkpoint": None})
+
+        self.save({"database": CURRENT_DB_VERSION, "done_steps": [], "progress": None})
+
+    def run(self):
+        if not in_progress():
+            return
+        log(f"[Migrator] Database needs migrating to version {CURRENT_DB_VERSION}, serving in compatible mode until it's done")
+
+        while True:
+            try:
+                migration = self.acquire_lease()
+                if not migration:
+                    if not in_progress():
+                        log(f"[Migrator] Database was migrated to version {CURRENT_DB_VERSION} by another node")
+                        return
+                    time.sleep(LEASE_RETRY_INTERVAL)
+                    continue
+
+                self.running = True
+                log(f"[Migrator] Migrating database from version {migration['database']} to version {CURRENT_DB_VERSION}")
+                self.migrate(migration)
+                self.release_lease()
+                log(f"[Migrator] Finished migrating database to version {CURRENT_DB_VERSION}")
+                return
+            except errors.MigrationLeaseLost:
+                log(f"[Migrator] Lost the migration lease during {self.step}, another node is taking over")
+            except Exception as e:
+                log(f"[Migrator] Failed during {self.step}: {e}")
+                try:
+                    self.release_lease()
+                except Exception: pass
+            finally:
+                self.running = False
+            time.sleep(LEASE_RETRY_INTERVAL)
+
+    def get_stats(self) -> dict:
+        migration = db.config.find_one({"_id": "migration"}) or {}
+        return {
+            "database": migration.get("database"),
+            "target": CURRENT_DB_VERSION,
+            "step": migration.get("step"),
+            "done_steps": migration.get("done_steps", []),
+            "progress": migration.get("progress"),
+            "lease_owner": migration.get("lease_owner"),
+            "lease_expires": migration.get("lease_expires"),
+            "node_id": self.node_id,
+            "running": self.running
+        }
+
+
+def in_progress() -> bool:
+    return db.config.count_documents({"_id": "migration", "database": {"$lt": CURRENT_DB_VERSION}}, limit=1) > 0
+
+
+# Version 10
+def add_pinned_posts(m: Migrator):
+    m.update_in_batches("posts", {"pinned": {"$exists": False}}, {"$set": {"pinned": False}})
+
+
+def add_chat_pinning_perm(m: Migrator):
+    m.update_in_batches("chats", {"allow_pinning": {"$exists": False}}, {"$set": {"allow_pinning": False}})
+
+
+def remove_experiments(m: Migrator):
+    m.update_in_batches("usersv0", {"experiments": {"$exists": True}}, {"$unset": {"experiments": ""}})
+
+
+def add_custom_pfps(m: Migrator):
+    m.update_in_batches("usersv0", {
+        "pswd": {"$ne": None},
+        "$or": [{"avatar": {"$exists": False}}, {"avatar_color": {"$exists": False}}]
+    }, [{"$set": {
+        "avatar": {"$ifNull": ["$avatar", ""]},
+        "avatar_color": {"$ifNull": ["$avatar_color", "000000"]}
+    }}])
+
+
+def add_chat_icons(m: Migrator):
+    m.update_in_batches("chats", {
+        "$or": [{"icon": {"$exists": False}}, {"icon_color": {"$exists": False}}]
+    }, [{"$set": {
+        "icon": {"$ifNull": ["$icon", ""]},
+        "icon_color": {"$ifNull": ["$icon_color", "000000"]}
+    }}])
+
+
+def add_post_attachments(m: Migrator):
+    m.update_in_batches("posts", {"attachments": {"$exists": False}}, {"$set": {"attachments": []}})
+
+
+def remove_profanity_filter(m: Migrator):
+    db.config.delete_one({"_id": "filter"})
+    m.update_in_batches("posts", {"unfiltered_p": {"$exists": True}}, [
+        {"$set": {"p": "$unfiltered_p"}},
+        {"$unset": "unfiltered_p"}
+    ])
+
+
+def add_mfa_recovery_codes(m: Migrator):
+    for batch in m.iter_batches("usersv0", {
+        "pswd": {"$ne": None},
+        "mfa_recovery_code": {"$exists": False}
+    }, projection={"_id": 1}):
+        # (don't overwrite a recovery code that was created since the batch was read)
+        db.usersv0.bulk_write([pymongo.UpdateOne({"_id": user["_id"], "mfa_recovery_code": {"$exists": False}}, {"$set": {
+            "mfa_recovery_code": secrets.token_hex(5)
+        }}) for user in batch], ordered=False)
+
+
+def add_post_reactions(m: Migrator):
+    m.update_in_batches("posts", {"reactions": {"$exists": False}}, {"$set": {"reactions": []}})
+
+
+def remove_post_type_and_id(m: Migrator):
+    m.update_in_batches("posts", {
+        "$or": [{"type": {"$exists": True}}, {"post_id": {"$exists": True}}]
+    }, {"$unset": {"type": "", "post_id": ""}})
+
+
+def add_post_replies(m: Migrator):
+    m.update_in_batches("posts", {"reply_to": {"$exists": False}}, {"$set": {"reply_to": []}})
+
+
+def fix_mfa_recovery_codes(m: Migrator):
+    m.update_in_batches("usersv0", {
+        "mfa_recovery_code": {"$type": "string"},
+        "$expr": {"$gt": [{"$strLenCP": "$mfa_recovery_code"}, 10]}
+    }, [{"$set": {"mfa_recovery_code": {"$substrCP": ["$mfa_recovery_code", 0, 10]}}}])
+
+
+def delete_system_users(m: Migrator):
+    db.usersv0.delete_many({"_id": {"$in": ["Server", "Deleted", "Meower", "Admin", "username"]}})
+
+
+def add_emails(m: Migrator):
+    m.update_in_batches("usersv0", {"email": {"$exists": False}}, {"$set": {
+        "email": "",
+        "normalized_email_hash": ""
+    }})
+
+
+def add_new_sessions(m: Migrator):
+    # Copy recently used legacy tokens to Redis (one pipeline per batch), then remove them from the user
+    for batch in m.iter_batches("usersv0", {"tokens": {"$exists": True}}, projection={"_id": 1, "tokens": 1, "last_seen": 1}):
+        cutoff = int(time.time())-LEGACY_TOKEN_MAX_AGE
+        pipeline = rdb.pipeline(transaction=False)
+        for user in batch:
+            if user.get("last_seen") and user["last_seen"] > cutoff and user["tokens"]:
+                for token in user["tokens"]:
+                    pipeline.set(
+                        urlsafe_b64encode(sha256(token.encode()).digest()),
+                        user["_id"],
+                        ex=LEGACY_TOKEN_MAX_AGE
+                    )
+        pipeline.execute()
+        db.usersv0.update_many({"_id": {"$in": [user["_id"] for user in batch]}}, {"$unset": {"tokens": ""}})
+    try: db.usersv0.drop_index("tokens")
+    except: pass
+
+
+def remove_netinfo_and_netlog(m: Migrator):
+    db.netinfo.drop()
+    db.netlog.drop()
+
+
+# (version, name, step), in the order they run
+MIGRATIONS: list[tuple[int, str, Callable[[Migrator], None]]] = [
+    (10, "add_pinned_posts", add_pinned_posts),
+    (10, "add_chat_pinning_perm", add_chat_pinning_perm),
+    (10, "remove_experiments", remove_experiments),
+    (10, "add_custom_pfps", add_custom_pfps),
+    (10, "add_chat_icons", add_chat_icons),
+    (10, "add_post_attachments", add_post_attachments),
+    (10, "remove_profanity_filter", remove_profanity_filter),
+    (10, "add_mfa_recovery_codes", add_mfa_recovery_codes),
+    (10, "add_post_reactions", add_post_reactions),
+    (10, "remove_post_type_and_id", remove_post_type_and_id),
+    (10, "add_post_replies", add_post_replies),
+    (10, "fix_mfa_recovery_codes", fix_mfa_recovery_codes),
+    (10, "delete_system_users", delete_system_users),
+    (10, "add_emails", add_emails),
+    (10, "add_new_sessions", add_new_sessions),
+    (10, "remove_netinfo_and_netlog", remove_netinfo_and_netlog)
+]
+
+migrator = Migrator()
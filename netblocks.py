@@ -0,0 +1,253 @@
+from threading import Thread, Event, Lock
+from typing import Optional, Literal
+from radix import Radix
+import os, time, msgpack
+
+from database import db, rdb
+from utils import log
+import errors
+
+"""
+Meower Netblocks Module
+This module keeps the netblock Radix trees in sync across every server process.
+
+Changes are written to the database, then broadcast as incremental add/remove ops over the "admin"
+pub/sub channel (handled in Supporter.listen_for_admin_pubsub) with a cluster-wide version number.
+A process that notices a gap in the version numbers (a missed op) resyncs its trees from the database.
+A snapshot of the trees can be saved to a file (NETBLOCK_SNAPSHOT) so processes can start without
+scanning the netblock collection, as long as the snapshot version is still current.
+
+The trees load in the background on import (retrying with backoff if loading fails). Checks don't wait for them,
+they raise NetblocksNotLoaded until the trees are loaded, so callers can reject the request instead of failing open.
+"""
+
+NETBLOCK_TYPES = Literal[
+    0,  # blocked from everything
+    1,  # blocked from registering
+]
+VERSION_KEY = "netblocks:version"
+SNAPSHOT_PATH = os.getenv("NETBLOCK_SNAPSHOT")
+LOAD_RETRY_MIN = 1  # seconds
+LOAD_RETRY_MAX = 60  # seconds
+
+blocked_ips = Radix()
+registration_blocked_ips = Radix()
+version: int = 0
+loaded = Event()
+_lock = Lock()
+
+
+def _trees() -> tuple[Radix, Radix]:
+    return blocked_ips, registration_blocked_ips
+
+
+def _add_local(cidr: str, netblock_type: NETBLOCK_TYPES) -> str:
+    with _lock:
+        _remove_local(cidr)
+        return _trees()[netblock_type].add(cidr).prefix
+
+
+def _remove_local(cidr: str):
+    for tree in _trees():
+        if tree.search_exact(cidr):
+            tree.delete(cidr)
+
+
+def _get_cluster_version() -> int:
+    cluster_version = rdb.get(VERSION_KEY)
+    return int(cluster_version) if cluster_version else 0
+
+
+def _load_snapshot(cluster_version: int) -> bool:
+    global version
+    if not (SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH)):
+        return False
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            snapshot = msgpack.unpackb(f.read())
+    except Exception as e:
+        log(f"Unable to read netblock snapshot: {e}")
+        return False
+    if snapshot["version"] != cluster_version:
+        return False
+
+    for netblock_type, tree in enumerate(_trees()):
+        for prefix in snapshot["trees"][netblock_type]:
+            tree.add(prefix)
+    version = snapshot["version"]
+    return True
+
+
+def save_snapshot():
+    if not SNAPSHOT_PATH:
+        return
+    with _lock:
+        snapshot = msgpack.packb({
+            "version": version,
+            "saved_at": int(time.time()),
+            "trees": [tree.prefixes() for tree in _trees()]
+        })
+
+    # Write to a temporary file first so a crash can't leave a partial snapshot behind
+    # (one per process, as every process on the host shares the snapshot)
+    tmp_path = f"{SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, SNAPSHOT_PATH)
+    except Exception as e:
+        log(f"Unable to save netblock snapshot: {e}")
+
+
+def resync():
+    # Make the trees match the database, without emptying them first (lookups don't take the lock)
+    global version
+    cluster_version = _get_cluster_version()
+    netblocks = {netblock["_id"]: netblock["type"] for netblock in db.netblock.find({}, projection={"_id": 1, "type": 1})}
+    with _lock:
+        for netblock_type, tree in enumerate(_trees()):
+            for prefix in tree.prefixes():
+                if netblocks.get(prefix) != netblock_type:
+                    tree.delete(prefix)
+        for prefix, netblock_type in netblocks.items():
+            try:
+                if not _trees()[netblock_type].search_exact(prefix):
+                    _trees()[netblock_type].add(prefix)
+            except Exception as e:
+                log(f"Failed to load netblock {prefix}: {e}")
+        version = cluster_version
+
+
+def load():
+    # Try loading from snapshot
+    if _load_snapshot(_get_cluster_version()):
+        log(f"Loaded netblocks from snapshot (version {version})")
+    else:
+        # Load from database
+        resync()
+        save_snapshot()
+
+    log(f"Successfully loaded {len(blocked_ips.nodes())} netblock(s) into Radix!")
+    log(f"Successfully loaded {len(registration_blocked_ips.nodes())} registration netblock(s) into Radix!")
+
+
+def _load_in_background():
+    retry_delay = LOAD_RETRY_MIN
+    while True:
+        try:
+            load()
+        except Exception as e:
+            log(f"Failed to load netblocks, retrying in {retry_delay}s! Error: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay*2, LOAD_RETRY_MAX)
+        else:
+            loaded.set()
+            return
+
+
+def _publish(op: dict):
+    global version
+    op["version"] = rdb.incr(VERSION_KEY)
+
+    # The op was already applied locally, so skip it when it comes back over pub/sub
+    # (unless ops from other processes came in between, those have to be applied first)
+    with _lock:
+        advanced = op["version"] == version+1
+        if advanced:
+            version = op["version"]
+
+    rdb.publish("admin", msgpack.packb({"op": "netblock_update", **op}))
+    if advanced:
+        save_snapshot()
+
+
+def add_netblock(cidr: str, netblock_type: NETBLOCK_TYPES) -> dict:
+    # Normalize prefix with Radix
+    prefix = _add_local(cidr, netblock_type)
+
+    # Add netblock to database
+    netblock = {
+        "_id": prefix,
+        "type": netblock_type,
+        "created": int(time.time())
+    }
+    db.netblock.update_one({"_id": prefix}, {"$set": netblock}, upsert=True)
+
+    # Broadcast to other processes
+    _publish({"action": "add", "cidr": prefix, "type": netblock_type})
+
+    return netblock
+
+
+def remove_netblock(cidr: str):
+    # Remove from database
+    db.netblock.delete_one({"_id": cidr})
+
+    # Remove from Radix
+    with _lock:
+        _remove_local(cidr)
+
+    # Broadcast to other processes
+    _publish({"action": "remove", "cidr": cidr})
+
+
+def apply_update(op: dict):
+    global version
+
+    # Skip ops that are already applied (including ones published by this process, see _publish)
+    if op["version"] <= version:
+        return
+
+    # Resync if an op was missed, applying this one on its own would leave the trees stale
+    if op["version"] != version+1:
+        log(f"Missed netblock updates (at version {version}, got {op['version']}), resyncing from the database")
+        resync()
+    else:
+        match op["action"]:
+            case "add":
+                _add_local(op["cidr"], op["type"])
+            case "remove":
+                with _lock:
+                    _remove_local(op["cidr"])
+        version = op["version"]
+
+    save_snapshot()
+
+
+def is_blocked(ip: str) -> bool:
+    if not loaded.is_set():
+        raise errors.NetblocksNotLoaded
+    try:
+        return blocked_ips.search_best(ip) is not None
+    except ValueError:
+        return False
+
+
+def is_registration_blocked(ip: str) -> bool:
+    if not loaded.is_set():
+        raise errors.NetblocksNotLoaded
+    try:
+        return registration_blocked_ips.search_best(ip) is not None
+    except ValueError:
+        return False
+
+
+def lookup_many(ips: list[str]) -> dict[str, Optional[dict[str, Optional[str]]]]:
+    if not loaded.is_set():
+        raise errors.NetblocksNotLoaded
+    results = {}
+    for ip in ips:
+        try:
+            blocked = blocked_ips.search_best(ip)
+            registration_blocked = registration_blocked_ips.search_best(ip)
+        except ValueError:
+            results[ip] = None
+            continue
+        results[ip] = {
+            "blocked": (blocked.prefix if blocked else None),
+            "registration_blocked": (registration_blocked.prefix if registration_blocked else None)
+        }
+    return results
+
+
+Thread(target=_load_in_background, daemon=True).start()
@@ -0,0 +1,273 @@
+from threading import Thread, Condition, Lock
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr
+from typing import Optional
+from datetime import datetime, timezone
+import time, os, uuid, smtplib, pymongo
+
+from database import db
+from utils import log
+
+"""
+Meower Email Outbox Module
+This module durably queues outgoing emails in the database and delivers them
+through a small pool of persistent SMTP connections, with retries and backoff.
+
+Workers claim emails in batches, and renew each email's lease right before sending it (skipping it if another
+worker took it over in the meantime). Bodies can hold live tokens, so they're only kept until an email is sent or
+fails for good, and failed emails expire from the outbox after 7 days (the failed_emails TTL index).
+"""
+
+OUTBOX_WORKERS = int(os.getenv("EMAIL_OUTBOX_WORKERS", 2))
+OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 10))
+OUTBOX_POLL_INTERVAL = 5  # seconds between checking for emails queued by other processes/retries
+SMTP_TIMEOUT = 30  # seconds, per socket operation
+OUTBOX_LEASE_SECONDS = SMTP_TIMEOUT * 10  # how long a worker owns an email before another worker can take it (renewed per send)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF_BASE = 30
+OUTBOX_BACKOFF_MAX = 3600
+SMTP_IDLE_TIMEOUT = 60  # seconds before an idle connection gets checked with NOOP
+
+
+class OutboxStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.queued: int = 0
+        self.sent: int = 0
+        self.retried: int = 0
+        self.failed: int = 0
+        self.connections_opened: int = 0
+        self.last_send_ms: float = 0.0
+        self.max_send_ms: float = 0.0
+
+    def incr(self, key: str, amount: int = 1):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + amount)
+
+    def record_send(self, ms: float):
+        with self._lock:
+            self.sent += 1
+            self.last_send_ms = ms
+            self.max_send_ms = max(self.max_send_ms, ms)
+
+
+stats = OutboxStats()
+_wakeup = Condition()
+
+
+def enqueue(subject: str, to_name: str, to_address: str, txt_tmpl: str, html_tmpl: str) -> str:
+    email_id = str(uuid.uuid4())
+    db.email_outbox.insert_one({
+        "_id": email_id,
+        "subject": subject,
+        "to_name": to_name,
+        "to_address": to_address,
+        "txt": txt_tmpl,
+        "html": html_tmpl,
+        "status": "pending",
+        "attempts": 0,
+        "available_at": int(time.time()),
+        "created_at": int(time.time()),
+        "last_error": None
+    })
+    stats.incr("queued")
+
+    # Wake up a local worker
+    with _wakeup:
+        _wakeup.notify()
+
+    return email_id
+
+
+def build_message(email: dict) -> MIMEMultipart:
+    message = MIMEMultipart("alternative")
+    message["From"] = formataddr((os.environ["EMAIL_FROM_NAME"], os.environ["EMAIL_FROM_ADDRESS"]))
+    message["To"] = formataddr((email["to_name"], email["to_address"]))
+    message["Subject"] = email["subject"]
+    message.attach(MIMEText(email["txt"], "plain"))
+    message.attach(MIMEText(email["html"], "html"))
+    return message
+
+
+class SMTPConnection:
+    def __init__(self):
+        self.server: Optional[smtplib.SMTP] = None
+        self.last_used: float = 0
+
+    def connect(self):
+        self.close()
+        self.server = smtplib.SMTP(os.environ["EMAIL_SMTP_HOST"], int(os.environ["EMAIL_SMTP_PORT"]), timeout=SMTP_TIMEOUT)
+        if os.getenv("EMAIL_SMTP_TLS"):
+            self.server.starttls()
+        if os.getenv("EMAIL_SMTP_USERNAME"):  # local stand-ins usually don't need auth
+            self.server.login(os.environ["EMAIL_SMTP_USERNAME"], os.environ["EMAIL_SMTP_PASSWORD"])
+        stats.incr("connections_opened")
+
+    def ensure_connected(self):
+        if not self.server:
+            return self.connect()
+
+        # Make sure idle connections haven't been dropped by the server
+        if time.time() - self.last_used > SMTP_IDLE_TIMEOUT:
+            try:
+                status, _ = self.server.noop()
+                if status != 250:
+                    self.connect()
+            except smtplib.SMTPException:
+                self.connect()
+
+    def send(self, email: dict):
+        self.ensure_connected()
+        try:
+            self.server.sendmail(os.environ["EMAIL_FROM_ADDRESS"], email["to_address"], build_message(email).as_string())
+        except smtplib.SMTPServerDisconnected:
+            # Reconnect once, the server may have closed the connection since the last check
+            self.connect()
+            self.server.sendmail(os.environ["EMAIL_FROM_ADDRESS"], email["to_address"], build_message(email).as_string())
+        self.last_used = time.time()
+
+    def close(self):
+        if self.server:
+            try:
+                self.server.quit()
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self.server = None
+
+
+def claim_batch(limit: int) -> list[dict]:
+    emails = []
+    while len(emails) < limit:
+        now = int(time.time())
+        email = db.email_outbox.find_one_and_update(
+            {"status": "pending", "available_at": {"$lte": now}},
+            {"$set": {"available_at": now+OUTBOX_LEASE_SECONDS}, "$inc": {"attempts": 1}},
+            sort=[("available_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if not email:
+            break
+        emails.append(email)
+    return emails
+
+
+def renew_lease(email: dict) -> bool:
+    # Returns False if the lease expired and another worker claimed the email
+    available_at = int(time.time())+OUTBOX_LEASE_SECONDS
+    result = db.email_outbox.update_one({
+        "_id": email["_id"],
+        "status": "pending",
+        "available_at": email["available_at"]
+    }, {"$set": {"available_at": available_at}})
+    if not result.matched_count:
+        return False
+    email["available_at"] = available_at
+    return True
+
+
+def is_permanent_failure(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 500 <= e.smtp_code < 600
+    return False
+
+
+def handle_failure(email: dict, e: Exception):
+    if is_permanent_failure(e) or email["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        db.email_outbox.update_one({"_id": email["_id"]}, {"$set": {
+            "status": "failed",
+            "failed_at": datetime.now(timezone.utc),  # a date, for the TTL index
+            "last_error": str(e)
+        }, "$unset": {"txt": "", "html": ""}})
+        stats.incr("failed")
+        log(f"Giving up on email {email['_id']} after {email['attempts']} attempts: {e}")
+    else:
+        backoff = min(OUTBOX_BACKOFF_BASE * (2 ** (email["attempts"]-1)), OUTBOX_BACKOFF_MAX)
+        db.email_outbox.update_one({"_id": email["_id"]}, {"$set": {
+            "available_at": int(time.time())+backoff,
+            "last_error": str(e)
+        }})
+        stats.incr("retried")
+
+
+def worker():
+    conn = SMTPConnection()
+    unremoved: list[str] = []  # IDs of sent emails that couldn't be removed from the outbox yet
+    while True:
+        # Retry removing sent emails, before their lease expires and they get sent again
+        while unremoved:
+            try:
+                db.email_outbox.delete_one({"_id": unremoved[0]})
+            except Exception as e:
+                log(f"Unable to remove sent email {unremoved[0]} from outbox: {e}")
+                break
+            unremoved.pop(0)
+
+        try:
+            emails = claim_batch(OUTBOX_BATCH_SIZE)
+        except Exception as e:
+            log(f"Unable to claim emails from outbox: {e}")
+            emails = []
+
+        if not emails:
+            # Close idle connection and wait for more emails
+            if conn.server and time.time() - conn.last_used > SMTP_IDLE_TIMEOUT:
+                conn.close()
+            with _wakeup:
+                _wakeup.wait(timeout=OUTBOX_POLL_INTERVAL)
+            continue
+
+        # Send the whole batch over the same connection
+        for email in emails:
+            try:
+                if not renew_lease(email):
+                    continue
+            except Exception as e:
+                log(f"Unable to renew lease on email {email['_id']}: {e}")
+                continue
+
+            started_at = time.perf_counter()
+            try:
+                conn.send(email)
+            except Exception as e:
+                if not is_permanent_failure(e):
+                    conn.close()
+                try:
+                    handle_failure(email, e)
+                except Exception as e:  # the email gets retried once its lease expires
+                    log(f"Unable to record failure of email {email['_id']}: {e}")
+            else:
+                stats.record_send((time.perf_counter() - started_at) * 1000)
+                try:
+                    db.email_outbox.delete_one({"_id": email["_id"]})
+                except Exception as e:
+                    log(f"Unable to remove sent email {email['_id']} from outbox: {e}")
+                    unremoved.append(email["_id"])
+
+
+def start():
+    if not os.getenv("EMAIL_SMTP_HOST"):
+        log("EMAIL_SMTP_HOST is not set, emails will stay queued in the outbox")
+        return
+
+    for _ in range(OUTBOX_WORKERS):
+        Thread(target=worker, daemon=True).start()
+
+
+def get_stats() -> dict:
+    return {
+        "pending": db.email_outbox.count_documents({"status": "pending"}),
+        "failed_total": db.email_outbox.count_documents({"status": "failed"}),
+        "workers": OUTBOX_WORKERS,
+        "queued": stats.queued,
+        "sent": stats.sent,
+        "retried": stats.retried,
+        "failed": stats.failed,
+        "connections_opened": stats.connections_opened,
+        "last_send_ms": round(stats.last_send_ms, 3),
+        "max_send_ms": round(stats.max_send_ms, 3)
+    }
@@ -10,9 +10,13 @@ from .v0 import v0
 
 from .admin import admin_bp
 
-from database import db, blocked_ips, registration_blocked_ips
+from database import db
+import netblocks
 from sessions import AccSession
+from metrics import query_stats, http_requests, http_request_duration
+from loop_monitor import api_monitor
 import security
+import errors
 
 
 # Init app
@@ -23,11 +27,33 @@ cors(app, allow_origin="*")
 QuartSchema(app)
 
 
+@app.before_serving
+async def start_loop_monitor():
+    api_monitor.start()
+
+
 class TokenHeader(BaseModel):
     token: str | None = None
     username: str | None = None
 
 
+@app.before_request
+async def start_request_metrics():
+    # Attribute database queries to the matched route
+    request.route = request.url_rule.rule if request.url_rule else "unmatched"
+    request.started_at = time.perf_counter()
+    request.query_tally_token = query_stats.start(f"{request.method} {request.route}")
+
+
+@app.after_request
+async def finish_request_metrics(response):
+    if hasattr(request, "query_tally_token"):
+        http_request_duration.labels(request.method, request.route).observe(time.perf_counter()-request.started_at)
+        http_requests.labels(request.method, request.route, str(response.status_code)).inc()
+        query_stats.finish(request.query_tally_token)
+    return response
+
+
 @app.before_request
 async def check_repair_mode():
     if app.supporter.repair_mode and request.path != "/status":
@@ -118,8 +144,8 @@ async def get_status():
         "scratchDeprecated": True,
         "registrationEnabled": app.supporter.registration,
         "isRepairMode": app.supporter.repair_mode,
-        "ipBlocked": (blocked_ips.search_best(request.ip) is not None),
-        "ipRegistrationBlocked": (registration_blocked_ips.search_best(request.ip) is not None)
+        "ipBlocked": netblocks.is_blocked(request.ip),
+        "ipRegistrationBlocked": netblocks.is_registration_blocked(request.ip)
     }, 200
 
 
@@ -166,6 +192,11 @@ async def validation_error(e):
     return {"error": True, "type": "badRequest"}, 400
 
 
+@app.errorhandler(errors.NetblocksNotLoaded)  # IP checks aren't possible yet
+async def netblocks_not_loaded(e):
+    return {"error": True, "type": "netblocksNotLoaded"}, 503, {"Retry-After": str(netblocks.LOAD_RETRY_MIN)}
+
+
 @app.errorhandler(400)  # Bad request
 async def bad_request(e):
     return {"error": True, "type": "badRequest"}, 400
@@ -7,8 +7,13 @@ from copy import copy
 import time, pymongo
 
 import security
-from database import db, get_total_pages, blocked_ips, registration_blocked_ips
+from database import db, get_total_pages, index_status
+from netblocks import blocked_ips, registration_blocked_ips
+import netblocks
 from sessions import AccSession
+from write_behind import write_behind
+from metrics import query_stats
+import outbox, search_index, loop_monitor, migrations
 
 
 admin_bp = Blueprint("admin_bp", __name__, url_prefix="/admin")
@@ -101,6 +106,12 @@ class NetblockBody(BaseModel):
     class Config:
         validate_assignment = True
 
+class NetblockLookupBody(BaseModel):
+    ips: list[str] = Field(min_length=1, max_length=1000)
+
+    class Config:
+        validate_assignment = True
+
 class GetAnnouncementsQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
 
@@ -394,6 +405,10 @@ async def delete_post(post_id):
         },
     )
 
+    # Update search index
+    if post["post_origin"] == "home":
+        search_index.publish_remove(post_id)
+
     # Send delete post event
     if post["post_origin"] == "home" or (post["post_origin"] == "inbox" and post["u"] == "Server"):
         app.cl.send_event("delete_post", {
@@ -406,16 +421,10 @@ async def delete_post(post_id):
             "post_id": post_id
         }, usernames=[post["u"]])
     else:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, projection={"members": 1})
-        if chat:
-            app.cl.send_event("delete_post", {
-                "chat_id": post["post_origin"],
-                "post_id": post_id
-            }, usernames=chat["members"])
+        app.cl.send_event("delete_post", {
+            "chat_id": post["post_origin"],
+            "post_id": post_id
+        }, chat_id=post["post_origin"])
 
     # Return updated post
     post["error"] = False
@@ -449,6 +458,10 @@ async def restore_post(post_id):
         {"$set": {"isDeleted": False}, "$unset": {"deleted_at": "", "mod_deleted": ""}},
     )
 
+    # Update search index
+    if post["post_origin"] == "home":
+        search_index.publish_add(post)
+
     # Return updated post
     post["error"] = False
     return app.supporter.parse_posts_v0(
@@ -490,8 +503,8 @@ async def get_user(username):
         "created": account["created"],
         "uuid": account["uuid"],
         "pfp_data": account["pfp_data"],
-        "avatar": account["avatar"],
-        "avatar_color": account["avatar_color"],
+        "avatar": account.get("avatar", ""),
+        "avatar_color": account.get("avatar_color", "000000"),
         "quote": account["quote"],
         "flags": account["flags"],
         "permissions": account["permissions"],
@@ -505,21 +518,23 @@ async def get_user(username):
     ):
         # Add user settings or unread inbox state
         if security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
-            payload.update({"settings": security.DEFAULT_USER_SETTINGS})
+            payload.update({"settings": security.DEFAULT_USER_SETTINGS.copy()})
             user_settings = db.user_settings.find_one({"_id": username})
             if user_settings:
                 del user_settings["_id"]
                 payload["settings"].update(user_settings)
+            security.resolve_unread_inbox(payload["settings"])
         elif security.has_permission(request.permissions, security.AdminPermissions.VIEW_POSTS):
             payload.update(
                 {"settings": {"unread_inbox": security.DEFAULT_USER_SETTINGS["unread_inbox"]}}
             )
             user_settings = db.user_settings.find_one(
-                {"_id": username}, projection={"unread_inbox": 1}
+                {"_id": username}, projection={"unread_inbox": 1, "inbox_read_epoch": 1}
             )
             if user_settings:
                 del user_settings["_id"]
                 payload["settings"].update(user_settings)
+            security.resolve_unread_inbox(payload["settings"])
 
         # Add ban state
         if security.has_permission(
@@ -954,7 +969,7 @@ async def update_chat(chat_id, data: UpdateChatBody):
         updated_vals["nickname"] = data.nickname
     if data.icon == "":
         updated_vals["icon"] = data.icon
-    if data.icon_color is not None and chat["icon_color"] != data.icon_color:
+    if data.icon_color is not None and chat.get("icon_color", "000000") != data.icon_color:
         updated_vals["icon_color"] = data.icon_color
     if data.allow_pinning is not None:
         updated_vals["allow_pinning"] = data.allow_pinning
@@ -1148,6 +1163,21 @@ async def get_netblocks(query_args: GetNetblocksQueryArgs):
     }, 200
 
 
+@admin_bp.post("/netblocks/lookup")
+@validate_request(NetblockLookupBody)
+async def lookup_netblocks(data: NetblockLookupBody):
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.VIEW_IPS):
+        abort(401)
+
+    # Return matching netblocks for each IP (null for invalid IPs)
+    return {
+        "error": False,
+        "version": netblocks.version,
+        "results": netblocks.lookup_many(data.ips)
+    }, 200
+
+
 @admin_bp.get("/netblocks/<cidr>")
 async def get_netblock(cidr):
     # Check permissions
@@ -1182,38 +1212,8 @@ async def create_netblock(cidr, data: NetblockBody):
     # b64 decode CIDR
     cidr = b64decode(cidr.encode()).decode()
 
-    # Construct netblock obj
-    netblock = {
-        "_id": cidr,
-        "type": data.type,
-        "created": int(time.time())
-    }
-
-    # Remove from Radix
-    if blocked_ips.search_exact(cidr):
-        blocked_ips.delete(cidr)
-    if registration_blocked_ips.search_exact(cidr):
-        registration_blocked_ips.delete(cidr)
-
-    # Add to Radix
-    if data.type == 0:
-        radix_node = blocked_ips.add(cidr)
-    elif data.type == 1:
-        radix_node = registration_blocked_ips.add(cidr)
-
-    # Modify netblock with new Radix node prefix
-    netblock["_id"] = radix_node.prefix
-
-    # Add netblock to database
-    db.netblock.update_one(
-        {"_id": netblock["_id"]}, {"$set": netblock}, upsert=True
-    )
-
-    # Kick clients
-    if data.type == 0:
-        for client in copy(app.cl.clients):
-            if blocked_ips.search_best(client.ip):
-                await client.websocket.close()
+    # Add netblock (blocked clients get kicked by each server when the update is broadcasted)
+    netblock = netblocks.add_netblock(cidr, data.type)
 
     # Add log
     security.add_audit_log(
@@ -1237,14 +1237,8 @@ async def delete_netblock(cidr):
     # b64 decode CIDR
     cidr = b64decode(cidr.encode()).decode()
 
-    # Remove from database
-    db.netblock.delete_one({"_id": cidr})
-
-    # Remove from Radix
-    if blocked_ips.search_exact(cidr):
-        blocked_ips.delete(cidr)
-    if registration_blocked_ips.search_exact(cidr):
-        registration_blocked_ips.delete(cidr)
+    # Remove netblock
+    netblocks.remove_netblock(cidr)
 
     # Add log
     security.add_audit_log(
@@ -1323,6 +1317,96 @@ async def kick_all_clients():
     return {"error": False}, 200
 
 
+@admin_bp.get("/server/send-queues")
+async def get_send_queues():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return Cloudlink send queue stats
+    return {"error": False, **app.cl.get_send_queue_stats()}, 200
+
+
+@admin_bp.get("/server/commands")
+async def get_command_stats():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return Cloudlink command latency stats
+    return {"error": False, "commands": app.cl.get_command_stats()}, 200
+
+
+@admin_bp.get("/server/write-behind")
+async def get_write_behind_stats():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return write-behind queue stats
+    return {"error": False, **write_behind.get_stats()}, 200
+
+
+@admin_bp.get("/server/email-outbox")
+async def get_email_outbox_stats():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return email outbox stats
+    return {"error": False, **outbox.get_stats()}, 200
+
+
+@admin_bp.get("/server/query-metrics")
+async def get_query_metrics():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return per-route and per-command query stats
+    return {"error": False, **query_stats.get_stats()}, 200
+
+
+@admin_bp.get("/server/loop-lag")
+async def get_loop_lag():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return event loop lag and recent stalls
+    return {"error": False, **loop_monitor.get_stats()}, 200
+
+
+@admin_bp.get("/server/indexes")
+async def get_indexes():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return database index build status
+    return {"error": False, **index_status}, 200
+
+
+@admin_bp.get("/server/migrations")
+async def get_migrations():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return database migration progress
+    return {"error": False, **migrations.migrator.get_stats()}, 200
+
+
+@admin_bp.get("/server/search-index")
+async def get_search_index_stats():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Return home search index stats
+    return {"error": False, **search_index.home_index.get_stats()}, 200
+
+
 @admin_bp.post("/server/enable-repair-mode")
 async def enable_repair_mode():
     # Check permissions
@@ -1,4 +1,4 @@
-import re, os, requests, pyotp, secrets, time
+import re, pyotp, secrets, time, asyncio
 from pydantic import BaseModel
 from quart import Blueprint, request, abort, current_app as app
 from quart_schema import validate_request
@@ -6,11 +6,11 @@ from pydantic import Field
 from typing import Optional
 from base64 import urlsafe_b64encode
 from hashlib import sha256
-from threading import Thread
 
-from database import db, rdb, blocked_ips, registration_blocked_ips
+from database import db, rdb
+import netblocks
 from sessions import AccSession, EmailTicket
-import security
+import security, captcha, migrations
 
 auth_bp = Blueprint("auth_bp", __name__, url_prefix="/auth")
 
@@ -28,7 +28,7 @@ class RecoverAccountBody(BaseModel):
 
 @auth_bp.before_request
 async def ip_block_check():
-    if blocked_ips.search_best(request.ip):
+    if netblocks.is_blocked(request.ip):
         return {"error": True, "type": "ipBlocked"}, 403
 
 
@@ -77,6 +77,17 @@ async def login(data: AuthRequest):
                 request.headers.get("User-Agent")
             ).token
             rdb.delete(encoded_token)
+        elif migrations.in_progress() and db.usersv0.count_documents({
+            "_id": account["_id"],
+            "tokens": data.password,
+            "last_seen": {"$gt": int(time.time())-migrations.LEGACY_TOKEN_MAX_AGE}
+        }, limit=1):  # not copied to Redis by the migration yet (it only copies tokens of recently seen users)
+            db.usersv0.update_one({"_id": account["_id"]}, {"$pull": {"tokens": data.password}})
+            data.password = AccSession.create(
+                account["_id"],
+                request.ip,
+                request.headers.get("User-Agent")
+            ).token
 
     # Check credentials & get session
     try:  # token for already existing session
@@ -88,7 +99,7 @@ async def login(data: AuthRequest):
 
         # Maybe they put their MFA credentials at the end of their password?
         if (not password_valid) and db.authenticators.count_documents({"user": account["_id"]}, limit=1):
-            if (not data.mfa_recovery_code) and data.password.endswith(account["mfa_recovery_code"]):
+            if (not data.mfa_recovery_code) and account.get("mfa_recovery_code") and data.password.endswith(account["mfa_recovery_code"]):
                 try:
                     data.mfa_recovery_code = data.password[-10:]
                     data.password = data.password[:-10]
@@ -134,7 +145,7 @@ async def login(data: AuthRequest):
                     })
                     abort(401)
             elif data.mfa_recovery_code:
-                if data.mfa_recovery_code == account["mfa_recovery_code"]:
+                if data.mfa_recovery_code == account.get("mfa_recovery_code"):
                     db.authenticators.delete_many({"user": account["_id"]})
 
                     new_recovery_code = secrets.token_hex(5)
@@ -202,25 +213,32 @@ async def register(data: AuthRequest):
         abort(400)
     
     # Make sure IP isn't blocked from creating new accounts
-    if registration_blocked_ips.search_best(request.ip):
+    if netblocks.is_registration_blocked(request.ip):
         security.ratelimit(f"register:{request.ip}:f", 5, 30)
         return {"error": True, "type": "registrationBlocked"}, 403
 
+    # Check whether the username is taken and verify the captcha concurrently
+    username_taken, captcha_passed = await asyncio.gather(
+        asyncio.to_thread(security.account_exists, data.username, ignore_case=True),
+        captcha.verify(data.captcha, request.ip, bypass=getattr(request, "bypass_captcha", False))
+    )
+
     # Make sure username isn't taken
-    if security.account_exists(data.username, ignore_case=True):
+    if username_taken:
         security.ratelimit(f"register:{request.ip}:f", 5, 30)
         return {"error": True, "type": "usernameExists"}, 409
 
     # Check captcha
-    if os.getenv("CAPTCHA_SECRET") and not (hasattr(request, "bypass_captcha") and request.bypass_captcha):
-        if not requests.post("https://api.hcaptcha.com/siteverify", data={
-            "secret": os.getenv("CAPTCHA_SECRET"),
-            "response": data.captcha,
-        }).json()["success"]:
-            return {"error": True, "type": "invalidCaptcha"}, 403
+    if not captcha_passed:
+        return {"error": True, "type": "invalidCaptcha"}, 403
+
+    # Warm the IP info cache (for the VPN check) off the event loop, only once the captcha has passed,
+    # so unsolved attempts don't use up the IP info quota
+    await asyncio.to_thread(security.get_ip_info, request.ip)
 
     # Create account
     security.create_account(data.username, data.password, request.ip)
+    captcha.consume(data.captcha, request.ip)
 
     # Ratelimit
     security.ratelimit(f"register:{request.ip}:s", 5, 900)
@@ -246,12 +264,9 @@ async def recover_account(data: RecoverAccountBody):
     security.ratelimit(f"recover:{request.ip}", 3, 2700)
 
     # Check captcha
-    if os.getenv("CAPTCHA_SECRET") and not (hasattr(request, "bypass_captcha") and request.bypass_captcha):
-        if not requests.post("https://api.hcaptcha.com/siteverify", data={
-            "secret": os.getenv("CAPTCHA_SECRET"),
-            "response": data.captcha,
-        }).json()["success"]:
-            return {"error": True, "type": "invalidCaptcha"}, 403
+    if not await captcha.verify(data.captcha, request.ip, bypass=getattr(request, "bypass_captcha", False)):
+        return {"error": True, "type": "invalidCaptcha"}, 403
+    captcha.consume(data.captcha, request.ip)
 
     # Get account
     account = db.usersv0.find_one({"email": data.email}, projection={"_id": 1, "email": 1, "flags": 1})
@@ -263,9 +278,6 @@ async def recover_account(data: RecoverAccountBody):
 
     # Send email
     txt_tmpl, html_tmpl = security.render_email_tmpl("recover", account["_id"], account["email"], {"token": ticket.token})
-    Thread(
-        target=security.send_email,
-        args=[security.EMAIL_SUBJECTS["recover"], account["_id"], account["email"], txt_tmpl, html_tmpl]
-    ).start()
+    security.send_email(security.EMAIL_SUBJECTS["recover"], account["_id"], account["email"], txt_tmpl, html_tmpl)
 
     return {"error": False}, 200
@@ -4,7 +4,7 @@ from pydantic import BaseModel, Field
 from typing import Optional, Literal
 import pymongo, uuid, time, re, os
 
-import security
+import security, errors
 from database import db, get_total_pages
 from uploads import claim_file, delete_file
 from utils import log
@@ -183,8 +183,8 @@ async def update_chat(chat_id, data: ChatBody):
     updated_vals = {"_id": chat_id}
     if data.nickname is not None and chat["nickname"] != data.nickname:
         updated_vals["nickname"] = data.nickname
-        app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the nickname of the group chat to '{chat['nickname']}'.", chat_members=chat["members"])
-    if data.icon is not None and chat["icon"] != data.icon:
+        app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the nickname of the group chat to '{chat['nickname']}'.")
+    if data.icon is not None and chat.get("icon", "") != data.icon:
         # Claim icon (and delete old one)
         if data.icon != "":
             try:
@@ -192,16 +192,16 @@ async def update_chat(chat_id, data: ChatBody):
             except Exception as e:
                 log(f"Unable to claim icon: {e}")
                 return {"error": True, "type": "unableToClaimIcon"}, 500
-        if chat["icon"]:
+        if chat.get("icon"):
             try:
                 delete_file(chat["icon"])
             except Exception as e:
                 log(f"Unable to delete icon: {e}")
-        app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the icon of the group chat.", chat_members=chat["members"])
-    if data.icon_color is not None and chat["icon_color"] != data.icon_color:
+        app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the icon of the group chat.")
+    if data.icon_color is not None and chat.get("icon_color", "000000") != data.icon_color:
         updated_vals["icon_color"] = data.icon_color
-        if data.icon is None or chat["icon"] == data.icon:
-            app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the icon of the group chat.", chat_members=chat["members"])
+        if data.icon is None or chat.get("icon", "") == data.icon:
+            app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the icon of the group chat.")
     if data.allow_pinning is not None:
         updated_vals["allow_pinning"] = data.allow_pinning
     
@@ -266,9 +266,9 @@ async def leave_chat(chat_id):
             }, usernames=chat["members"])
 
             # Send in-chat notification
-            app.supporter.create_post(chat_id, "Server", f"@{request.user} has left the group chat.", chat_members=chat["members"])
+            app.supporter.create_post(chat_id, "Server", f"@{request.user} has left the group chat.")
         else:
-            if chat["icon"]:
+            if chat.get("icon"):
                 try:
                     delete_file(chat["icon"])
                 except Exception as e:
@@ -286,6 +286,11 @@ async def leave_chat(chat_id):
     # Send delete event to client
     app.cl.send_event("delete_chat", {"chat_id": chat_id}, usernames=[request.user])
 
+    # Hidden DMs stay in the chat index (the requester is still a member),
+    # this runs on the event loop after the delete event removed them
+    if chat["type"] == 1:
+        app.cl.call_soon(app.cl.add_chat_members, chat_id, [request.user])
+
     return {"error": False}, 200
 
 
@@ -295,31 +300,11 @@ async def emit_typing(chat_id):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"typing:{request.user}"):
-        abort(429)
-
-    # Ratelimit
-    security.ratelimit(f"typing:{request.user}", 6, 5)
-
-    # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.CHAT_POSTS):
-        return {"error": True, "type": "accountBanned"}, 403
-
-    # Get chat
-    if chat_id != "livechat":
-        chat = db.chats.find_one({
-            "_id": chat_id,
-            "members": request.user,
-            "deleted": False
-        }, projection={"members": 1})
-        if not chat:
-            abort(404)
-
     # Send typing event
-    app.cl.send_event("typing", {
-        "chat_id": chat_id, "username": request.user
-    }, usernames=(None if chat_id == "livechat" else chat["members"]))
+    try:
+        app.supporter.emit_typing(chat_id, request.user)
+    except errors.APIError as e:
+        return {"error": True, "type": e.type}, e.status
 
     return {"error": False}, 200
 
@@ -389,7 +374,7 @@ async def add_chat_member(chat_id, username):
     app.supporter.create_post("inbox", username, f"You have been added to the group chat '{chat['nickname']}' by @{request.user}!")
 
     # Send in-chat notification
-    app.supporter.create_post(chat_id, "Server", f"@{request.user} added @{username} to the group chat.", chat_members=chat["members"])
+    app.supporter.create_post(chat_id, "Server", f"@{request.user} added @{username} to the group chat.")
 
     # Return chat
     chat.update({
@@ -447,7 +432,7 @@ async def remove_chat_member(chat_id, username):
     app.supporter.create_post("inbox", username, f"You have been removed from the group chat '{chat['nickname']}' by @{request.user}!")
 
     # Send in-chat notification
-    app.supporter.create_post(chat_id, "Server", f"@{request.user} removed @{username} from the group chat.", chat_members=chat["members"])
+    app.supporter.create_post(chat_id, "Server", f"@{request.user} removed @{username} from the group chat.")
 
     # Return chat
     chat.update({
@@ -504,7 +489,7 @@ async def transfer_chat_ownership(chat_id, username):
     }, usernames=chat["members"])
 
     # Send in-chat notification
-    app.supporter.create_post(chat_id, "Server", f"@{request.user} transferred ownership of the group chat to @{username}.", chat_members=chat["members"])
+    app.supporter.create_post(chat_id, "Server", f"@{request.user} transferred ownership of the group chat to @{username}.")
 
     # Return chat
     chat.update({
@@ -680,7 +665,7 @@ async def create_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
     db[f"chat_{emote_type}"].insert_one(emote)
     del emote["created_at"]
     del emote["created_by"]
-    app.cl.send_event(f"create_{emote_type[:-1]}", emote, usernames=chat["members"])
+    app.cl.send_event(f"create_{emote_type[:-1]}", emote, chat_id=chat_id)
 
     # Return new emote
     del emote["chat_id"]
@@ -738,7 +723,7 @@ async def update_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
         "_id": emote_id,
         "chat_id": chat_id,
         "name": data.name
-    }, usernames=chat["members"])
+    }, chat_id=chat_id)
 
     # Return updated emote
     emote["error"] = False
@@ -782,7 +767,7 @@ async def delete_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
     app.cl.send_event(f"delete_{emote_type[:-1]}", {
         "_id": emote_id,
         "chat_id": chat_id
-    }, usernames=chat["members"])
+    }, chat_id=chat_id)
     delete_file(emote_id)
 
     return {"error": False}, 200
@@ -93,7 +93,7 @@ async def recover_account(data: RecoverAccountBody):
     })
 
     # Make sure the ticket email matches the user's current email
-    if ticket.email_address != account["email"]:
+    if ticket.email_address != account.get("email"):
         abort(401)
 
     # Revoke ticket
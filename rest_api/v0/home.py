@@ -2,12 +2,10 @@ from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Optional
-import pymongo, copy
+import pymongo
 
-import security
 from database import db, get_total_pages
-from uploads import claim_file
-from utils import log
+import errors
 
 
 home_bp = Blueprint("home_bp", __name__, url_prefix="/home")
@@ -54,65 +52,20 @@ async def create_home_post(data: PostBody):
     if not request.user:
         abort(401)
 
-    if not (request.flags & security.UserFlags.POST_RATELIMIT_BYPASS):
-        # Check ratelimit
-        if security.ratelimited(f"post:{request.user}"):
-            abort(429)
-
-        # Ratelimit
-        security.ratelimit(f"post:{request.user}", 6, 5)
-
-    # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.HOME_POSTS):
-        return {"error": True, "type": "accountBanned"}, 403
-
-    # Make sure there's not too many attachments
-    if len(data.attachments) > 10:
-        return {"error": True, "type": "tooManyAttachments"}, 400
-
-    # Make sure the post isn't replying to too many posts
-    if len(data.reply_to) > 10:
-        return {"error": True, "type": "tooManyReplies"}, 400
-    
-    # Make sure there's not too many stickers
-    if len(data.stickers) > 10:
-        return {"error": True, "type": "tooManyStickers"}, 400
-    
-    # Make sure stickers exist
-    for sticker_id in copy.copy(data.stickers):
-        if not db.chat_stickers.count_documents({"_id": sticker_id}, limit=1):
-            data.stickers.remove(sticker_id)
-
-    # Make sure replied to post IDs exist and are unique
-    unique_reply_to_post_ids = []
-    for post_id in data.reply_to:
-        if db.posts.count_documents({"_id": post_id, "post_origin": "home"}, limit=1) and \
-            post_id not in unique_reply_to_post_ids:
-            unique_reply_to_post_ids.append(post_id)
-
-    # Claim attachments
-    attachments = []
-    for attachment_id in set(data.attachments):
-        try:
-            attachments.append(claim_file(attachment_id, "attachments"))
-        except Exception as e:
-            log(f"Unable to claim attachment: {e}")
-            return {"error": True, "type": "unableToClaimAttachment"}, 500
-
-    # Make sure the post has text content or at least 1 attachment or at least 1 sticker
-    if not data.content and not attachments and not data.stickers:
-        abort(400)
-
     # Create post
-    post = app.supporter.create_post(
-        "home",
-        request.user,
-        data.content,
-        attachments=attachments,
-        stickers=data.stickers,
-        nonce=data.nonce,
-        reply_to=unique_reply_to_post_ids
-    )
+    try:
+        post = app.supporter.submit_post(
+            "home",
+            request.user,
+            request.flags,
+            data.content,
+            attachment_ids=data.attachments,
+            sticker_ids=data.stickers,
+            reply_to_ids=data.reply_to,
+            nonce=data.nonce
+        )
+    except errors.APIError as e:
+        return {"error": True, "type": e.type}, e.status
 
     # Return new post
     post["error"] = False
@@ -125,18 +78,10 @@ async def emit_typing():
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"typing:{request.user}"):
-        abort(429)
-
-    # Ratelimit
-    security.ratelimit(f"typing:{request.user}", 6, 5)
-
-    # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.HOME_POSTS):
-        return {"error": True, "type": "accountBanned"}, 403
-
     # Send new state
-    app.cl.send_event("typing", {"chat_id": "home", "username": request.user})
+    try:
+        app.supporter.emit_typing("home", request.user)
+    except errors.APIError as e:
+        return {"error": True, "type": e.type}, e.status
 
     return {"error": False}, 200
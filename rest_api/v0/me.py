@@ -5,7 +5,6 @@ from typing import Optional, List, Literal
 from copy import copy
 from base64 import urlsafe_b64encode
 from hashlib import sha256
-from threading import Thread
 import pymongo
 import uuid
 import time
@@ -14,13 +13,13 @@ import qrcode, qrcode.image.svg
 import uuid
 import secrets
 import os
-import requests
 
-import security
+import security, captcha
 from database import db, rdb, get_total_pages
 from uploads import claim_file, delete_file
 from sessions import AccSession, EmailTicket
 from utils import log
+from write_behind import write_behind
 
 
 me_bp = Blueprint("me_bp", __name__, url_prefix="/me")
@@ -87,8 +86,8 @@ async def get_me():
     if not request.user:
         abort(401)
 
-    # Update last_seen (this is only to remove CL3's dependency on the DB)
-    db.usersv0.update_one({"_id": request.user}, {"$set": {"last_seen": int(time.time())}})
+    # Update last_seen
+    write_behind.touch_last_seen(request.user)
 
     # Get and return account
     return {"error": False, **security.get_account(request.user, include_config=True)}, 200
@@ -158,7 +157,7 @@ async def update_config(data: UpdateConfigBody):
 
     # Claim avatar (and delete old one)
     if "avatar" in new_config:
-        cur_avatar = db.usersv0.find_one({"_id": request.user}, projection={"avatar": 1})["avatar"]
+        cur_avatar = db.usersv0.find_one({"_id": request.user}, projection={"avatar": 1}).get("avatar", "")
         if new_config["avatar"] != "":
             try:
                 claim_file(new_config["avatar"], "icons")
@@ -240,12 +239,9 @@ async def update_email(data: UpdateEmailBody):
     security.ratelimit(f"emailch:{request.user}", 3, 2700)
 
     # Check captcha
-    if os.getenv("CAPTCHA_SECRET") and not (hasattr(request, "bypass_captcha") and request.bypass_captcha):
-        if not requests.post("https://api.hcaptcha.com/siteverify", data={
-            "secret": os.getenv("CAPTCHA_SECRET"),
-            "response": data.captcha,
-        }).json()["success"]:
-            return {"error": True, "type": "invalidCaptcha"}, 403
+    if not await captcha.verify(data.captcha, request.ip, bypass=getattr(request, "bypass_captcha", False)):
+        return {"error": True, "type": "invalidCaptcha"}, 403
+    captcha.consume(data.captcha, request.ip)
 
     # Create email verification ticket
     ticket = EmailTicket(data.email, request.user, "verify", expires_at=int(time.time())+1800)
@@ -255,10 +251,7 @@ async def update_email(data: UpdateEmailBody):
 
     # Send email
     txt_tmpl, html_tmpl = security.render_email_tmpl("verify", request.user, data.email, {"token": ticket.token})
-    Thread(
-        target=security.send_email,
-        args=[security.EMAIL_SUBJECTS["verify"], request.user, data.email, txt_tmpl, html_tmpl]
-    ).start()
+    security.send_email(security.EMAIL_SUBJECTS["verify"], request.user, data.email, txt_tmpl, html_tmpl)
 
     return {"error": False}, 200
 
@@ -369,6 +362,13 @@ async def add_authenticator(data: AddAuthenticatorBody):
     if not security.check_password_hash(data.password, account["pswd"]):
         security.ratelimit(f"login:u:{request.user}", 5, 60)
         return {"error": True, "type": "invalidCredentials"}, 401
+
+    # Create MFA recovery code (if the migration hasn't added one yet)
+    if not account.get("mfa_recovery_code"):
+        account["mfa_recovery_code"] = secrets.token_hex(5)
+        db.usersv0.update_one({"_id": account["_id"]}, {"$set": {
+            "mfa_recovery_code": account["mfa_recovery_code"]
+        }})
     
     # Register
     authenticator = {
@@ -506,7 +506,7 @@ async def reset_mfa_recovery_code(data: ResetMFARecoveryCodeBody):
         "mfa_recovery_code": new_recovery_code
     }})
     security.log_security_action("mfa_recovery_reset", account["_id"], {
-        "old_recovery_code_hash": urlsafe_b64encode(sha256(account["mfa_recovery_code"]).digest()).decode(),
+        "old_recovery_code_hash": urlsafe_b64encode(sha256(account.get("mfa_recovery_code", "").encode()).digest()).decode(),
         "new_recovery_code_hash": urlsafe_b64encode(sha256(new_recovery_code.encode()).digest()).decode(),
         "ip": request.ip,
         "user_agent": request.headers.get("User-Agent")
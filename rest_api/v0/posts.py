@@ -2,13 +2,12 @@ from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Optional
-from threading import Thread
 from copy import copy
-import pymongo, uuid, time, emoji
+import pymongo, uuid, time
 
-import security
+import security, errors, search_index
 from database import db, get_total_pages
-from uploads import claim_file, delete_file
+from uploads import delete_file
 from utils import log
 
 
@@ -135,7 +134,11 @@ async def update_post(query_args: PostIdQueryArgs, data: PostBody):
     }})
 
     # Send update post event
-    app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    app.cl.send_event("update_post", post, chat_id=(None if post["post_origin"] == "home" else post["post_origin"]))
+
+    # Update search index
+    if post["post_origin"] == "home":
+        search_index.publish_add(post)
 
     # Return post
     post["error"] = False
@@ -192,6 +195,7 @@ async def report_post(post_id, data: ReportBody):
             "mod_deleted": True,
             "deleted_at": int(time.time())
         }})
+        search_index.publish_remove(post_id)
 
     return {"error": False}, 200
 
@@ -216,7 +220,7 @@ async def pin_post(post_id):
     if not chat:
         abort(401)
 
-    if not (request.user == chat["owner"] or chat["allow_pinning"] or has_perm):
+    if not (request.user == chat["owner"] or chat.get("allow_pinning") or has_perm):
         abort(401)
 
     db.posts.update_one({"_id": post_id}, {"$set": {
@@ -225,7 +229,7 @@ async def pin_post(post_id):
 
     post["pinned"] = True
 
-    app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    app.cl.send_event("update_post", post, chat_id=(None if post["post_origin"] == "home" else post["post_origin"]))
 
     post["error"] = False
     return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
@@ -250,7 +254,7 @@ async def unpin_post(post_id):
     if not chat:
         abort(401)
 
-    if not (request.user == chat["owner"] or chat["allow_pinning"] or has_perm):
+    if not (request.user == chat["owner"] or chat.get("allow_pinning") or has_perm):
         abort(401)
 
 
@@ -260,7 +264,7 @@ async def unpin_post(post_id):
 
     post["pinned"] = False
 
-    app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    app.cl.send_event("update_post", post, chat_id=(None if post["post_origin"] == "home" else post["post_origin"]))
 
     post["error"] = False
     return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
@@ -294,6 +298,7 @@ async def delete_attachment(post_id: str, attachment_id: str):
         abort(403)
 
     # Delete attachment
+    post.setdefault("attachments", [])  # not added by the migration yet
     for attachment in copy(post["attachments"]):
         if attachment["id"] == attachment_id:
             try:
@@ -309,7 +314,7 @@ async def delete_attachment(post_id: str, attachment_id: str):
         }})
 
         # Send update post event
-        app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+        app.cl.send_event("update_post", post, chat_id=(None if post["post_origin"] == "home" else post["post_origin"]))
     else:  # delete post if no content and attachments remain
         # Update post
         db.posts.update_one({"_id": post_id}, {"$set": {
@@ -321,7 +326,11 @@ async def delete_attachment(post_id: str, attachment_id: str):
         app.cl.send_event("delete_post", {
             "chat_id": post["post_origin"],
             "post_id": post_id
-        }, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+        }, chat_id=(None if post["post_origin"] == "home" else post["post_origin"]))
+
+        # Update search index
+        if post["post_origin"] == "home":
+            search_index.publish_remove(post_id)
 
     # Return post
     post["error"] = False
@@ -362,7 +371,7 @@ async def delete_post(query_args: PostIdQueryArgs):
             abort(403)
 
     # Delete attachments
-    for attachment in post["attachments"]:
+    for attachment in post.get("attachments", []):
         try:
             delete_file(attachment["id"])
         except Exception as e:
@@ -378,7 +387,11 @@ async def delete_post(query_args: PostIdQueryArgs):
     app.cl.send_event("delete_post", {
         "chat_id": post["post_origin"],
         "post_id": query_args.id
-    }, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    }, chat_id=(None if post["post_origin"] == "home" else post["post_origin"]))
+
+    # Update search index
+    if post["post_origin"] == "home":
+        search_index.publish_remove(query_args.id)
 
     return {"error": False}, 200
 
@@ -420,103 +433,20 @@ async def create_chat_post(chat_id, data: PostBody):
     if not request.user:
         abort(401)
 
-    if not (request.flags & security.UserFlags.POST_RATELIMIT_BYPASS):
-        # Check ratelimit
-        if security.ratelimited(f"post:{request.user}"):
-            abort(429)
-
-        # Ratelimit
-        security.ratelimit(f"post:{request.user}", 6, 5)
-
-    # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.CHAT_POSTS):
-        return {"error": True, "type": "accountBanned"}, 403
-
-    # Make sure there's not too many attachments
-    if len(data.attachments) > 10:
-        return {"error": True, "type": "tooManyAttachments"}, 400
-
-    # Make sure the post isn't replying to too many posts
-    if len(data.reply_to) > 10:
-        return {"error": True, "type": "tooManyReplies"}, 400
-    
-    # Make sure there's not too many stickers
-    if len(data.stickers) > 10:
-        return {"error": True, "type": "tooManyStickers"}, 400
-
-    # Make sure stickers exist
-    for sticker_id in copy(data.stickers):
-        if not db.chat_stickers.count_documents({"_id": sticker_id}, limit=1):
-            data.stickers.remove(sticker_id)
-
-    # Make sure replied to post IDs exist and are unique
-    unique_reply_to_post_ids = []
-    if chat_id != "livechat":
-        for post_id in data.reply_to:
-            if db.posts.count_documents({"_id": post_id, "post_origin": chat_id}, limit=1) and \
-                post_id not in unique_reply_to_post_ids:
-                unique_reply_to_post_ids.append(post_id)
-
-    # Claim attachments
-    attachments = []
-    if chat_id != "livechat":
-        for attachment_id in set(data.attachments):
-            try:
-                attachments.append(claim_file(attachment_id, "attachments"))
-            except Exception as e:
-                log(f"Unable to claim attachment: {e}")
-                return {"error": True, "type": "unableToClaimAttachment"}, 500
-
-    # Make sure the post has text content or at least 1 attachment or at least 1 sticker
-    if not data.content and not attachments and not data.stickers:
-        abort(400)
-
-    if chat_id != "livechat":
-        # Get chat
-        chat = db.chats.find_one({
-            "_id": chat_id,
-            "members": request.user,
-            "deleted": False
-        }, projection={"type": 1, "members": 1})
-        if not chat:
-            abort(404)
-        
-        # DM stuff
-        if chat["type"] == 1:
-            # Check privacy options
-            if db.relationships.count_documents({"$or": [
-                {"_id": {"from": chat["members"][0], "to": chat["members"][1]}},
-                {"_id": {"from": chat["members"][1], "to": chat["members"][0]}}
-            ], "state": 2}, limit=1) > 0:
-                abort(403)
-
-            # Update user settings
-            Thread(target=db.user_settings.bulk_write, args=([
-                pymongo.UpdateMany({"$or": [
-                    {"_id": chat["members"][0]},
-                    {"_id": chat["members"][1]}
-                ]}, {"$pull": {"active_dms": chat_id}}),
-                pymongo.UpdateMany({"$or": [
-                    {"_id": chat["members"][0]},
-                    {"_id": chat["members"][1]}
-                ]}, {"$push": {"active_dms": {
-                    "$each": [chat_id],
-                    "$position": 0,
-                    "$slice": -150
-                }}})
-            ],)).start()
-
     # Create post
-    post = app.supporter.create_post(
-        chat_id,
-        request.user,
-        data.content,
-        attachments=attachments,
-        stickers=data.stickers,
-        nonce=data.nonce,
-        chat_members=(None if chat_id == "livechat" else chat["members"]),
-        reply_to=unique_reply_to_post_ids
-    )
+    try:
+        post = app.supporter.submit_post(
+            chat_id,
+            request.user,
+            request.flags,
+            data.content,
+            attachment_ids=data.attachments,
+            sticker_ids=data.stickers,
+            reply_to_ids=data.reply_to,
+            nonce=data.nonce
+        )
+    except errors.APIError as e:
+        return {"error": True, "type": e.type}, e.status
 
     # Return new post
     post["error"] = False
@@ -564,77 +494,11 @@ async def add_post_reaction(post_id: str, emoji_reaction: str):
     if not request.user:
         abort(401)
 
-    # Ratelimit
-    if security.ratelimited(f"react:{request.user}"):
-        abort(429)
-    security.ratelimit(f"react:{request.user}", 5, 5)
-
-    # Check if the emoji is only one emoji, with support for variants
-    if not (emoji.purely_emoji(emoji_reaction) and len(emoji.distinct_emoji_list(emoji_reaction)) == 1):
-        # Check if the emoji is a custom emoji
-        if not db.chat_emojis.count_documents({"_id": emoji_reaction}, limit=1):
-            abort(400)
-
-    # Get necessary post details and check access
-    post = db.posts.find_one({
-        "_id": post_id,
-        "isDeleted": {"$ne": True}
-    }, projection={
-        "_id": 1,
-        "post_origin": 1,
-        "u": 1,
-        "reactions": 1
-    })
-    if not post:
-        abort(404)
-    elif post["post_origin"] == "inbox" and post["u"] not in ["Server", request.user]:
-        abort(404)
-    elif post["post_origin"] not in ["home", "inbox"]:
-        if not db.chats.count_documents({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, limit=1):
-            abort(404)
-
-    # Make sure there's not too many reactions (50)
-    if len(post["reactions"]) >= 50:
-        return {"error": True, "type": "tooManyReactions"}, 403
-
     # Add reaction
-    db.post_reactions.update_one({"_id": {
-        "post_id": post["_id"],
-        "emoji": emoji_reaction,
-        "user": request.user
-    }}, {"$set": {"time": int(time.time())}}, upsert=True)
-
-    # Update post
-    existing_reaction = None
-    for reaction in post["reactions"]:
-        if reaction["emoji"] == emoji_reaction:
-            existing_reaction = reaction
-            break
-    if existing_reaction:
-        existing_reaction["count"] = db.post_reactions.count_documents({
-            "_id.post_id": post["_id"],
-            "_id.emoji": reaction["emoji"]
-        })
-    else:
-        post["reactions"].append({
-            "emoji": emoji_reaction,
-            "count": 1
-        })
-    db.posts.update_one({"_id": post["_id"]}, {"$set": {
-        "reactions": post["reactions"]
-    }})
-
-    # Send event
-    app.cl.send_event("post_reaction_add", {
-        "chat_id": post["post_origin"],
-        "post_id": post["_id"],
-        "emoji": emoji_reaction,
-        "username": request.user
-    })
+    try:
+        app.supporter.add_post_reaction(post_id, emoji_reaction, request.user)
+    except errors.APIError as e:
+        return {"error": True, "type": e.type}, e.status
 
     return {"error": False}, 200
 
@@ -648,75 +512,10 @@ async def remove_post_reaction(post_id: str, emoji_reaction: str, username: str)
     if username == "@me":
         username = request.user
 
-    # Ratelimit
-    if security.ratelimited(f"react:{request.user}"):
-        abort(429)
-    security.ratelimit(f"react:{request.user}", 5, 5)
-
-    # Make sure reaction exists
-    if not db.post_reactions.count_documents({"_id": {
-        "post_id": post_id,
-        "emoji": emoji_reaction,
-        "user": username
-    }}, limit=1):
-        abort(404)
-
-    # Get necessary post details and check access
-    post = db.posts.find_one({
-        "_id": post_id,
-        "isDeleted": {"$ne": True}
-    }, projection={
-        "_id": 1,
-        "post_origin": 1,
-        "u": 1,
-        "reactions": 1
-    })
-    if not post:
-        abort(404)
-    elif post["post_origin"] == "inbox" and post["u"] not in ["Server", request.user]:
-        abort(404)
-    elif post["post_origin"] not in ["home", "inbox"]:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, projection={"owner": 1})
-        if not chat:
-            abort(404)
-
-    # Make sure requester can remove the reaction
-    if request.user != username:
-        if (post["post_origin"] in ["home", "inbox"]) or (chat["owner"] != request.user):
-            abort(403)
-
     # Remove reaction
-    db.post_reactions.delete_one({"_id": {
-        "post_id": post["_id"],
-        "emoji": emoji_reaction,
-        "user": username
-    }})
-
-    # Update post
-    for reaction in post["reactions"]:
-        if reaction["emoji"] != emoji_reaction:
-            continue
-        reaction["count"] = db.post_reactions.count_documents({
-            "_id.post_id": post["_id"],
-            "_id.emoji": reaction["emoji"]
-        })
-        if not reaction["count"]:
-            post["reactions"].remove(reaction)
-        break
-    db.posts.update_one({"_id": post["_id"]}, {"$set": {
-        "reactions": post["reactions"]
-    }})
-
-    # Send event
-    app.cl.send_event("post_reaction_remove", {
-        "chat_id": post["post_origin"],
-        "post_id": post["_id"],
-        "emoji": emoji_reaction,
-        "username": username
-    })
+    try:
+        app.supporter.remove_post_reaction(post_id, emoji_reaction, username, request.user)
+    except errors.APIError as e:
+        return {"error": True, "type": e.type}, e.status
 
     return {"error": False}, 200
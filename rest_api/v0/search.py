@@ -1,10 +1,12 @@
-from quart import Blueprint, current_app as app, request
+from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, Literal
+import asyncio
 
-import security
+import security, errors
 from database import db, get_total_pages
+from search_index import home_index, username_index
 
 
 search_bp = Blueprint("search_bp", __name__, url_prefix="/search")
@@ -14,10 +16,49 @@ class SearchQueryArgs(BaseModel):
     q: str = Field(min_length=1, max_length=4000)
     page: Optional[int] = Field(default=1, ge=1)
 
+class SearchUsersQueryArgs(SearchQueryArgs):
+    mode: Optional[Literal["text", "prefix"]] = Field(default="text")
+
+class SearchHomeQueryArgs(SearchQueryArgs):
+    cursor: Optional[str] = Field(default=None, max_length=200)
+
 
 @search_bp.get("/home")
-@validate_querystring(SearchQueryArgs)
-async def search_home(query_args: SearchQueryArgs):
+@validate_querystring(SearchHomeQueryArgs)
+async def search_home(query_args: SearchHomeQueryArgs):
+    # Search index (falls back to $text while the index is still being built)
+    if home_index.ready:
+        try:
+            post_ids, total, next_cursor = await asyncio.to_thread(
+                home_index.search,
+                query_args.q,
+                page=query_args.page,
+                cursor=query_args.cursor
+            )
+        except errors.InvalidSearchCursor:
+            abort(400)
+
+        # Get posts (and drop any that got deleted without the index knowing)
+        posts = {post["_id"]: post for post in db.posts.find({
+            "_id": {"$in": post_ids},
+            "post_origin": "home",
+            "isDeleted": False
+        })}
+        for post_id in post_ids:
+            if post_id not in posts:
+                home_index.remove(post_id)
+
+        return {
+            "error": False,
+            "autoget": app.supporter.parse_posts_v0(
+                [posts[post_id] for post_id in post_ids if post_id in posts],
+                requester=request.user
+            ),
+            "page#": query_args.page,
+            "pages": (total // 25) + (1 if total % 25 else 0),
+            "next_cursor": next_cursor
+        }, 200
+
     query = {"post_origin": "home", "isDeleted": False, "$text": {"$search": query_args.q}}
     return {
         "error": False,
@@ -32,8 +73,22 @@ async def search_home(query_args: SearchQueryArgs):
 
 
 @search_bp.get("/users")
-@validate_querystring(SearchQueryArgs)
-async def search_users(query_args: SearchQueryArgs):
+@validate_querystring(SearchUsersQueryArgs)
+async def search_users(query_args: SearchUsersQueryArgs):
+    # Prefix autocomplete (online users first)
+    if query_args.mode == "prefix" and username_index.ready:
+        usernames, total = username_index.complete(
+            query_args.q,
+            page=query_args.page,
+            online=app.cl.usernames
+        )
+        return {
+            "error": False,
+            "autoget": security.get_accounts(usernames),
+            "page#": query_args.page,
+            "pages": (total // 25) + (1 if total % 25 else 0)
+        }, 200
+
     # Get users
     query = {"pswd": {"$type": "string"}, "$text": {"$search": query_args.q}}
     usernames = [user["_id"] for user in db.usersv0.find(query, skip=(query_args.page-1)*25, limit=25, projection={"_id": 1})]
@@ -41,7 +96,7 @@ async def search_users(query_args: SearchQueryArgs):
     # Return users
     return {
         "error": False,
-        "autoget": [security.get_account(username) for username in usernames],
+        "autoget": security.get_accounts(usernames),
         "page#": query_args.page,
         "pages": get_total_pages("usersv0", query)
     }, 200
@@ -225,6 +225,9 @@ async def get_dm_chat(username):
         }
         db.chats.insert_one(chat)
 
+        # Add members to the chat index (there's no create_chat event for DMs)
+        app.cl.call_soon(app.cl.add_chat_members, chat["_id"], chat["members"])
+
     # Return chat
     if chat["last_active"] == 0:
         chat["last_active"] = int(time.time())
@@ -0,0 +1,392 @@
+from threading import Lock
+from typing import Optional, Iterator, Container
+from collections import Counter, defaultdict
+from array import array
+from bisect import bisect_left, insort
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import re, os, time, math, heapq, msgpack, pymongo
+
+from database import db, rdb
+from utils import log
+from metrics import background_task_duration
+import errors
+
+"""
+Meower Search Index Module
+This module provides an in-memory inverted index over home posts, ranked with BM25 and a recency boost,
+and a sorted prefix index of usernames for autocomplete.
+
+New documents go into a mutable live segment, which gets frozen into a compact segment once it's full.
+Frozen segments are periodically merged in size tiers (like a log-structured merge tree), which also purges
+deleted (tombstoned) documents. Searches score a snapshot of the segments without holding the index lock.
+Changes are broadcast over the "admin" pub/sub channel so every process keeps its index up to date.
+"""
+
+TOKEN_REGEX = re.compile(r"\w+")
+MAX_TOKEN_LEN = 32
+MAX_QUERY_TERMS = 16
+
+SEGMENT_SIZE = int(os.getenv("SEARCH_SEGMENT_SIZE", 10000))  # documents per segment
+MERGE_FACTOR = 8  # frozen segments of the same size tier allowed before merging them
+MERGE_INTERVAL = 60  # seconds
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RECENCY_HALF_LIFE = float(os.getenv("SEARCH_RECENCY_HALF_LIFE", 86400*30))  # seconds
+RECENCY_WEIGHT = 1.0  # a brand new post gets up to double the score of an ancient one
+MAX_AGE = int(os.getenv("SEARCH_MAX_AGE", 0))  # seconds, 0 to search all posts
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_REGEX.findall(text.lower()) if len(token) <= MAX_TOKEN_LEN]
+
+
+class LiveSegment:
+    __slots__ = ("postings", "doc_ids")
+
+    def __init__(self):
+        self.postings: dict[str, dict[int, int]] = {}  # {"term": {doc: tf}}
+        self.doc_ids: list[int] = []
+
+    def add(self, doc: int, terms: Counter):
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc] = tf
+        self.doc_ids.append(doc)
+
+    def doc_freq(self, term: str) -> int:
+        return len(self.postings.get(term, ()))
+
+    def iter_postings(self, term: str) -> Iterator[tuple[int, int]]:
+        return iter(self.postings.get(term, {}).items())
+
+    def snapshot(self, terms: list[str]) -> "LiveSegment":
+        # Copy the postings of the given terms, so they can be read while new documents are being added
+        snapshot = LiveSegment()
+        snapshot.postings = {term: dict(self.postings[term]) for term in terms if term in self.postings}
+        return snapshot
+
+
+class FrozenSegment:
+    __slots__ = ("postings", "doc_ids")
+
+    def __init__(self, postings: dict[str, dict[int, int]], doc_ids: list[int]):
+        # Store postings as packed arrays, which take a fraction of the memory of dicts
+        self.postings: dict[str, tuple[array, array]] = {
+            term: (array("Q", docs.keys()), array("H", (min(tf, 65535) for tf in docs.values())))
+            for term, docs in postings.items()
+        }
+        self.doc_ids = array("Q", doc_ids)
+
+    def doc_freq(self, term: str) -> int:
+        postings = self.postings.get(term)
+        return len(postings[0]) if postings else 0
+
+    def iter_postings(self, term: str) -> Iterator[tuple[int, int]]:
+        postings = self.postings.get(term)
+        return zip(*postings) if postings else iter(())
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self.ready = False
+
+        self.live = LiveSegment()
+        self.segments: list[FrozenSegment] = []
+        self.tombstones: set[int] = set()
+
+        self.docs: dict[int, tuple[str, int, int]] = {}  # {doc: ("post_id", length, timestamp)}
+        self.post_ids: dict[str, int] = {}  # {"post_id": doc}
+        self.next_doc = 0
+        self.total_len = 0
+
+    def add(self, post_id: str, content: str, timestamp: int):
+        terms = Counter(tokenize(content))
+        length = sum(terms.values())
+        with self._lock:
+            # Replace existing document
+            self._remove(post_id)
+
+            doc = self.next_doc
+            self.next_doc += 1
+            self.docs[doc] = (post_id, length, timestamp)
+            self.post_ids[post_id] = doc
+            self.total_len += length
+            self.live.add(doc, terms)
+
+            # Freeze live segment once it's full
+            if len(self.live.doc_ids) >= SEGMENT_SIZE:
+                self.segments.append(FrozenSegment(self.live.postings, self.live.doc_ids))
+                self.live = LiveSegment()
+
+    def remove(self, post_id: str):
+        with self._lock:
+            self._remove(post_id)
+
+    def _remove(self, post_id: str):
+        doc = self.post_ids.pop(post_id, None)
+        if doc is not None:
+            self.tombstones.add(doc)
+            self.total_len -= self.docs[doc][1]
+
+    def merge(self):
+        # Group frozen segments into size tiers (SEGMENT_SIZE, SEGMENT_SIZE*MERGE_FACTOR, ...)
+        # and merge the smallest tier that has filled up, so big segments don't get rewritten every time
+        with self._lock:
+            tiers: dict[int, list[FrozenSegment]] = defaultdict(list)
+            for segment in self.segments:
+                size = len(segment.doc_ids)
+                tier = int(math.log(size / SEGMENT_SIZE, MERGE_FACTOR)) if size > SEGMENT_SIZE else 0
+                tiers[tier].append(segment)
+            full_tiers = sorted(tier for tier, segments in tiers.items() if len(segments) >= MERGE_FACTOR)
+            if not full_tiers:
+                return
+            to_merge = tiers[full_tiers[0]]
+            tombstones = set(self.tombstones)
+
+        # Build merged segment without holding the lock (frozen segments never change)
+        started_at = time.perf_counter()
+        postings: dict[str, dict[int, int]] = defaultdict(dict)
+        doc_ids = []
+        purged = set()
+        for segment in to_merge:
+            for doc in segment.doc_ids:
+                if doc in tombstones:
+                    purged.add(doc)
+                else:
+                    doc_ids.append(doc)
+            for term, (docs, tfs) in segment.postings.items():
+                for doc, tf in zip(docs, tfs):
+                    if doc not in tombstones:
+                        postings[term][doc] = tf
+        merged = FrozenSegment(postings, doc_ids)
+
+        with self._lock:
+            # Put the merged segment where the first merged segment was (frozen segments are only ever
+            # appended by add() or replaced by merge(), which runs in a single thread)
+            merged_ids = {id(segment) for segment in to_merge}
+            position = next(i for i, segment in enumerate(self.segments) if id(segment) in merged_ids)
+            self.segments = [segment for segment in self.segments if id(segment) not in merged_ids]
+            self.segments.insert(position, merged)
+            for doc in purged:
+                del self.docs[doc]
+            self.tombstones -= purged
+
+        background_task_duration.labels("search_index_merge").observe(time.perf_counter()-started_at)
+        log(f"Merged {len(to_merge)} search segments ({len(doc_ids)} docs, {len(purged)} purged) in {round((time.perf_counter()-started_at)*1000)}ms")
+
+    def search(
+        self,
+        query: str,
+        limit: int = 25,
+        page: int = 1,
+        cursor: Optional[str] = None
+    ) -> tuple[list[str], int, Optional[str]]:
+        # Decode cursor (pins the time used for recency, so pages stay consistent)
+        if cursor:
+            try:
+                now, after_score, after_doc = msgpack.unpackb(urlsafe_b64decode(cursor.encode()))
+                after = (-after_score, -after_doc)
+                now = float(now)
+            except Exception:
+                raise errors.InvalidSearchCursor
+        else:
+            now, after = time.time(), None
+
+        terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+        if not terms:
+            return [], 0, None
+
+        # Snapshot segments (frozen segments never change, the live segment gets copied)
+        with self._lock:
+            doc_count = len(self.post_ids)
+            if not doc_count:
+                return [], 0, None
+            avg_len = max(self.total_len / doc_count, 1)
+            segments = self.segments + [self.live.snapshot(terms)]
+
+        # Score documents with BM25
+        # (documents can get removed or purged while scoring, so skip any that are gone)
+        scores: dict[int, float] = defaultdict(float)
+        for term in terms:
+            doc_freq = sum(segment.doc_freq(term) for segment in segments)
+            if not doc_freq:
+                continue
+            idf = math.log(1 + ((doc_count - doc_freq + 0.5) / (doc_freq + 0.5)))
+            for segment in segments:
+                for doc, tf in segment.iter_postings(term):
+                    if doc in self.tombstones:
+                        continue
+                    info = self.docs.get(doc)
+                    if info is None:
+                        continue
+                    scores[doc] += idf * ((tf * (BM25_K1 + 1)) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * (info[1] / avg_len))))
+
+        # Apply recency boost and cutoff
+        ranked = []
+        for doc, score in scores.items():
+            info = self.docs.get(doc)
+            if info is None:
+                continue
+            post_id, _, timestamp = info
+            age = max(now - timestamp, 0)
+            if MAX_AGE and age > MAX_AGE:
+                continue
+            ranked.append((score * (1 + RECENCY_WEIGHT * (0.5 ** (age / RECENCY_HALF_LIFE))), doc, post_id))
+
+        # Get page
+        key = lambda result: (-result[0], -result[1])
+        if after:
+            results = heapq.nsmallest(limit, (result for result in ranked if key(result) > after), key=key)
+        else:
+            results = heapq.nsmallest(page * limit, ranked, key=key)[(page - 1) * limit:]
+
+        # Get next cursor
+        next_cursor = None
+        if len(results) == limit:
+            next_cursor = urlsafe_b64encode(msgpack.packb([now, results[-1][0], results[-1][1]])).decode()
+
+        return [post_id for _, _, post_id in results], len(ranked), next_cursor
+
+    def build(self):
+        started_at = time.time()
+        for post in db.posts.find(
+            {"post_origin": "home", "isDeleted": False},
+            projection={"_id": 1, "p": 1, "t.e": 1},
+            sort=[("t.e", pymongo.ASCENDING)],
+            batch_size=1000
+        ):
+            self.add(post["_id"], post.get("p", ""), post["t"]["e"])
+        self.ready = True
+        log(f"Built home search index with {len(self.post_ids)} posts in {round(time.time()-started_at, 1)}s")
+
+    def run(self):
+        try:
+            self.build()
+        except Exception as e:
+            log(f"Unable to build home search index: {e}")
+            return
+
+        while True:
+            time.sleep(MERGE_INTERVAL)
+            try:
+                self.merge()
+            except Exception as e:
+                log(f"Unable to merge home search segments: {e}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "docs": len(self.post_ids),
+                "tombstones": len(self.tombstones),
+                "segments": len(self.segments),
+                "live_docs": len(self.live.doc_ids)
+            }
+
+    def apply_update(self, op: dict):
+        match op["action"]:
+            case "add":
+                self.add(op["id"], op["p"], op["t"])
+            case "remove":
+                self.remove(op["id"])
+
+
+class UsernameIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self.ready = False
+        self.lower_usernames: list[str] = []  # sorted
+        self.usernames: dict[str, str] = {}  # {"lower_username": "Username"}
+
+    def add(self, username: str):
+        lower_username = username.lower()
+        with self._lock:
+            if lower_username not in self.usernames:
+                insort(self.lower_usernames, lower_username)
+            self.usernames[lower_username] = username
+
+    def remove(self, username: str):
+        lower_username = username.lower()
+        with self._lock:
+            if self.usernames.pop(lower_username, None) is not None:
+                del self.lower_usernames[bisect_left(self.lower_usernames, lower_username)]
+
+    def complete(
+        self,
+        prefix: str,
+        limit: int = 25,
+        page: int = 1,
+        online: Container[str] = (),
+        max_scan: int = 1000
+    ) -> tuple[list[str], int]:
+        prefix = prefix.lower()
+        with self._lock:
+            start = bisect_left(self.lower_usernames, prefix)
+            matches = []
+            for lower_username in self.lower_usernames[start:start+max_scan]:
+                if not lower_username.startswith(prefix):
+                    break
+                matches.append(self.usernames[lower_username])
+
+        # Online users first, then exact and shorter matches
+        matches.sort(key=lambda username: (username not in online, len(username), username.lower()))
+        return matches[(page-1)*limit:page*limit], len(matches)
+
+    def build(self):
+        lower_usernames = []
+        usernames = {}
+        for user in db.usersv0.find({"pswd": {"$type": "string"}}, projection={"_id": 1}):
+            lower_usernames.append(user["_id"].lower())
+            usernames[user["_id"].lower()] = user["_id"]
+        lower_usernames.sort()
+        with self._lock:
+            self.lower_usernames = lower_usernames
+            self.usernames = usernames
+        self.ready = True
+        log(f"Built username index with {len(usernames)} users")
+
+    def apply_update(self, op: dict):
+        match op["action"]:
+            case "add":
+                self.add(op["username"])
+            case "remove":
+                self.remove(op["username"])
+
+
+home_index = SearchIndex()
+username_index = UsernameIndex()
+
+
+def publish_add(post: dict):
+    rdb.publish("admin", msgpack.packb({
+        "op": "search_index",
+        "action": "add",
+        "id": post["_id"],
+        "p": post.get("p", ""),
+        "t": post["t"]["e"]
+    }))
+
+
+def publish_remove(post_id: str):
+    rdb.publish("admin", msgpack.packb({
+        "op": "search_index",
+        "action": "remove",
+        "id": post_id
+    }))
+
+
+def publish_username_add(username: str):
+    rdb.publish("admin", msgpack.packb({
+        "op": "username_index",
+        "action": "add",
+        "username": username
+    }))
+
+
+def publish_username_remove(username: str):
+    rdb.publish("admin", msgpack.packb({
+        "op": "username_index",
+        "action": "remove",
+        "username": username
+    }))
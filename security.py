@@ -1,15 +1,16 @@
 from typing import Optional, Any, Literal
 from hashlib import sha256
 from base64 import urlsafe_b64encode, urlsafe_b64decode
-from threading import Thread
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formataddr
-import time, requests, os, uuid, secrets, bcrypt, hmac, msgpack, jinja2, smtplib, re
+from threading import Condition
+from functools import cache
+from collections import deque
+import time, requests, os, uuid, secrets, bcrypt, hmac, msgpack, jinja2, re, json, pymongo.errors
 
 from database import db, rdb, signing_keys
 from utils import log
 from uploads import clear_files
+from metrics import ratelimit_rejections, background_task_duration
+import outbox, ip_intel, search_index
 import errors
 
 """
@@ -68,8 +69,23 @@ EMAIL_SUBJECTS = {
 }
 
 
+EMAIL_PLATFORM_ENV_KEYS = (
+    "EMAIL_PLATFORM_NAME",
+    "EMAIL_PLATFORM_LOGO",
+    "EMAIL_PLATFORM_BRAND",
+    "EMAIL_PLATFORM_FRONTEND",
+    "EMAIL_PLATFORM_SUPPORT"
+)
+
+
+# Compile email templates once (templates don't change while the server is running)
 email_file_loader = jinja2.FileSystemLoader("email_templates")
-email_env = jinja2.Environment(loader=email_file_loader)
+email_env = jinja2.Environment(loader=email_file_loader, auto_reload=False)
+email_templates = {
+    (template, fmt): email_env.get_template(f"{template}.{fmt}")
+    for template in EMAIL_SUBJECTS
+    for fmt in ("txt", "html")
+}
 
 
 class UserFlags:
@@ -121,6 +137,7 @@ class Restrictions:
 def ratelimited(bucket_id: str):
     remaining = rdb.get(f"rtl:{bucket_id}")
     if remaining is not None and int(remaining.decode()) < 1:
+        ratelimit_rejections.labels(bucket_id.split(":")[0]).inc()
         return True
     else:
         return False
@@ -185,6 +202,9 @@ def create_account(username: str, password: str, ip: str):
     })
     db.user_settings.insert_one({"_id": username})
 
+    # Add to username index
+    search_index.publish_username_add(username)
+
     # Send welcome message
     rdb.publish("admin", msgpack.packb({
         "op": "alert_user",
@@ -210,6 +230,62 @@ def create_account(username: str, password: str, ip: str):
         })
 
 
+def get_inbox_epoch() -> int:
+    inbox = db.config.find_one({"_id": "inbox"}, projection={"epoch": 1})
+    return inbox["epoch"] if inbox else 0
+
+
+def bump_inbox_epoch():
+    db.config.update_one({"_id": "inbox"}, {"$inc": {"epoch": 1}}, upsert=True)
+
+
+def resolve_unread_inbox(user_settings: dict, epoch: Optional[int] = None):
+    # Personal inbox messages set unread_inbox directly, announcements bump the global epoch
+    if epoch is None:
+        epoch = get_inbox_epoch()
+    read_epoch = user_settings.pop("inbox_read_epoch", 0)
+    user_settings["unread_inbox"] = user_settings.get("unread_inbox", DEFAULT_USER_SETTINGS["unread_inbox"]) or read_epoch < epoch
+
+
+def prepare_account(account: dict):
+    # Make sure there's nothing sensitive on the account obj
+    for key in SENSITIVE_ACCOUNT_FIELDS:
+        if key in account:
+            del account[key]
+
+    # Add lvl and banned
+    account["lvl"] = 0
+    if account["ban"]:
+        if account["ban"]["state"] == "perm_ban":
+            account["banned"] = True
+        elif (account["ban"]["state"] == "temp_ban") and (account["ban"]["expires"] > time.time()):
+            account["banned"] = True
+        else:
+            account["banned"] = False
+    else:
+        account["banned"] = False
+
+
+def get_accounts(usernames: list[str]) -> list[dict]:
+    # Get all accounts in one query
+    accounts = {
+        account["_id"]: account
+        for account in db.usersv0.find({"_id": {"$in": usernames}}, projection=SENSITIVE_ACCOUNT_FIELDS_DB_PROJECTION)
+    }
+
+    # Return accounts in the same order as the usernames
+    ordered_accounts = []
+    for username in usernames:
+        account = accounts.get(username)
+        if not account:
+            continue
+        prepare_account(account)
+        account.pop("email", None)  # not added by the migration yet on old accounts
+        del account["ban"]
+        ordered_accounts.append(account)
+    return ordered_accounts
+
+
 def get_account(username, include_config=False):
     # Check datatype
     if not isinstance(username, str):
@@ -238,23 +314,7 @@ def get_account(username, include_config=False):
     account = db.usersv0.find_one({"lower_username": username.lower()}, projection=SENSITIVE_ACCOUNT_FIELDS_DB_PROJECTION)
     if not account:
         return None
-
-    # Make sure there's nothing sensitive on the account obj
-    for key in SENSITIVE_ACCOUNT_FIELDS:
-        if key in account:
-            del account[key]
-
-    # Add lvl and banned
-    account["lvl"] = 0
-    if account["ban"]:
-        if account["ban"]["state"] == "perm_ban":
-            account["banned"] = True
-        elif (account["ban"]["state"] == "temp_ban") and (account["ban"]["expires"] > time.time()):
-            account["banned"] = True
-        else:
-            account["banned"] = False
-    else:
-        account["banned"] = False
+    prepare_account(account)
 
     # Include config
     if include_config:
@@ -263,9 +323,10 @@ def get_account(username, include_config=False):
         if user_settings:
             del user_settings["_id"]
             account.update(user_settings)
+        resolve_unread_inbox(account)
     else:
         # Remove email and ban if not including config
-        del account["email"]
+        account.pop("email", None)
         del account["ban"]
 
     return account
@@ -340,11 +401,16 @@ def update_settings(username, newdata):
                 
                 updated_user_settings_vals[key] = newdata[key]
 
+    # Mark announcements as read
+    update_user_settings = {"$set": updated_user_settings_vals}
+    if updated_user_settings_vals.get("unread_inbox") is False:
+        update_user_settings["$max"] = {"inbox_read_epoch": get_inbox_epoch()}
+
     # Update database items
     if len(updated_user_vals) > 0:
         db.usersv0.update_one({"_id": account["_id"]}, {"$set": updated_user_vals})
     if len(updated_user_settings_vals) > 0:
-        db.user_settings.update_one({"_id": account["_id"]}, {"$set": updated_user_settings_vals}, upsert=True)
+        db.user_settings.update_one({"_id": account["_id"]}, update_user_settings, upsert=True)
 
     return True
 
@@ -403,6 +469,9 @@ def delete_account(username, purge=False):
     # Add deleted flag
     account["flags"] |= UserFlags.DELETED
 
+    # Remove from username index
+    search_index.publish_username_remove(username)
+
     # Update account
     db.usersv0.update_one({"_id": username}, {"$set": {
         "pfp_data": None,
@@ -430,6 +499,7 @@ def delete_account(username, purge=False):
     db.acc_sessions.delete_many({"user": username})
 
     # Delete security logs
+    discard_security_log(username)
     db.security_log.delete_many({"user": username})
 
     # Delete uploaded files
@@ -475,7 +545,29 @@ def delete_account(username, purge=False):
         db.usersv0.delete_one({"_id": username})
 
 
+IP_INTEL_REMOTE_FALLBACK = os.getenv("IP_INTEL_REMOTE_FALLBACK", "0") == "1"
+UNKNOWN_IP_INFO = {
+    "country_code": "Unknown",
+    "country_name": "Unknown",
+    "region": "Unknown",
+    "city": "Unknown",
+    "timezone": "Unknown",
+    "currency": "Unknown",
+    "as": "Unknown",
+    "isp": "Unknown",
+    "vpn": False
+}
+
+
 def get_ip_info(ip_address):
+    # Get from offline IP intelligence database
+    if ip_intel.ip_db:
+        ip_info = ip_intel.lookup(ip_address)
+        if ip_info:
+            return ip_info
+        elif not IP_INTEL_REMOTE_FALLBACK:
+            return UNKNOWN_IP_INFO.copy()
+
     # Get IP hash
     ip_hash = urlsafe_b64encode(sha256(ip_address.encode()).digest()).decode()
 
@@ -499,76 +591,159 @@ def get_ip_info(ip_address):
             "isp": resp_json["isp"],
             "vpn": (resp_json.get("hosting") or resp_json.get("proxy"))
         }
-        rdb.set(f"ip{ip_hash}", msgpack.packb(ip_info), ex=int(time.time())+(86400*21))  # cache for 3 weeks
+        rdb.set(f"ip{ip_hash}", msgpack.packb(ip_info), ex=(86400*21))  # cache for 3 weeks
         return ip_info
     
     # Fallback
-    return {
-        "country_code": "Unknown",
-        "country_name": "Unknown",
-        "region": "Unknown",
-        "city": "Unknown",
-        "timezone": "Unknown",
-        "currency": "Unknown",
-        "as": "Unknown",
-        "isp": "Unknown",
-        "vpn": False
-    }
+    return UNKNOWN_IP_INFO.copy()
 
   
-def log_security_action(action_type: str, user: str, data: dict):
-    db.security_log.insert_one({
-        "_id": str(uuid.uuid4()),
-        "type": action_type,
-        "user": user,
-        "time": int(time.time()),
-        "data": data
-    })
+SECURITY_ALERT_ACTIONS = {
+    "email_changed",
+    "password_changed",
+    "mfa_added",
+    "mfa_removed",
+    "mfa_recovery_reset",
+    "mfa_recovery_used",
+    "locked"
+}
+SECURITY_LOG_BATCH_SIZE = 500
+SECURITY_LOG_RETRY_INTERVAL = 5  # seconds between retrying entries that failed to write
+SECURITY_LOG_MAX_RETRIES = 10000  # entries kept for retrying, past this they get written to the log instead
+SECURITY_LOG_DISCARD_TIMEOUT = 5  # seconds to wait for a batch that's being written when discarding a user's entries
 
-    if action_type in {
-        "email_changed",
-        "password_changed",
-        "mfa_added",
-        "mfa_removed",
-        "mfa_recovery_reset",
-        "mfa_recovery_used",
-        "locked"
-    }:
-        tmpl_name = "locked" if action_type == "locked" else "security_alert"
-        platform_name = os.environ["EMAIL_PLATFORM_NAME"]
-
-        account = db.usersv0.find_one({"_id": user}, projection={"_id": 1, "email": 1})
-
-        txt_tmpl, html_tmpl = render_email_tmpl(tmpl_name, account["_id"], account.get("email", ""), {
-            "msg": {
-                "email_changed": f"The email address on your {platform_name} account has been changed.",
-                "password_changed": f"The password on your {platform_name} account has been changed.",
-                "mfa_added": f"A multi-factor authenticator has been added to your {platform_name} account.",
-                "mfa_removed": f"A multi-factor authenticator has been removed from your {platform_name} account.",
-                "mfa_recovery_reset": f"The multi-factor authentication recovery code on your {platform_name} account has been reset.",
-                "mfa_recovery_used": f"Your multi-factor authentication recovery code has been used to reset multi-factor authentication on your {platform_name} account."
-            }[action_type] if action_type != "locked" else None,
-            "token": create_token("email", [  # this doesn't use EmailTicket in sessions.py because it'd be a recursive import
-                account["email"],
-                account["_id"],
-                "lockdown",
-                int(time.time())+86400
-            ]) if account.get("email") and action_type != "locked" else None
+security_log_cond = Condition()
+security_log_queue: deque[dict] = deque()
+security_log_retries: deque[dict] = deque()
+security_log_in_flight: set[str] = set()  # users with entries in the batch being written
+
+
+def log_security_action(action_type: str, user: str, data: dict):
+    with security_log_cond:
+        security_log_queue.append({
+            "_id": str(uuid.uuid4()),
+            "type": action_type,
+            "user": user,
+            "time": int(time.time()),
+            "data": data
         })
-    
-        # Email
-        if account.get('email'):
-            Thread(
-                target=send_email,
-                args=[EMAIL_SUBJECTS[tmpl_name], account["_id"], account["email"], txt_tmpl, html_tmpl]
-            ).start()
+        security_log_cond.notify_all()
 
-        # Inbox
-        rdb.publish("admin", msgpack.packb({
-            "op": "alert_user",
-            "user": account["_id"],
-            "content": txt_tmpl
-        }))
+
+@cache
+def get_security_alert_messages(platform_name: str) -> dict[str, str]:
+    return {
+        "email_changed": f"The email address on your {platform_name} account has been changed.",
+        "password_changed": f"The password on your {platform_name} account has been changed.",
+        "mfa_added": f"A multi-factor authenticator has been added to your {platform_name} account.",
+        "mfa_removed": f"A multi-factor authenticator has been removed from your {platform_name} account.",
+        "mfa_recovery_reset": f"The multi-factor authentication recovery code on your {platform_name} account has been reset.",
+        "mfa_recovery_used": f"Your multi-factor authentication recovery code has been used to reset multi-factor authentication on your {platform_name} account."
+    }
+
+
+def send_security_alert(action_type: str, user: str):
+    tmpl_name = "locked" if action_type == "locked" else "security_alert"
+
+    account = db.usersv0.find_one({"_id": user}, projection={"_id": 1, "email": 1})
+    if not account:
+        return
+
+    # Only render the HTML version if it's going to be emailed
+    txt_tmpl, html_tmpl = render_email_tmpl(tmpl_name, account["_id"], account.get("email", ""), {
+        "msg": get_security_alert_messages(os.environ["EMAIL_PLATFORM_NAME"])[action_type] if action_type != "locked" else None,
+        "token": create_token("email", [  # this doesn't use EmailTicket in sessions.py because it'd be a recursive import
+            account["email"],
+            account["_id"],
+            "lockdown",
+            int(time.time())+86400
+        ]) if account.get("email") and action_type != "locked" else None
+    }, html=bool(account.get("email")))
+
+    # Email
+    if account.get('email'):
+        send_email(EMAIL_SUBJECTS[tmpl_name], account["_id"], account["email"], txt_tmpl, html_tmpl)
+
+    # Inbox
+    rdb.publish("admin", msgpack.packb({
+        "op": "alert_user",
+        "user": account["_id"],
+        "content": txt_tmpl
+    }))
+
+
+def insert_security_log_entries(entries: list[dict]):
+    # Insert log entries, keeping the ones that fail for retrying
+    try:
+        db.security_log.insert_many(entries, ordered=False)
+        return
+    except pymongo.errors.BulkWriteError as e:
+        failed_indexes = {error["index"] for error in e.details["writeErrors"] if error["code"] != 11000}  # duplicates were already written
+        failed = [entry for i, entry in enumerate(entries) if i in failed_indexes]
+    except Exception:
+        failed = entries
+    if not failed:
+        return
+
+    with security_log_cond:
+        dropped = max(len(security_log_retries) + len(failed) - SECURITY_LOG_MAX_RETRIES, 0)
+        security_log_retries.extend(failed[dropped:])
+    log(f"Unable to write {len(failed)} security log entries, retrying in {SECURITY_LOG_RETRY_INTERVAL}s")
+    for entry in failed[:dropped]:
+        log(f"Dropping security log entry: {json.dumps(entry)}")
+
+
+def write_security_log_batch(entries: list[dict]):
+    # Insert log entries
+    insert_security_log_entries(entries)
+
+    # Send security alerts
+    for entry in entries:
+        if entry["type"] in SECURITY_ALERT_ACTIONS:
+            try:
+                send_security_alert(entry["type"], entry["user"])
+            except Exception as e:
+                log(f"Unable to send {entry['type']} security alert to {entry['user']}: {e}")
+
+
+def security_log_sink():
+    last_retry = time.monotonic()
+    while True:
+        # Wait for entries (or for it to be time to retry failed ones), then take a batch
+        with security_log_cond:
+            security_log_cond.wait_for(
+                lambda: security_log_queue,
+                timeout=(SECURITY_LOG_RETRY_INTERVAL if security_log_retries else None)
+            )
+            entries = [security_log_queue.popleft() for _ in range(min(len(security_log_queue), SECURITY_LOG_BATCH_SIZE))]
+            retries = []
+            if security_log_retries and time.monotonic() - last_retry >= SECURITY_LOG_RETRY_INTERVAL:
+                retries = [security_log_retries.popleft() for _ in range(min(len(security_log_retries), SECURITY_LOG_BATCH_SIZE))]
+                last_retry = time.monotonic()
+            security_log_in_flight.update(entry["user"] for entry in entries + retries)
+
+        try:
+            with background_task_duration.labels("security_log_batch").time():
+                if entries:
+                    write_security_log_batch(entries)
+                if retries:
+                    insert_security_log_entries(retries)  # alerts were already sent
+        finally:
+            with security_log_cond:
+                security_log_in_flight.clear()
+                security_log_cond.notify_all()
+
+
+def discard_security_log(username: str):
+    # Drop the user's pending entries and wait for any that are being written, so none land after their logs are deleted
+    with security_log_cond:
+        for pending in (security_log_queue, security_log_retries):
+            kept = [entry for entry in pending if entry["user"] != username]
+            if len(kept) != len(pending):
+                pending.clear()
+                pending.extend(kept)
+        if not security_log_cond.wait_for(lambda: username not in security_log_in_flight, timeout=SECURITY_LOG_DISCARD_TIMEOUT):
+            log(f"Timed out waiting for security log entries of {username} to be written")
 
 
 def add_audit_log(action_type, mod_username, mod_ip, data):
@@ -589,20 +764,24 @@ def background_tasks_loop():
         log("Running background tasks...")
 
         # Delete accounts scheduled for deletion
-        for user in db.usersv0.find({"delete_after": {"$lt": int(time.time())}}, projection={"_id": 1}):
-            try:
-                delete_account(user["_id"])
-            except Exception as e:
-                log(f"Failed to delete account {user['_id']}: {e}")
+        with background_task_duration.labels("delete_accounts").time():
+            for user in db.usersv0.find({"delete_after": {"$lt": int(time.time())}}, projection={"_id": 1}):
+                try:
+                    delete_account(user["_id"])
+                except Exception as e:
+                    log(f"Failed to delete account {user['_id']}: {e}")
 
         # Revoke inactive sessions (3 weeks of inactivity)
-        db.acc_sessions.delete_many({"refreshed_at": {"$lt": int(time.time())-(86400*21)}})
+        with background_task_duration.labels("revoke_sessions").time():
+            db.acc_sessions.delete_many({"refreshed_at": {"$lt": int(time.time())-(86400*21)}})
 
         # Purge old deleted posts
-        db.posts.delete_many({"deleted_at": {"$lt": int(time.time())-2419200}})
+        with background_task_duration.labels("purge_posts").time():
+            db.posts.delete_many({"deleted_at": {"$lt": int(time.time())-2419200}})
 
         # Purge old post revisions
-        db.post_revisions.delete_many({"time": {"$lt": int(time.time())-2419200}})
+        with background_task_duration.labels("purge_post_revisions").time():
+            db.post_revisions.delete_many({"time": {"$lt": int(time.time())-2419200}})
 
         """ we should probably not be getting rid of audit logs...
         # Purge old "get" admin audit logs
@@ -649,30 +828,32 @@ def get_normalized_email_hash(address: str) -> str:
     return urlsafe_b64encode(sha256(f"{identifier}@{domain}".encode()).digest()).decode()
 
 
-def render_email_tmpl(template: str, to_name: str, to_address: str, data: Optional[dict[str, str]] = {}) -> tuple[str, str]:
-    data.update({
+@cache
+def get_email_platform_env() -> dict[str, str]:
+    return {key: os.getenv(key, "") for key in EMAIL_PLATFORM_ENV_KEYS}
+
+
+def render_email_tmpl(
+    template: str,
+    to_name: str,
+    to_address: str,
+    data: Optional[dict[str, str]] = None,
+    html: bool = True
+) -> tuple[str, Optional[str]]:
+    context = {
+        **(data or {}),
         "subject": EMAIL_SUBJECTS[template],
         "name": to_name,
         "address": to_address,
-        "env": os.environ
-    })
-    
-    txt_tmpl = email_env.get_template(f"{template}.txt")
-    html_tmpl = email_env.get_template(f"{template}.html")
+        "env": get_email_platform_env()
+    }
 
-    return txt_tmpl.render(data), html_tmpl.render(data)
+    txt = email_templates[(template, "txt")].render(context)
+    if html:
+        return txt, email_templates[(template, "html")].render(context)
+    else:
+        return txt, None
 
 
 def send_email(subject: str, to_name: str, to_address: str, txt_tmpl: str, html_tmpl: str):
-    message = MIMEMultipart("alternative")
-    message["From"] = formataddr((os.environ["EMAIL_FROM_NAME"], os.environ["EMAIL_FROM_ADDRESS"]))
-    message["To"] = formataddr((to_name, to_address))
-    message["Subject"] = subject
-    message.attach(MIMEText(txt_tmpl, "plain"))
-    message.attach(MIMEText(html_tmpl, "html"))
-
-    with smtplib.SMTP(os.environ["EMAIL_SMTP_HOST"], int(os.environ["EMAIL_SMTP_PORT"])) as server:
-        if os.getenv("EMAIL_SMTP_TLS"):
-            server.starttls()
-        server.login(os.environ["EMAIL_SMTP_USERNAME"], os.environ["EMAIL_SMTP_PASSWORD"])
-        server.sendmail(os.environ["EMAIL_FROM_ADDRESS"], to_address, message.as_string())
+    outbox.enqueue(subject, to_name, to_address, txt_tmpl, html_tmpl)
@@ -129,12 +129,14 @@ class AccSession:
             if refreshed_at != self._db["refreshed_at"]:
                 return self.revoke()
 
-        self._db.update({
-            "ip": ip,
-            "user_agent": user_agent,
-            "refreshed_at": int(time.time())
-        })
-        db.acc_sessions.update_one({"_id": self._db["_id"]}, {"$set": self._db})
+        # Only write fields that changed
+        updated_vals = {"refreshed_at": int(time.time())}
+        if ip != self._db["ip"]:
+            updated_vals["ip"] = ip
+        if user_agent != self._db["user_agent"]:
+            updated_vals["user_agent"] = user_agent
+        self._db.update(updated_vals)
+        db.acc_sessions.update_one({"_id": self._db["_id"]}, {"$set": updated_vals})
 
         security.log_security_action("session_refresh", self._db["user"], {
             "session_id": self._db["_id"],
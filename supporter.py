@@ -1,10 +1,13 @@
 from threading import Thread
 from typing import Optional, Iterable, Any
-import uuid, time, msgpack, pymongo, re, copy, asyncio
+import uuid, time, msgpack, pymongo, re, copy, asyncio, emoji
 
 from cloudlink import CloudlinkServer
 from database import db, rdb
-from uploads import FileDetails
+from uploads import FileDetails, claim_file
+from utils import log
+from write_behind import write_behind
+import security, errors, netblocks, search_index
 
 """
 Meower Supporter Module
@@ -59,6 +62,12 @@ class Supporter:
             }
         ]}))
 
+    def get_chat_ids(self, username: str) -> list[str]:
+        return [chat["_id"] for chat in db.chats.find({
+            "members": username,
+            "deleted": False
+        }, projection={"_id": 1})]
+
     def create_post(
         self,
         origin: str,
@@ -67,7 +76,6 @@ class Supporter:
         attachments: list[FileDetails] = [],
         stickers: list[str] = [],
         nonce: Optional[str] = None,
-        chat_members: list[str] = [],
         reply_to: list[str] = []
     ) -> tuple[bool, dict]:
         # Create post ID and get timestamp
@@ -105,24 +113,331 @@ class Supporter:
         if nonce:
             post["nonce"] = nonce
 
+        # Update search index
+        if origin == "home":
+            search_index.publish_add(post)
+
         # Send live packet
         if origin == "inbox":
             self.cl.send_event("inbox_message", copy.copy(post), usernames=(None if author == "Server" else [author]))
         else:
-            self.cl.send_event("post", copy.copy(post), usernames=(None if origin in ["home", "livechat"] else chat_members))
+            self.cl.send_event("post", copy.copy(post), chat_id=(None if origin in ["home", "livechat"] else origin))
 
         # Update other database items
         if origin == "inbox":
             if author == "Server":
-                db.user_settings.update_many({}, {"$set": {"unread_inbox": True}})
+                security.bump_inbox_epoch()
             else:
                 db.user_settings.update_one({"_id": author}, {"$set": {"unread_inbox": True}})
-        elif origin != "home":
-            db.chats.update_one({"_id": origin}, {"$set": {"last_active": int(time.time())}})
+        elif origin not in ["home", "livechat"]:
+            write_behind.touch_chat(origin, post["t"]["e"])
 
         # Return post
         return post
 
+    def check_repair_mode(self):
+        # Same gate as check_repair_mode in the REST API, for actions that can come from Cloudlink
+        if self.repair_mode:
+            raise errors.APIError("repairModeEnabled", 503)
+
+    def get_actor_flags(self, username: str) -> int:
+        """
+        Get the current flags of a Cloudlink user that's about to act, raises errors.APIError if they're banned.
+        REST requests get both from check_auth, but Cloudlink sessions outlive bans and flag changes.
+        """
+
+        account = db.usersv0.find_one({"_id": username}, projection={"flags": 1, "ban.state": 1, "ban.expires": 1})
+        if not account:
+            raise errors.APIError("accountDeleted", 401)
+        if account["ban"]["state"] == "perm_ban" or (account["ban"]["state"] == "temp_ban" and account["ban"]["expires"] > time.time()):
+            raise errors.APIError("accountBanned", 403)
+        return account["flags"]
+
+    def submit_post(
+        self,
+        origin: str,
+        author: str,
+        author_flags: int,
+        content: str,
+        attachment_ids: list[str] = [],
+        sticker_ids: list[str] = [],
+        reply_to_ids: list[str] = [],
+        nonce: Optional[str] = None
+    ) -> dict:
+        """
+        Validate and create a post on behalf of a user.
+        Used by both the REST API and Cloudlink, raises errors.APIError if the post is rejected.
+        """
+
+        # Check repair mode
+        self.check_repair_mode()
+
+        if not (author_flags & security.UserFlags.POST_RATELIMIT_BYPASS):
+            # Check ratelimit
+            if security.ratelimited(f"post:{author}"):
+                raise errors.APIError("tooManyRequests", 429)
+
+            # Ratelimit
+            security.ratelimit(f"post:{author}", 6, 5)
+
+        # Check restrictions
+        if security.is_restricted(author, (
+            security.Restrictions.HOME_POSTS if origin == "home" else security.Restrictions.CHAT_POSTS
+        )):
+            raise errors.APIError("accountBanned", 403)
+
+        # Make sure there's not too many attachments
+        if len(attachment_ids) > 10:
+            raise errors.APIError("tooManyAttachments", 400)
+
+        # Make sure the post isn't replying to too many posts
+        if len(reply_to_ids) > 10:
+            raise errors.APIError("tooManyReplies", 400)
+
+        # Make sure there's not too many stickers
+        if len(sticker_ids) > 10:
+            raise errors.APIError("tooManyStickers", 400)
+
+        # Livechat doesn't support attachments or replies
+        if origin == "livechat":
+            attachment_ids = []
+            reply_to_ids = []
+
+        # Get chat
+        chat = None
+        if origin not in {"home", "livechat"}:
+            chat = db.chats.find_one({
+                "_id": origin,
+                "members": author,
+                "deleted": False
+            }, projection={"type": 1, "members": 1})
+            if not chat:
+                raise errors.APIError("notFound", 404)
+
+            # Check DM privacy options
+            if chat["type"] == 1 and db.relationships.count_documents({"$or": [
+                {"_id": {"from": chat["members"][0], "to": chat["members"][1]}},
+                {"_id": {"from": chat["members"][1], "to": chat["members"][0]}}
+            ], "state": 2}, limit=1) > 0:
+                raise errors.APIError("missingPermissions", 403)
+
+        # Make sure stickers exist
+        sticker_ids = [
+            sticker_id for sticker_id in sticker_ids
+            if db.chat_stickers.count_documents({"_id": sticker_id}, limit=1)
+        ]
+
+        # Make sure replied to post IDs exist and are unique
+        unique_reply_to_post_ids = []
+        for post_id in reply_to_ids:
+            if post_id not in unique_reply_to_post_ids and \
+                db.posts.count_documents({"_id": post_id, "post_origin": origin}, limit=1):
+                unique_reply_to_post_ids.append(post_id)
+
+        # Make sure the post has text content or at least 1 attachment or at least 1 sticker
+        if not content and not attachment_ids and not sticker_ids:
+            raise errors.APIError("badRequest", 400)
+
+        # Claim attachments
+        attachments = []
+        for attachment_id in set(attachment_ids):
+            try:
+                attachments.append(claim_file(attachment_id, "attachments"))
+            except Exception as e:
+                log(f"Unable to claim attachment: {e}")
+                raise errors.APIError("unableToClaimAttachment", 500)
+
+        # Update active DMs
+        if chat and chat["type"] == 1:
+            # Re-add members that hid the DM to the chat index
+            self.cl.call_soon(self.cl.add_chat_members, origin, chat["members"])
+
+            write_behind.touch_active_dm(chat["members"], origin)
+
+        # Create post
+        return self.create_post(
+            origin,
+            author,
+            content,
+            attachments=attachments,
+            stickers=sticker_ids,
+            nonce=nonce,
+            reply_to=unique_reply_to_post_ids
+        )
+
+    def emit_typing(self, chat_id: str, username: str):
+        # Check repair mode
+        self.check_repair_mode()
+
+        # Check ratelimit
+        if security.ratelimited(f"typing:{username}"):
+            raise errors.APIError("tooManyRequests", 429)
+
+        # Ratelimit
+        security.ratelimit(f"typing:{username}", 6, 5)
+
+        # Check restrictions
+        if security.is_restricted(username, (
+            security.Restrictions.HOME_POSTS if chat_id == "home" else security.Restrictions.CHAT_POSTS
+        )):
+            raise errors.APIError("accountBanned", 403)
+
+        # Make sure chat exists and user has access
+        if chat_id not in {"home", "livechat"}:
+            if not db.chats.count_documents({
+                "_id": chat_id,
+                "members": username,
+                "deleted": False
+            }, limit=1):
+                raise errors.APIError("notFound", 404)
+
+        # Send typing event
+        self.cl.send_event("typing", {
+            "chat_id": chat_id, "username": username
+        }, chat_id=(None if chat_id in {"home", "livechat"} else chat_id))
+
+    def get_reactable_post(self, post_id: str, username: str) -> tuple[dict, Optional[dict]]:
+        # Get necessary post details
+        post = db.posts.find_one({
+            "_id": post_id,
+            "isDeleted": {"$ne": True}
+        }, projection={
+            "_id": 1,
+            "post_origin": 1,
+            "u": 1,
+            "reactions": 1
+        })
+        if not post:
+            raise errors.APIError("notFound", 404)
+        post.setdefault("reactions", [])  # not added by the migration yet
+
+        # Check access
+        chat = None
+        if post["post_origin"] == "inbox" and post["u"] not in ["Server", username]:
+            raise errors.APIError("notFound", 404)
+        elif post["post_origin"] not in ["home", "inbox"]:
+            chat = db.chats.find_one({
+                "_id": post["post_origin"],
+                "members": username,
+                "deleted": False
+            }, projection={"owner": 1})
+            if not chat:
+                raise errors.APIError("notFound", 404)
+
+        return post, chat
+
+    def add_post_reaction(self, post_id: str, emoji_reaction: str, username: str):
+        # Check repair mode
+        self.check_repair_mode()
+
+        # Ratelimit
+        if security.ratelimited(f"react:{username}"):
+            raise errors.APIError("tooManyRequests", 429)
+        security.ratelimit(f"react:{username}", 5, 5)
+
+        # Check if the emoji is only one emoji, with support for variants
+        if not (emoji.purely_emoji(emoji_reaction) and len(emoji.distinct_emoji_list(emoji_reaction)) == 1):
+            # Check if the emoji is a custom emoji
+            if not db.chat_emojis.count_documents({"_id": emoji_reaction}, limit=1):
+                raise errors.APIError("badRequest", 400)
+
+        # Get post and check access
+        post, _ = self.get_reactable_post(post_id, username)
+
+        # Make sure there's not too many reactions (50)
+        if len(post["reactions"]) >= 50:
+            raise errors.APIError("tooManyReactions", 403)
+
+        # Add reaction
+        db.post_reactions.update_one({"_id": {
+            "post_id": post["_id"],
+            "emoji": emoji_reaction,
+            "user": username
+        }}, {"$set": {"time": int(time.time())}}, upsert=True)
+
+        # Update post
+        existing_reaction = None
+        for reaction in post["reactions"]:
+            if reaction["emoji"] == emoji_reaction:
+                existing_reaction = reaction
+                break
+        if existing_reaction:
+            existing_reaction["count"] = db.post_reactions.count_documents({
+                "_id.post_id": post["_id"],
+                "_id.emoji": existing_reaction["emoji"]
+            })
+        else:
+            post["reactions"].append({
+                "emoji": emoji_reaction,
+                "count": 1
+            })
+        db.posts.update_one({"_id": post["_id"]}, {"$set": {
+            "reactions": post["reactions"]
+        }})
+
+        # Send event
+        self.cl.send_event("post_reaction_add", {
+            "chat_id": post["post_origin"],
+            "post_id": post["_id"],
+            "emoji": emoji_reaction,
+            "username": username
+        }, chat_id=(None if post["post_origin"] in {"home", "inbox"} else post["post_origin"]))
+
+    def remove_post_reaction(self, post_id: str, emoji_reaction: str, username: str, requester: str):
+        # Check repair mode
+        self.check_repair_mode()
+
+        # Ratelimit
+        if security.ratelimited(f"react:{requester}"):
+            raise errors.APIError("tooManyRequests", 429)
+        security.ratelimit(f"react:{requester}", 5, 5)
+
+        # Make sure reaction exists
+        if not db.post_reactions.count_documents({"_id": {
+            "post_id": post_id,
+            "emoji": emoji_reaction,
+            "user": username
+        }}, limit=1):
+            raise errors.APIError("notFound", 404)
+
+        # Get post and check access
+        post, chat = self.get_reactable_post(post_id, requester)
+
+        # Make sure requester can remove the reaction
+        if requester != username:
+            if (post["post_origin"] in ["home", "inbox"]) or (chat["owner"] != requester):
+                raise errors.APIError("missingPermissions", 403)
+
+        # Remove reaction
+        db.post_reactions.delete_one({"_id": {
+            "post_id": post["_id"],
+            "emoji": emoji_reaction,
+            "user": username
+        }})
+
+        # Update post
+        for reaction in post["reactions"]:
+            if reaction["emoji"] != emoji_reaction:
+                continue
+            reaction["count"] = db.post_reactions.count_documents({
+                "_id.post_id": post["_id"],
+                "_id.emoji": reaction["emoji"]
+            })
+            if not reaction["count"]:
+                post["reactions"].remove(reaction)
+            break
+        db.posts.update_one({"_id": post["_id"]}, {"$set": {
+            "reactions": post["reactions"]
+        }})
+
+        # Send event
+        self.cl.send_event("post_reaction_remove", {
+            "chat_id": post["post_origin"],
+            "post_id": post["_id"],
+            "emoji": emoji_reaction,
+            "username": username
+        }, chat_id=(None if post["post_origin"] in {"home", "inbox"} else post["post_origin"]))
+
     def listen_for_admin_pubsub(self):
         pubsub = rdb.pubsub()
         pubsub.subscribe("admin")
@@ -137,6 +452,14 @@ class Supporter:
                             asyncio.run(c.kick())
                     case "alert_user":
                         self.create_post("inbox", msg["user"], msg["content"])
+                    case "search_index":
+                        search_index.home_index.apply_update(msg)
+                    case "username_index":
+                        search_index.username_index.apply_update(msg)
+                    case "netblock_update":
+                        netblocks.apply_update(msg)
+                        if msg["action"] == "add" and msg["type"] == 0:
+                            self.cl.call_soon(self.cl.kick_blocked_clients)
                     case "ban_user":
                         # Get user details
                         username = msg.pop("user")
@@ -190,6 +513,11 @@ class Supporter:
                 "post_id": post["_id"]
             })
 
+            # Fields that the migration may not have added yet
+            post.setdefault("attachments", [])
+            post.setdefault("reactions", [])
+            post.setdefault("pinned", False)
+
             # Author
             post.update({"author": db.usersv0.find_one({"_id": post["u"]}, projection={
                 "_id": 1,
@@ -0,0 +1,176 @@
+from threading import Condition, Lock
+from typing import Optional
+import time, os, pymongo
+
+from database import db
+from utils import log
+from metrics import background_task_duration
+
+"""
+Meower Write-Behind Module
+This module coalesces frequent, non-critical database writes (such as active DMs, chat activity and last seen)
+and flushes them to the database in batched bulk writes from a single worker thread.
+Writes that fail to flush are requeued for the next flush, and stop() flushes whatever is left on shutdown.
+"""
+
+FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 1))
+ACTIVE_DMS_LIMIT = 150
+
+
+class WriteBehindQueue:
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self._cond = Condition()
+        self._flush_lock = Lock()
+        self._stopped = False
+
+        # Pending writes, merged per key
+        self._active_dms: dict[str, list[str]] = {}  # {"username": ["oldest_chat_id", ..., "newest_chat_id"]}
+        self._chats_last_active: dict[str, int] = {}  # {"chat_id": last_active}
+        self._last_seen: dict[str, int] = {}  # {"username": last_seen}
+
+        # Stats
+        self.flushes: int = 0
+        self.failed_flushes: int = 0
+        self.merged_writes: int = 0
+        self.last_flush_at: Optional[float] = None
+        self.last_flush_ms: float = 0.0
+        self.max_flush_ms: float = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._active_dms) + len(self._chats_last_active) + len(self._last_seen)
+
+    def touch_active_dm(self, usernames: list[str], chat_id: str):
+        with self._cond:
+            for username in usernames:
+                chat_ids = self._active_dms.setdefault(username, [])
+                if chat_id in chat_ids:
+                    chat_ids.remove(chat_id)
+                    self.merged_writes += 1
+                chat_ids.append(chat_id)
+
+    def touch_chat(self, chat_id: str, last_active: Optional[int] = None):
+        if last_active is None:
+            last_active = int(time.time())
+        with self._cond:
+            if chat_id in self._chats_last_active:
+                self.merged_writes += 1
+            self._chats_last_active[chat_id] = max(last_active, self._chats_last_active.get(chat_id, 0))
+
+    def touch_last_seen(self, username: str, last_seen: Optional[int] = None):
+        if last_seen is None:
+            last_seen = int(time.time())
+        with self._cond:
+            if username in self._last_seen:
+                self.merged_writes += 1
+            self._last_seen[username] = max(last_seen, self._last_seen.get(username, 0))
+
+    def requeue(self, active_dms: dict[str, list[str]], chats_last_active: dict[str, int], last_seen: dict[str, int]):
+        # Merge failed writes back in, under anything that was queued since
+        with self._cond:
+            for username, chat_ids in active_dms.items():
+                newer_chat_ids = self._active_dms.get(username, [])
+                self._active_dms[username] = [chat_id for chat_id in chat_ids if chat_id not in newer_chat_ids] + newer_chat_ids
+            for chat_id, last_active in chats_last_active.items():
+                self._chats_last_active[chat_id] = max(last_active, self._chats_last_active.get(chat_id, 0))
+            for username, timestamp in last_seen.items():
+                self._last_seen[username] = max(timestamp, self._last_seen.get(username, 0))
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        # Swap out pending writes
+        with self._cond:
+            active_dms, self._active_dms = self._active_dms, {}
+            chats_last_active, self._chats_last_active = self._chats_last_active, {}
+            last_seen, self._last_seen = self._last_seen, {}
+        if not (active_dms or chats_last_active or last_seen):
+            return
+
+        # Every write is idempotent, so groups that fail can be retried as a whole on the next flush
+        started_at = time.perf_counter()
+        failed = {"active_dms": {}, "chats_last_active": {}, "last_seen": {}}
+
+        # Move chats to the front of active DMs
+        # ($pull and $push on the same field can't be in one update, so this has to stay ordered)
+        if active_dms:
+            updates = []
+            for username, chat_ids in active_dms.items():
+                updates.append(pymongo.UpdateOne({"_id": username}, {"$pull": {"active_dms": {"$in": chat_ids}}}))
+                updates.append(pymongo.UpdateOne({"_id": username}, {"$push": {"active_dms": {
+                    "$each": chat_ids[::-1],
+                    "$position": 0,
+                    "$slice": -ACTIVE_DMS_LIMIT
+                }}}))
+            try:
+                db.user_settings.bulk_write(updates, ordered=True)
+            except Exception as e:
+                log(f"Unable to flush active DMs from write-behind queue: {e}")
+                failed["active_dms"] = active_dms
+
+        # Update chats last active
+        if chats_last_active:
+            try:
+                db.chats.bulk_write([
+                    pymongo.UpdateOne({"_id": chat_id}, {"$max": {"last_active": last_active}})
+                    for chat_id, last_active in chats_last_active.items()
+                ], ordered=False)
+            except Exception as e:
+                log(f"Unable to flush chats last active from write-behind queue: {e}")
+                failed["chats_last_active"] = chats_last_active
+
+        # Update users last seen
+        if last_seen:
+            try:
+                db.usersv0.bulk_write([
+                    pymongo.UpdateOne({"_id": username}, {"$max": {"last_seen": timestamp}})
+                    for username, timestamp in last_seen.items()
+                ], ordered=False)
+            except Exception as e:
+                log(f"Unable to flush last seen from write-behind queue: {e}")
+                failed["last_seen"] = last_seen
+
+        if any(failed.values()):
+            self.failed_flushes += 1
+            self.requeue(**failed)
+
+        self.flushes += 1
+        self.last_flush_at = time.time()
+        self.last_flush_ms = (time.perf_counter() - started_at) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        background_task_duration.labels("write_behind_flush").observe(self.last_flush_ms / 1000)
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped, timeout=self.interval)
+                stopped = self._stopped
+            self.flush()
+            if stopped:
+                return
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        # Flush what's left from the calling thread, the worker is a daemon thread so it may not get to
+        self.flush()
+
+    def get_stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "interval": self.interval,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "merged_writes": self.merged_writes,
+            "last_flush_at": self.last_flush_at,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3)
+        }
+
+
+write_behind = WriteBehindQueue()